@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Benchmark of routing the 'command' event to plugins.
+
+Compares the indexed routing done by ``seejoo.ext.get_command_handlers``
+against the previous approach of checking every plugin's 'commands' attribute.
+The time of whole ``seejoo.ext.notify`` is shown as well: calling handlers
+through Deferreds costs much more than finding them, whichever way it's done.
+Run it from the repository root, optionally passing the numbers of plugins::
+
+    $ PYTHONPATH=. python benchmarks/command_routing.py 50 100
+'''
+import sys
+import timeit
+
+from seejoo import ext
+
+
+PLUGIN_COUNTS = (10, 50, 200)
+COMMANDS_PER_PLUGIN = 3
+ITERATIONS = 20000
+
+
+class BenchmarkPlugin(ext.Plugin):
+    def __init__(self, prefix):
+        self.commands = dict(('%s_%d' % (prefix, i), None)
+                             for i in xrange(COMMANDS_PER_PLUGIN))
+
+    def command(self, bot, channel, user, cmd, args):
+        return cmd
+
+
+def route_by_scanning(cmd):
+    ''' Routing of the command event the way it used to be done:
+    by asking every plugin whether it supports the command.
+    '''
+    def supports_command(plugin):
+        if not hasattr(plugin, 'commands'):
+            return True
+        return cmd in plugin.commands
+
+    return [(plugin, handler)
+            for plugin, handler in ext._subscribers['command']
+            if supports_command(plugin)]
+
+
+def run(count):
+    for plugin in list(ext._plugins):
+        ext.unregister_plugin(plugin)
+    for i in xrange(count):
+        ext.register_plugin(BenchmarkPlugin('cmd%d_%d' % (count, i)))
+
+    kwargs = dict(channel='#seejoo', user='nick!id@host',
+                  cmd='cmd%d_%d_0' % (count, count // 2), args=None)
+    cmd = kwargs['cmd']
+    assert route_by_scanning(cmd) == ext.get_command_handlers(cmd)
+
+    scanning = timeit.timeit(lambda: route_by_scanning(cmd),
+                             number=ITERATIONS)
+    indexed = timeit.timeit(lambda: ext.get_command_handlers(cmd),
+                            number=ITERATIONS)
+    notify = timeit.timeit(lambda: ext.notify(None, 'command', **kwargs),
+                           number=ITERATIONS)
+
+    per_call = lambda t: t / ITERATIONS * 1e6
+    print ("%4d plugins: scanning %7.2f us/cmd, indexed %5.2f us/cmd (%.1fx);"
+           " whole notify %5.2f us/cmd" % (
+               count, per_call(scanning), per_call(indexed),
+               scanning / indexed, per_call(notify)))
+
+
+def main(argv=None):
+    counts = map(int, (argv or sys.argv)[1:]) or PLUGIN_COUNTS
+    for count in counts:
+        run(count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Benchmark of notifying plugins about the 'message' event.
+
+Compares dispatching event objects (``seejoo.events``) against
+the previous approach of passing event's fields as keyword arguments,
+which builds a new dictionary for every plugin notified.
+Run it from the repository root, optionally passing the numbers of plugins::
+
+    $ PYTHONPATH=. python benchmarks/event_dispatch.py 5 20
+'''
+import sys
+import timeit
+
+from seejoo import events, ext
+
+
+PLUGIN_COUNTS = (5, 20)
+ITERATIONS = 50000
+
+# Fields of the event, in order
+MESSAGE = (('channel', '#seejoo'), ('user', 'nick!~id@example.com'),
+           ('message', "Hello, world"), ('type', ext.MSG_SAY))
+
+
+class BenchmarkPlugin(ext.Plugin):
+    def message(self, bot, channel, user, message, type):
+        pass
+
+
+def notify_with_kwargs(bot, event, **kwargs):
+    ''' Notifying plugins the way it used to be done:
+    with event's fields as keyword arguments.
+    '''
+    try:
+        for plugin, _ in ext._subscribers.get(event, ()):
+            res = getattr(plugin, event)(bot, **kwargs)
+            if res is not None:
+                ext._resolve_result(res)
+    except Exception:
+        pass
+
+
+def run(count):
+    for plugin in list(ext._plugins):
+        ext.unregister_plugin(plugin)
+    for _ in xrange(count):
+        ext.register_plugin(BenchmarkPlugin())
+
+    kwargs = dict(MESSAGE)
+    args = [value for _, value in MESSAGE]
+    with_kwargs = timeit.timeit(
+        lambda: notify_with_kwargs(None, 'message', **kwargs),
+        number=ITERATIONS)
+    with_objects = timeit.timeit(
+        lambda: ext.notify(None, events.Message(*args)),
+        number=ITERATIONS)
+
+    # Sizes of objects holding the event's fields, created per notification:
+    # a dictionary for the call and every plugin vs. one event object
+    kwargs_size = sys.getsizeof(kwargs) * (count + 1)
+    object_size = sys.getsizeof(events.Message(*args))
+
+    per_call = lambda t: t / ITERATIONS * 1e6
+    print ("%3d plugins: kwargs %6.2f us/event (%5d B), "
+           "objects %6.2f us/event (%3d B)") % (
+        count, per_call(with_kwargs), kwargs_size,
+        per_call(with_objects), object_size)
+
+
+def main(argv=None):
+    counts = map(int, (argv or sys.argv)[1:]) or PLUGIN_COUNTS
+    for count in counts:
+        run(count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+'''
+Benchmark of the prefix tree used for looking up commands.
+
+Compares ``seejoo.util.prefix_tree.PrefixTree`` against the previous
+implementation, which sorted and scanned node's children at every step.
+Run it from the repository root, optionally passing the numbers of keys::
+
+    $ PYTHONPATH=. python benchmarks/prefix_tree.py 1000 5000
+'''
+import random
+import string
+import sys
+import timeit
+
+from seejoo.util.prefix_tree import PrefixTree
+
+
+KEY_COUNTS = (1000, 3000)
+ITERATIONS = 20000
+
+
+class LegacyPrefixTree(object):
+    '''
+    Previous implementation of the prefix tree, kept for comparison.
+    A generalized prefix tree node. Node contains:
+    - data (any object)
+    - links to children, each of them (i.e. links) labeled with a string
+    '''
+    def __init__(self, data = None):
+        ''' Initializes the prefix tree node. '''
+        self.data = data
+        self.children = {}
+
+    def _traverse(self, path):
+        '''
+        Internal function that traverses the prefix tree, searching for
+        node which lies at the end of given path.
+        Returns result of traversal which can be either a node
+        found at the end of the path or a node where a divergence
+        has been found and new node should potentially be inserted.
+        @param path: A string determining the path in tree to traverse
+        @return: 2-tuple: a node and a string path in tree that was traversed
+        '''
+        if not path:    return self, ""
+
+        node = self
+        ahead = path
+        while len(ahead) > 0:
+            # Pick a path to go down
+            for c in sorted(node.children.keys(), key = len, reverse = True):
+                if len(c) > len(ahead): continue
+                if ahead.startswith(c):
+                    node = node.children[c]
+                    ahead = ahead[len(c):]
+                    break
+            else:
+                # No path to go down;
+                # either a divergence or leaf
+                return node, path[:path.find(ahead)]
+
+        return node, path   # Found a match
+
+    def get(self, path):
+        '''
+        Retrieves an item from this node's subtree if it exists.
+        @note: This node is part of its subtree so its key should prefix
+        the parameter of this function for anything to be found
+        @return: Data of the item or None if it could not be found
+        '''
+        node, tree_path = self._traverse(path)
+        return node.data if tree_path == path else None
+
+    def add(self, path, data):
+        '''
+        Adds an item to this node subtree.
+        @return: Whether the item could be added
+        '''
+        # Special case for insertion in the current node
+        if not path:
+            if self.data:   return False
+            self.data = data
+            return True
+
+        node, tree_path = self._traverse(path)
+        if path == tree_path:   return False
+
+        new_node = LegacyPrefixTree(data)
+
+        # Relocate nodes that should be children of the newly created one
+        rest = path[len(tree_path):]
+        to_delete = []
+        for label, child in node.children.items():
+            if label.startswith(rest):
+                new_label = label[len(rest):]
+                new_node.children[new_label] = child
+                to_delete.append(label)
+        for label in to_delete:
+            del node.children[label]
+
+        node.children[rest] = new_node
+        return True
+
+    def search(self, prefix):
+        '''
+        Searches for all nodes that match given prefix.
+        @return: A dictionary of matches, with values being data
+        of nodes found
+        '''
+        res = {}
+        node, path = self._traverse(prefix)
+
+        # Do a DFS from given node
+        stack = [(path, node)]
+        while len(stack) > 0:
+            curr_prefix, curr_node = stack.pop()
+            rest = prefix[len(curr_prefix):]
+            if rest:
+                # Keep looking: try child nodes,
+                # but only those that go along the path of the search prefix
+                for child_label, child_node in curr_node.children.items():
+                    if child_label.startswith(rest) or rest.startswith(child_label):
+                        stack.append((curr_prefix + child_label, child_node))
+            else:
+                # This path is exhausted so we reached at some viable search result
+                res[curr_prefix] = curr_node
+
+        return res
+
+
+def generate_keys(count):
+    ''' Generates given number of command-like names,
+    many of them sharing common prefixes.
+    '''
+    rng = random.Random(count)
+    stems = [''.join(rng.choice(string.ascii_lowercase)
+                     for _ in xrange(rng.randint(1, 4)))
+             for _ in xrange(count // 10 or 1)]
+    keys = set()
+    while len(keys) < count:
+        keys.add(rng.choice(stems) + ''.join(
+            rng.choice(string.ascii_lowercase)
+            for _ in xrange(rng.randint(0, 6))))
+    return list(keys)
+
+
+def measure(tree, keys, prefixes):
+    ''' Measures the time of building a tree and doing lookups in it.
+    @return: Times (in microseconds) per add, get and search
+    '''
+    build = timeit.timeit(lambda: [tree().add(key, key) for key in keys[:100]],
+                          number=ITERATIONS // 1000) / (ITERATIONS // 1000 * 100)
+
+    instance = tree()
+    for key in keys:
+        instance.add(key, key)
+    lookups = [keys[i % len(keys)] for i in xrange(ITERATIONS)]
+    get = timeit.timeit(lambda: [instance.get(key) for key in lookups],
+                        number=1) / ITERATIONS
+    search = timeit.timeit(lambda: [instance.search(p) for p in prefixes],
+                           number=1) / len(prefixes)
+    return build * 1e6, get * 1e6, search * 1e6
+
+
+def run(count):
+    keys = generate_keys(count)
+    prefixes = [key[:3] for key in keys[:ITERATIONS // 10]]
+
+    print "%5d keys:" % count
+    for name, tree in (("legacy", LegacyPrefixTree), ("radix", PrefixTree)):
+        print "  %-6s add %6.2f us, get %6.2f us, search %8.2f us" % (
+            (name,) + measure(tree, keys, prefixes))
+
+
+def main(argv=None):
+    counts = map(int, (argv or sys.argv)[1:]) or KEY_COUNTS
+    for count in counts:
+        run(count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+Benchmark of finding new items in RSS feed, when there are few or none.
+
+Compares the incremental parsing of ``seejoo.plugins.rss``, which stops
+at the last seen item, against the previous approach: parsing the whole
+feed (with dateutil for every date), sorting it, and only then dropping
+the items that have been seen already.
+Run it from the repository root, optionally passing the numbers of items::
+
+    $ PYTHONPATH=. python benchmarks/rss_parsing.py 50 500
+'''
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from itertools import takewhile
+import calendar
+import sys
+import timeit
+
+from dateutil.parser import parse as parse_date
+from lxml import etree
+import pytz
+
+from seejoo.plugins import rss
+
+
+ITEM_COUNTS = (50, 500)
+NEW_ITEMS = (0, 3)
+ITERATIONS = 200
+
+
+def make_feed(count):
+    ''' Creates content of a feed with given number of items,
+    newest first, one per hour.
+    '''
+    now = datetime(2015, 1, 1)
+    items = []
+    for i in xrange(count):
+        date = now - timedelta(hours=i)
+        items.append(
+            "<item><title>Item %d</title><link>http://example.com/%d</link>"
+            "<guid>%d</guid><pubDate>%s</pubDate>"
+            "<description>%s</description></item>" % (
+                i, i, count - i,
+                formatdate(calendar.timegm(date.timetuple())),
+                "Lorem ipsum dolor sit amet. " * 10))
+    return "<rss><channel><title>Feed</title>%s</channel></rss>" % (
+        "".join(items))
+
+
+def legacy_get_new_items(content, until):
+    ''' Finding new items the way it used to be done. '''
+    res = []
+    for channel in etree.fromstring(content).iter('channel'):
+        for item in channel.iter('item'):
+            rss_item = dict((elem.tag, elem.text)
+                            for elem in item.iter(tag=etree.Element)
+                            if elem.tag != 'item')
+            try:
+                pub_date = parse_date(rss_item['pubDate'])
+                if pub_date.tzinfo is not None:
+                    pub_date = pub_date.astimezone(pytz.utc)
+                    pub_date = pub_date.replace(tzinfo=None)
+                rss_item['pubDate'] = pub_date
+            except (KeyError, ValueError):
+                rss_item.pop('pubDate', None)
+            res.append(rss_item)
+
+    res = sorted(res, key=lambda item: item.get('pubDate', datetime.min),
+                 reverse=True)
+    return list(takewhile(lambda item: not until(item), res))
+
+
+def run(count, new):
+    content = make_feed(count)
+    last_item = str(count - new)
+    until = lambda item: item.get('guid') == last_item
+
+    assert (len(rss.get_new_items(content, until)) ==
+            len(legacy_get_new_items(content, until)) == new)
+
+    legacy = timeit.timeit(lambda: legacy_get_new_items(content, until),
+                           number=ITERATIONS)
+    incremental = timeit.timeit(lambda: rss.get_new_items(content, until),
+                                number=ITERATIONS)
+
+    per_call = lambda t: t / ITERATIONS * 1e3
+    print "%4d items, %d new: legacy %7.3f ms, incremental %7.3f ms" % (
+        count, new, per_call(legacy), per_call(incremental))
+
+
+def main(argv=None):
+    counts = map(int, (argv or sys.argv)[1:]) or ITEM_COUNTS
+    for count in counts:
+        for new in NEW_ITEMS:
+            run(count, new)
+
+
+if __name__ == '__main__':
+    main()
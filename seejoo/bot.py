@@ -11,14 +11,16 @@ import os
 import re
 import socket
 
-from twisted.internet import reactor, task
+from twisted.internet import defer, reactor
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.words.protocols.irc import IRCClient as _IRCClient
 
 import seejoo
-from seejoo import ext
+from seejoo import events, ext
 from seejoo.config import config
 from seejoo.util import irc
+from seejoo.util.roster import Roster
+from seejoo.util.scheduler import Scheduler
 from seejoo.util.strings import normalize_whitespace
 
 
@@ -42,7 +44,34 @@ class IRCClient(_IRCClient):
         self.invited(inviter, channel)
 
 
-COMMAND_RE = re.compile(r"(?P<cmd>\w+)(\s+(?P<args>.+))?")
+# Command can be suffixed with '!' to bypass the cache for its results
+COMMAND_RE = re.compile(r"(?P<cmd>\w+)(?P<nocache>!)?(\s+(?P<args>.+))?")
+
+# Quit message of users disconnected by a netsplit: names of the two servers,
+# which some networks mask (e.g. "*.net *.split")
+NETSPLIT_RE = re.compile(r"^[\w*-]+(\.[\w*-]+)+ [\w*-]+(\.[\w*-]+)+$")
+NETSPLIT_WINDOW = 2.0  # seconds without quits/joins that end the batch
+NETSPLIT_MIN_USERS = 3  # for the batch to be considered a netsplit/netjoin
+NETJOIN_TIMEOUT = 15 * 60  # for users to come back after netsplit
+
+
+class EventBatch(object):
+    """Users affected by a netsplit or netjoin, collected until
+    no more of them appear for NETSPLIT_WINDOW seconds.
+    """
+    def __init__(self, end):
+        self.users = []
+        self.hostmasks = []
+        self._end_call = reactor.callLater(NETSPLIT_WINDOW, end)
+
+    def add(self, user, hostmask):
+        self.users.append(user)
+        self.hostmasks.append(hostmask)
+        self._end_call.reset(NETSPLIT_WINDOW)
+
+    def cancel(self):
+        if self._end_call.active():
+            self._end_call.cancel()
 
 
 class Bot(IRCClient):
@@ -56,6 +85,13 @@ class Bot(IRCClient):
         self.config = config
         self.nickname = config.nickname
         self.channels = set()
+        self.roster = Roster()  # members of channels
+        self.scheduler = Scheduler()
+        self._hostmask = None  # of the sender of line being handled
+
+        self._netsplits = {}  # servers -> EventBatch of quits
+        self._netjoins = {}  # (servers, channel) -> EventBatch of joins
+        self._split_users = {}  # nick -> (servers, time to give up waiting)
 
         self._register_meta_commands()
         __import__('seejoo.commands')  # TODO(xion): turn these into plugins
@@ -63,9 +99,9 @@ class Bot(IRCClient):
         self._import_plugins()
         self._init_plugins()
 
-        # schedule a task to be ran every second
-        tick_task = task.LoopingCall(self.tick)
-        tick_task.start(1.0)
+        # only plugins which still handle the 'tick' event need it every second
+        if ext._subscribers.get('tick'):
+            self.every(1.0, self.tick)
 
     def _register_meta_commands(self):
         ''' Registers the "meta" commands,
@@ -74,6 +110,7 @@ class Bot(IRCClient):
         for cmd, doc in ext.BOT_COMMANDS.iteritems():
             func = functools.partial(self._handle_command, cmd)
             func.__doc__ = doc
+            func.reactor_safe = True
             ext.register_command(cmd, func)
 
     def _import_plugins(self):
@@ -102,9 +139,9 @@ class Bot(IRCClient):
 
     def _init_plugins(self):
         ''' Initializes plugins that have a configuration section in config.plugins. '''
-        for plugin in ext._plugins:
+        for plugin, handler in ext._subscribers.get('init', ()):
             conf = config.plugins.get(plugin.__module__)
-            plugin(self, 'init', config=conf)
+            handler(self, events.Init(conf))
 
     def _handle_command(self, cmd, args):
         ''' Handles a bot-level command. Returns its result. '''
@@ -123,10 +160,25 @@ class Bot(IRCClient):
                 return "No help found for '%s'" % args
 
     def tick(self):
-        ''' Method called every second. Provides a way for plugins
-        to perform actions based on time.
+        ''' Method called every second, if any plugins subscribe
+        to the 'tick' event. Those which only need to do something
+        from time to time should use schedule() or every() instead.
+        '''
+        ext.notify(self, events.Tick())
+
+    def schedule(self, delay, func):
+        ''' Schedules a function to be called after given number of seconds.
+        @return: Timer object, with cancel() method
+        '''
+        return self.scheduler.schedule(delay, func)
+
+    def every(self, interval, func, jitter=0, delay=None):
+        ''' Schedules a function to be called every interval seconds,
+        plus random jitter of up to given number of seconds.
+        @param delay: Seconds before the first call (default: interval)
+        @return: Timer object, with cancel() method
         '''
-        ext.notify(self, 'tick')
+        return self.scheduler.every(interval, func, jitter, delay)
 
     def signedOn(self):
         ''' Method called upon successful connection to IRC server. '''
@@ -150,11 +202,58 @@ class Bot(IRCClient):
         if config.join_on_invite:
             self.join(channel)
 
+    def handleCommand(self, command, prefix, params):
+        ''' Method called for every line received from the server. '''
+        # Sender's hostmask is parsed once, to be passed to plugins
+        # along with the event(s) that the line causes
+        self._hostmask = irc.parse_hostmask(prefix)
+        try:
+            IRCClient.handleCommand(self, command, prefix, params)
+        finally:
+            self._hostmask = None
+
+    def isupport(self, options):
+        ''' Method called with features supported by the server. '''
+        casemapping = self.supported.getFeature('CASEMAPPING')
+        if casemapping and casemapping[0] != self.roster.casemapping:
+            # Announced upon connecting, before any channels are joined
+            self.roster = Roster(casemapping[0])
+
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        ''' Handles the list of users on a channel (a NAMES reply). '''
+        channel, names = params[2], params[3].split()
+        modes = dict((symbol, mode) for mode, (symbol, _)
+                     in self.supported.getFeature('PREFIX', {}).iteritems())
+        for name in names:
+            i = 0
+            while i < len(name) and name[i] in modes:
+                i += 1
+            user_modes = "".join(modes[symbol] for symbol in name[:i])
+
+            # Names can be full hostmasks if server supports userhost-in-names
+            hostmask = irc.parse_hostmask(name[i:]) if '!' in name else None
+            nick = hostmask.nick if hostmask else name[i:]
+            self.roster.add(channel, nick, user_modes, hostmask)
+
+    def irc_RPL_WHOREPLY(self, prefix, params):
+        ''' Handles the information about a user (a WHO reply). '''
+        _, _, ident, host, _, nick = params[:6]
+        self.roster.set_hostmask(
+            nick, irc.parse_hostmask("%s!%s@%s" % (nick, ident, host)))
+
+    def _notify(self, event_class, *args):
+        ''' Notifies plugins about an event caused by the line
+        being currently handled.
+        @param args: Fields of the event, except for hostmask
+        '''
+        event = event_class(*args, hostmask=self._hostmask)
+        return ext.notify(self, event)
+
     def myInfo(self, servername, version, umodes, cmodes):
         ''' Method called with information about the server. '''
         logging.debug("[SERVER] %s running %s; usermodes=%s, channelmodes=%s",
                       servername, version, umodes, cmodes)
-        ext.notify(self, 'connect', host=servername)
+        ext.notify(self, events.Connect(servername))
 
     def message(self, user, channel, message):
         ''' Method called upon receiving a message on a channel or private message. '''
@@ -163,9 +262,8 @@ class Bot(IRCClient):
             return
 
         is_priv = channel == self.nickname
-        ext.notify(self, 'message', user=user,
-                   channel=None if is_priv else channel,
-                   message=message, type=ext.MSG_SAY)
+        self._notify(events.Message, None if is_priv else channel,
+                     user, message, ext.MSG_SAY)
 
         if is_priv:
             is_command = True   # on priv, everything's a command
@@ -184,15 +282,23 @@ class Bot(IRCClient):
                      user, channel if not is_priv else '__priv__', message)
 
         if is_command:
-            resp = self._command(user, message,
-                                 channel=None if is_priv else channel)
-            if resp:
-                logging.info("[RESPONSE] %s", resp)
-                irc.say(self, user if is_priv else channel, resp)
+            d = self._command(user, message,
+                              channel=None if is_priv else channel)
+            d.addCallback(self._respond, user if is_priv else channel)
+            d.addErrback(lambda failure: logging.error(
+                "Error while processing command: %s",
+                failure.getTraceback()))
+
+    def _respond(self, resp, recipient):
+        ''' Says the response to a command, if there is any. '''
+        if resp:
+            logging.info("[RESPONSE] %s", resp)
+            irc.say(self, recipient, resp)
 
     def _command(self, user, command, channel=None):
         '''Internal function that handles the processing of commands.
-        Returns the result of processing as a text response to be "said" by the bot,
+        Returns a Deferred which fires with the result of processing
+        as a text response to be "said" by the bot,
         or None if it wasn't actually a command.
 
         :param channel: Channel where the command was issued
@@ -200,66 +306,86 @@ class Bot(IRCClient):
         '''
         m = COMMAND_RE.match(command)
         if not m:
-            return
+            return defer.succeed(None)
 
         cmd = m.group('cmd')
         args = m.groupdict().get('args')
+        nocache = bool(m.group('nocache'))
 
-        # Poll plugins for command result
-        resp = ext.notify(self, 'command',
-                          channel=channel, user=user, cmd=cmd, args=args)
-        if resp:
-            return self._reply(to=user, response=resp)
-
-        # Plugins didn't care so find a command and invoke it if present
+        # Poll plugins for command result;
+        # if they didn't care, find a command and invoke it if present
+        def handle_plugins_response(resp):
+            if resp:
+                return self._reply(to=user, response=resp)
+            return self._invoke_command(user, cmd, args, channel, nocache)
+
+        event = events.Command(channel, user, cmd, args,
+                               hostmask=irc.parse_hostmask(user))
+        d = ext.notify(self, event, nocache=nocache)
+        d.addCallback(handle_plugins_response)
+        return d
+
+    def _invoke_command(self, user, cmd, args, channel=None, nocache=False):
+        '''Finds a command object and invokes it, if present.
+        Returns the result of processing as a text response
+        (or a Deferred of it).
+        '''
         cmd_object = ext.get_command(cmd)
-        if cmd_object:
-            if callable(cmd_object):
-                try:
-                    resp = cmd_object(args)
-                except Exception, e:
-                    resp = type(e).__name__ + ": " + str(e)
-                resp = [resp]  # Since we expect response to be iterable
-            else:
-                return ["Error while executing command '%s'" % cmd]
+        if not cmd_object:
+            return self._unknown_command(user, cmd, args, channel, nocache)
+        if not callable(cmd_object):
+            return ["Error while executing command '%s'" % cmd]
+
+        def format_error(failure):
+            return failure.type.__name__ + ": " + str(failure.value)
+
+        kwargs = {'user': user} if ext.wants_user(cmd_object) else {}
+        d = ext.call_cached(cmd_object, (cmd, args), nocache, args, **kwargs)
+        d.addErrback(format_error)
+        d.addCallback(lambda resp: self._reply(
+            to=user, response=[resp]))  # Since we expect response to be iterable
+        return d
+
+    def _unknown_command(self, user, cmd, args, channel=None, nocache=False):
+        '''Handles a command that hasn't been registered.
+        Returns the result of processing as a text response.
+        '''
+        # Check whether the command can be unambiguously resolved
+        completions = ext._commands.completions(cmd)
+        if len(completions) == 1:
+            command = completions[0]
+            if nocache:
+                command += "!"
+            if args:
+                command += " %s" % args
+            return self._command(user, command, channel)
+
+        # Otherwise, suggest the possible completions
+        # or commands with similar names, if it was misspelled
+        suggestions = completions or ext.suggest_commands(cmd)
+
+        if len(suggestions) == 0:
+            resp = ["Unrecognized command '%s'." % cmd]
         else:
-            # Check whether the command can be unambiguously resolved
-            completions = ext._commands.search(cmd).keys()
-            if len(completions) == 1:
-                command = completions[0]
-                if args:
-                    command += " %s" % args
-                return self._command(user, command)
-
-            # Otherwise, suggest other variants
-            suggestions = set()
-            for i in range(1, len(cmd) + 1):
-                completions = ext._commands.search(cmd[:i]).keys()
-                suggestions.update(set(completions))
-
-            if len(suggestions) == 0:
-                resp = ["Unrecognized command '%s'." % cmd]
-            else:
-                # If there are too many suggestions, filter them out
-                MAX_SUGGESTIONS = 5
-                suggestions = filter(None, suggestions)
-                more = None
-                if len(suggestions) > MAX_SUGGESTIONS:
-                    more = len(suggestions) - MAX_SUGGESTIONS
-                    suggestions = suggestions[:MAX_SUGGESTIONS]
-
-                # Include normal command prefix
-                if config.cmd_prefix:
-                    suggestions = [config.cmd_prefix + s for s in suggestions]
+            # If there are too many suggestions, filter them out
+            MAX_SUGGESTIONS = 5
+            more = None
+            if len(suggestions) > MAX_SUGGESTIONS:
+                more = len(suggestions) - MAX_SUGGESTIONS
+                suggestions = suggestions[:MAX_SUGGESTIONS]
+
+            # Include normal command prefix
+            if config.cmd_prefix:
+                suggestions = [config.cmd_prefix + s for s in suggestions]
 
-                # Format the suggestions nicely
-                if len(suggestions) == 1:
-                    resp = ["Did you mean %s ?" % suggestions[0]]
-                else:
-                    suggestions = str.join(" ", suggestions)
-                    if more:
-                        suggestions += " ... (%s more)" % more
-                    resp = ["Did you mean one of: %s ?" % suggestions]
+            # Format the suggestions nicely
+            if len(suggestions) == 1:
+                resp = ["Did you mean %s ?" % suggestions[0]]
+            else:
+                suggestions = str.join(" ", suggestions)
+                if more:
+                    suggestions += " ... (%s more)" % more
+                resp = ["Did you mean one of: %s ?" % suggestions]
 
         return self._reply(to=user, response=resp)
 
@@ -282,9 +408,8 @@ class Bot(IRCClient):
         # Notify plugins and log message
         logging.debug("[ACTION] * %s/%s %s", user,
                       channel if not is_priv else '__priv__', message)
-        ext.notify(self, 'message',
-                   user=user, channel=(None if is_priv else channel),
-                   message=message, type=ext.MSG_ACTION)
+        self._notify(events.Message, None if is_priv else channel,
+                     user, message, ext.MSG_ACTION)
 
     def noticed(self, user, channel, message):
         ''' Method called upon recieving notice message (either channel or private). '''
@@ -292,51 +417,69 @@ class Bot(IRCClient):
 
         logging.debug("[NOTICE] <%s/%s> %s", user,
                       channel if not is_priv else '__priv__', message)
-        ext.notify(self, 'message',
-                   user=user, channel=(channel if not is_priv else None),
-                   message=message, type=ext.MSG_NOTICE)
+        self._notify(events.Message, None if is_priv else channel,
+                     user, message, ext.MSG_NOTICE)
 
     def modeChanged(self, user, channel, set, modes, args):
         ''' Method called when user changes mode(s) for a channel. '''
         logging.debug("[MODE] %s sets %s%s %s for %s",
                       user, "+" if set else "-", modes, args, channel)
-        ext.notify(self, 'mode',
-                   user=user, channel=channel, set=set, modes=modes, args=args)
+        if channel in self.roster:
+            prefix_modes = self.supported.getFeature('PREFIX', {})
+            for mode, arg in zip(modes, args):
+                if mode in prefix_modes and arg:
+                    self.roster.set_mode(channel, arg, mode, set)
+        self._notify(events.Mode, channel, user, set, modes, args)
 
     def topicUpdated(self, user, channel, newTopic):
         ''' Method called when topic of channel changes or upon joining the channel. '''
         logging.debug("[TOPIC] <%s/%s> %s", user, channel, newTopic)
-        ext.notify(self, 'topic', channel=channel, topic=newTopic, user=user)
+        self._notify(events.Topic, channel, newTopic, user)
 
     def joined(self, channel):
         ''' Method called when bot has joined a channel. '''
         self.channels.add(channel)
+        self.roster.add_channel(channel)
+        self.sendLine("WHO %s" % channel)  # for hostmasks of users
         logging.debug("[JOIN] %s to %s", self.nickname, channel)
-        ext.notify(self, 'join', channel=channel, user=self.nickname)
+        self._notify(events.Join, channel, self.nickname)
 
     def userJoined(self, user, channel):
         ''' Method called when other user has joined a channel. '''
         logging.debug("[JOIN] %s to %s", user, channel)
-        ext.notify(self, 'join', channel=channel, user=user)
+        self.roster.add(channel, user, hostmask=self._hostmask)
+
+        split = self._split_users.get(user)
+        if split and split[1] > reactor.seconds():
+            key = (split[0], channel)
+            batch = self._netjoins.get(key)
+            if batch is None:
+                batch = self._netjoins[key] = EventBatch(
+                    functools.partial(self._end_netjoin, key))
+            batch.add(user, self._hostmask)
+            return
+        self._notify(events.Join, channel, user)
 
     def left(self, channel):
         ''' Method called when bot has left a channel. '''
-        self.channels.remove(channel)
+        self.channels.discard(channel)
+        self.roster.remove_channel(channel)
         logging.debug("[PART] %s from %s", self.nickname, channel)
-        ext.notify(self, 'part', user=self.nickname, channel=channel)
+        self._notify(events.Part, channel, self.nickname)
 
     def userLeft(self, user, channel):
         ''' Method called when other user has left a channel. '''
-        logging.debug("[PART] %s from %s", self.nickname, channel)
-        ext.notify(self, 'part', user=self.nickname, channel=channel)
+        logging.debug("[PART] %s from %s", user, channel)
+        self.roster.remove(channel, user)
+        self._notify(events.Part, channel, user)
 
     def kickedFrom(self, channel, kicker, message):
         ''' Method called when bot is kicked from a channel. '''
-        self.channels.remove(channel)
+        self.channels.discard(channel)
+        self.roster.remove_channel(channel)
         logging.debug("[KICK] %s from %s by %s (%s)",
                       self.nickname, channel, kicker, message)
-        ext.notify(self, 'kick', channel=channel,
-                   kicker=kicker, kickee=self.nickname, reason=message)
+        self._notify(events.Kick, channel, kicker, self.nickname, message)
         if config.rejoin_on_kick:
             self.join(channel)
 
@@ -344,26 +487,97 @@ class Bot(IRCClient):
         ''' Method called when other user is kicked from a channel. '''
         logging.debug("[KICK] %s from %s by %s (%s)",
                       kickee, channel, kicker, message)
-        ext.notify(self, 'kick', channel=channel,
-                   kicker=kicker, kickee=kickee, reason=message)
+        self.roster.remove(channel, kickee)
+        self._notify(events.Kick, channel, kicker, kickee, message)
 
     def nickChanged(self, nick):
         ''' Method called when bot's nick has changed. '''
         old = self.nickname
         self.nickname = nick
+        self.roster.rename(old, nick)
 
         logging.debug("[NICK] %s -> %s", old, nick)
-        ext.notify(self, 'nick', old=old, new=nick)
+        self._notify(events.Nick, old, nick)
 
     def userRenamed(self, oldname, newname):
         ''' Method called when other user has changed their nick. '''
         logging.debug("[NICK] %s -> %s", oldname, newname)
-        ext.notify(self, 'nick', old=oldname, new=newname)
+        self.roster.rename(oldname, newname)
+        self._notify(events.Nick, oldname, newname)
 
     def userQuit(self, user, message):
         ''' Method called when other user has disconnected from IRC. '''
         logging.debug("[QUIT] %s (%s)", user, message)
-        ext.notify(self, 'quit', user=user, message=message)
+        self.roster.remove_user(user)
+
+        if NETSPLIT_RE.match(message):
+            batch = self._netsplits.get(message)
+            if batch is None:
+                batch = self._netsplits[message] = EventBatch(
+                    functools.partial(self._end_netsplit, message))
+            batch.add(user, self._hostmask)
+            return
+        self._notify(events.Quit, user, message)
+
+    def _end_netsplit(self, servers):
+        ''' Notifies plugins about users who quit because of netsplit,
+        remembering them so that their return can be detected.
+        '''
+        batch = self._netsplits.pop(servers)
+        batch.cancel()
+        event = events.Netsplit(servers, tuple(batch.users),
+                                tuple(batch.hostmasks))
+        if len(event.users) < NETSPLIT_MIN_USERS:
+            self._notify_individually(event)
+            return
+
+        logging.info("[NETSPLIT] %s user(s) quit (%s)",
+                     len(event.users), servers)
+        now = reactor.seconds()
+        for nick, (_, until) in self._split_users.items():
+            if until <= now:
+                del self._split_users[nick]
+        for user in event.users:
+            self._split_users[user] = (servers, now + NETJOIN_TIMEOUT)
+        ext.notify(self, event)
+
+    def _end_netjoin(self, key):
+        ''' Notifies plugins about users who rejoined a channel
+        after netsplit.
+        '''
+        batch = self._netjoins.pop(key)
+        batch.cancel()
+        servers, channel = key
+        # The burst of joins is over, so later ones are ordinary again
+        for user in batch.users:
+            self._split_users.pop(user, None)
+
+        event = events.Netjoin(channel, servers, tuple(batch.users),
+                               tuple(batch.hostmasks))
+        if len(event.users) < NETSPLIT_MIN_USERS:
+            self._notify_individually(event)
+            return
+
+        logging.info("[NETJOIN] %s user(s) to %s (%s)",
+                     len(event.users), channel, servers)
+        ext.notify(self, event)
+
+    def _notify_individually(self, batch_event):
+        ''' Notifies plugins about events from a batch
+        which turned out to be too small to be considered as one.
+        '''
+        for event in batch_event.expand():
+            ext.notify(self, event)
+
+    def connectionLost(self, reason):
+        ''' Method called when connection to server has been lost. '''
+        for servers in self._netsplits.keys():
+            self._end_netsplit(servers)
+        for key in self._netjoins.keys():
+            self._end_netjoin(key)
+        self._split_users.clear()
+        self.scheduler.stop()  # plugins will be initialized again
+        IRCClient.connectionLost(self, reason)
 
 
 class BotFactory(ReconnectingClientFactory):
@@ -383,6 +597,9 @@ def run():
         else:
             logging.warning("Cannot resolve IPv6 host %s:%s", host, port)
 
+    if config.threaded_commands:
+        reactor.suggestThreadPoolSize(config.command_threads)
+
     reactor.connectTCP(host, port, BotFactory())
     reactor.run()
 
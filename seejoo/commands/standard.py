@@ -5,14 +5,17 @@ Created on 2010-12-05
 
 Standard useful commands, such as evaluation of expressions.
 '''
-from multiprocessing import Process, Pipe
-from seejoo.ext import command
+from twisted.internet import defer, reactor
+
+from seejoo.ext import command, reactor_safe, with_user
+from seejoo.util.irc import parse_hostmask
+from seejoo.util.workers import QueueFull, WorkerDied, WorkerPool
 import math, random
-import os
 import unicodedata
 
 
 @command('rot13')
+@reactor_safe
 def rot13(text):
     ''' Applies the ROT-13 transformation to given text,
     stripping it from all accent characters first.
@@ -28,22 +31,19 @@ def rot13(text):
 ###############################################################################
 # Evaluation of mathematical expressions
 
-# Sandbox process and pipe to communicate with it
-eval_pipe_parent = None ; eval_pipe_child = None
-eval_process = None
-
 # Forbidden functionality
 FORBIDDEN_GLOBALS = ['__package__', '__file__', '__name__', '__doc__']
 FORBIDDEN_BUILTINS = ['__import__', 'eval', 'execfile', 'compile', 'dir', 'open', 'exit', 'quit']
 
-# Worker function for the evaluations; runs in different process
-def _eval_worker(pipe):
+# Globals for evaluated expressions; set up in sandbox processes
+eval_globals = None
+
+def _init_eval_worker():
     '''
-    Pops the incoming expressions from given Pipe, evaluates
-    them and sends the back. Continues indefinitely.
+    Constructs a (relatively) safe dictionary of globals
+    to be used by evaluated expressions. Runs in sandbox process.
     '''
-    # Construct a (relatively) safe dictionary of globals
-    # to be used by evaluated expressions
+    global eval_globals
     g = {}
     g.update(math.__dict__)
     g.update(random.__dict__)
@@ -53,68 +53,76 @@ def _eval_worker(pipe):
             del g['__builtins__'][func]
     for func in FORBIDDEN_GLOBALS:
         if func in g:   del g[func]
-        
-    while True:
-        try:                exp = pipe.recv()
-        except EOFError:    return
-        
-        # Evaluate expression
-        try:
-            res = eval(exp, g)
-            res = "= " + str(res)
-        except SyntaxError:         res = "Syntax error."
-        except ValueError:          res = "Evaluation error."
-        except TypeError:           res = "Type mismatch."
-        except OverflowError:       res = "Overflow."
-        except FloatingPointError:  res = "Floating point exception."
-        except ZeroDivisionError:   res = "Division by zero."
-        except KeyError:            res = "Key not found."
-        except NameError:           res = "Unknown or forbidden function."
-        except MemoryError:         res = "Out of memory."
-        except KeyboardInterrupt:   exit(1)  # Timeout
-        except Exception:           res = "Error."
-
-        # Check whether the result isn't obscenely big
-        try:
-            if res and len(res) > 1024:
-                res = "Too long result."
-        except TypeError, AttributeError: pass
-        
-        # Push the result via pipe
-        pipe.send(res)
-        
+    eval_globals = g
+
+# Worker function for the evaluations; runs in sandbox process
+def _evaluate(exp):
+    '''
+    Evaluates the expression and returns the result
+    (or error message) as string.
+    '''
+    try:
+        res = eval(exp, eval_globals)
+        res = "= " + str(res)
+    except SyntaxError:         res = "Syntax error."
+    except ValueError:          res = "Evaluation error."
+    except TypeError:           res = "Type mismatch."
+    except OverflowError:       res = "Overflow."
+    except FloatingPointError:  res = "Floating point exception."
+    except ZeroDivisionError:   res = "Division by zero."
+    except KeyError:            res = "Key not found."
+    except NameError:           res = "Unknown or forbidden function."
+    except MemoryError:         res = "Out of memory."
+    except Exception:           res = "Error."
+
+    # Check whether the result isn't obscenely big
+    try:
+        if res and len(res) > 1024:
+            res = "Too long result."
+    except TypeError, AttributeError: pass
+
+    return res
+
 
 # Timeout for evaluation in seconds
 EVAL_TIMEOUT = 5
+# Number of sandbox processes, and memory each of them can allocate
+EVAL_WORKERS = 2
+EVAL_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# Pool of sandbox processes, started along with the reactor
+eval_pool = WorkerPool(_evaluate, size=EVAL_WORKERS, timeout=EVAL_TIMEOUT,
+                       cpu_limit=EVAL_TIMEOUT, memory_limit=EVAL_MEMORY_LIMIT,
+                       initializer=_init_eval_worker, name="seejoo_eval")
+reactor.callWhenRunning(eval_pool.start)
+reactor.addSystemEventTrigger('before', 'shutdown', eval_pool.stop)
 
-@command('c') 
-def evaluate_expression(exp):
+
+@command('c')
+@reactor_safe  # talks to sandbox processes asynchronously
+@with_user
+def evaluate_expression(exp, user=None):
     '''
     Evaluates given expression.
-    '''    
+    '''
     if not exp:
         return "No expression supplied."
-    exp = str(exp)
-    
-    # Setup evaluation process if it's not present
-    global eval_process, eval_pipe_parent, eval_pipe_child
-    if not eval_process:
-        eval_pipe_parent, eval_pipe_child = Pipe()
-        eval_process = Process(name = "seejoo_eval",
-                               target = _eval_worker,
-                               args = (eval_pipe_child,))
-        eval_process.daemon = True
-        eval_process.start()
-    
-    # Push expression through the pipe and wait for result
-    eval_pipe_parent.send(exp)
-    if eval_pipe_parent.poll(EVAL_TIMEOUT):
-        res = str(eval_pipe_parent.recv())
-        res = filter(lambda x: ord(x) >= 32, res)   # Sanitize result
-        return res        
-
-    # Evaluation timed out; kill the process and return error
-    os.kill(eval_process.pid, 9)
-    os.waitpid(eval_process.pid, os.WUNTRACED)
-    eval_process = None
-    return "Operation timed out."
+
+    # Expressions from every host wait for their turn,
+    # so that nobody can keep all the sandbox processes busy
+    hostmask = parse_hostmask(user)
+    key = (hostmask.host or hostmask.nick) if hostmask else user
+
+    def sanitize(res):
+        return filter(lambda x: ord(x) >= 32, str(res))
+
+    def handle_error(failure):
+        if failure.check(QueueFull):
+            return "Too many expressions waiting, try again later."
+        # Exceeding the CPU time limit gets the sandbox process killed
+        failure.trap(defer.TimeoutError, WorkerDied)
+        return "Operation timed out."
+
+    d = eval_pool.submit(str(exp), key)
+    d.addCallbacks(sanitize, handle_error)
+    return d
@@ -10,24 +10,31 @@ import re
 import urllib2
 from xml.etree import ElementTree
 
-from seejoo.ext import command
-from seejoo.util.common import download
+from twisted.internet import defer
+
+from seejoo.ext import cacheable, command, reactor_safe, uncached
+from seejoo.util.http import fetch
 from seejoo.util.strings import strip_html
 
 
 MAX_QUERY_RESULTS = 3
 
+SEARCH_CACHE_TTL = 15 * 60  # seconds
+DEFINITION_CACHE_TTL = 60 * 60  # seconds
+
 
 # General commands
 
 @command('rss')
+@reactor_safe
+@defer.inlineCallbacks
 def get_recent_rss_items(url):
     '''
     Retrieves the few most recent items from the given RSS feed.
     '''
-    rss = download(url)
+    rss = yield fetch(url)
     if not rss:
-        return "Could not retrieve RSS feed."
+        defer.returnValue("Could not retrieve RSS feed.")
     rss_xml = ElementTree.ElementTree(ElementTree.fromstring(rss))
 
     title = rss_xml._root.find('channel/title').text
@@ -36,18 +43,19 @@ def get_recent_rss_items(url):
 
     res = title + " :: "
     res += " | ".join(items)
-    return res
+    defer.returnValue(res)
 
 
 # Google commands
 
+@defer.inlineCallbacks
 def _google_websearch(query):
     '''
     Performs a query to Google Web Search API and returns resulting JSON object.
     '''
     url = "https://ajax.googleapis.com/ajax/services/search/web?v=1.0&q=%s" % urllib2.quote(query)
-    response = download(url)
-    return json.loads(response)
+    response = yield fetch(url)
+    defer.returnValue(json.loads(response))
 
 
 def _get_google_websearch_result_count(json_resp):
@@ -67,14 +75,17 @@ def _get_google_websearch_result_count(json_resp):
 
 
 @command('g')
+@cacheable(SEARCH_CACHE_TTL)
+@reactor_safe
+@defer.inlineCallbacks
 def google_search(query):
     '''
     Performs a search using Google search engine.
     @warning: Uses deprecated Google Web Search API that has limitations to 100 queries per day.
     '''
     if not query or len(str(query).strip()) == 0:
-        return "No query supplied."
-    json_resp = _google_websearch(query)
+        defer.returnValue("No query supplied.")
+    json_resp = yield _google_websearch(query)
 
     # Parse the response and return first few results
     results = json_resp['responseData']['results'][:MAX_QUERY_RESULTS]
@@ -87,36 +98,41 @@ def google_search(query):
     if result_count > MAX_QUERY_RESULTS:
         res += " (and about %s more)" % (result_count - MAX_QUERY_RESULTS)
 
-    return res
+    defer.returnValue(res)
 
 
 @command('gc')
+@cacheable(SEARCH_CACHE_TTL)
+@reactor_safe
+@defer.inlineCallbacks
 def google_search_count(query):
     '''
     Performs a search using Google search engine
     and returns only the estimated number of results.
     '''
     if not query or len(str(query).strip()) == 0:
-        return "No queries provided."
-    json_resp = _google_websearch(query)
+        defer.returnValue("No queries provided.")
+    json_resp = yield _google_websearch(query)
     result_count = _get_google_websearch_result_count(json_resp)
-    return "`%s`: about %s results" % (query, result_count)
+    defer.returnValue("`%s`: about %s results" % (query, result_count))
 
 
 @command('gf')
+@reactor_safe
+@defer.inlineCallbacks
 def googlefight(queries):
     '''
     Performs a Googlefight, querying each term and displaying results.
     Queries shall be separated with semicolon.
     '''
     if not queries or len(str(queries).strip()) == 0:
-        return "No queries provided."
+        defer.returnValue("No queries provided.")
     queries = map(str.strip, queries.split(";"))
 
-    # Query for each term
+    # Query for all terms at once
+    json_resps = yield defer.gatherResults(map(_google_websearch, queries))
     results = []
-    for query in queries:
-        json_resp = _google_websearch(query)
+    for query, json_resp in zip(queries, json_resps):
         count = _get_google_websearch_result_count(json_resp)
         results.append((query, count or 0))
 
@@ -125,7 +141,7 @@ def googlefight(queries):
     results_str = ("%i. %s (%s)" % (place, r[0], r[1])
                    for place, r in enumerate(results, 1))
 
-    return " ".join(results_str)
+    defer.returnValue(" ".join(results_str))
 
 
 
@@ -145,14 +161,15 @@ def get_wikipage_api_url(title, lang='en', format='json'):
     return url % (lang, format, urllib2.quote(title))
 
 
+@defer.inlineCallbacks
 def get_wikipage_content(title):
     '''
     Returns raw markup of given Wikipedia page using API call.
     '''
     url = get_wikipage_api_url(title)
-    resp = download(url)
+    resp = yield fetch(url)
     if not resp:
-        return None
+        defer.returnValue(None)
 
     resp = json.loads(resp)
     try:
@@ -160,9 +177,9 @@ def get_wikipage_content(title):
         page = pages.values()[0]
         content = page['revisions'][0].values()[0]
     except (KeyError, AttributeError):
-        return None
+        defer.returnValue(None)
 
-    return content
+    defer.returnValue(content)
 
 
 WIKI_HTML_TAGS = re.compile(
@@ -221,30 +238,34 @@ def get_definition_from_wiki(wiki, chars):
 
 
 @command('w')
+@cacheable(DEFINITION_CACHE_TTL)
+@reactor_safe
+@defer.inlineCallbacks
 def wikipedia_definition(term):
     '''
     Looks up given term in English Wikipedia and returns the beginning
     of its definition.
     '''
     if not term or len(str(term).strip()) == 0:
-        return "No term supplied."
+        defer.returnValue("No term supplied.")
 
-    page = get_wikipage_content(term)
+    page = yield get_wikipage_content(term)
     if not page:
-        return "Could not find the term in Wikipedia."
+        defer.returnValue(uncached("Could not find the term in Wikipedia."))
 
     wiki_def = get_definition_from_wiki(page, 200)
     if not wiki_def:
-        return "Could found the definition in Wikipedia."
+        defer.returnValue("Could found the definition in Wikipedia.")
 
     # Handle Wikipedia redirects
     if wiki_def.startswith("#REDIRECT"):
         first_line = wiki_def[:wiki_def.find('\n')]
         _, target = first_line.split(None, 1)
-        return wikipedia_definition(target)
+        definition = yield wikipedia_definition(target)
+        defer.returnValue(definition)
 
     wiki_url = "http://en.wikipedia.org/wiki/" + urllib2.quote(term)
-    return "%s -- from: %s" % (wiki_def, wiki_url)
+    defer.returnValue("%s -- from: %s" % (wiki_def, wiki_url))
 
 
 # Dictionaries
@@ -274,18 +295,22 @@ def find_first_sentences(html, s=1):
 
 
 @command('ud')
+@cacheable(DEFINITION_CACHE_TTL)
+@reactor_safe
+@defer.inlineCallbacks
 def urban_dictionary(term):
     '''
     Looks up given term in urbandictionary.com. Returns the first sentence
     of definition.
     '''
     if not term or len(str(term).strip()) == 0:
-        return "No term supplied."
+        defer.returnValue("No term supplied.")
 
-    ud_site = download("http://www.urbandictionary.com/define.php?term=%s" %
-                       urllib2.quote(term))
+    ud_site = yield fetch("http://www.urbandictionary.com/define.php?term=%s" %
+                          urllib2.quote(term))
     if not ud_site:
-        return "Could not retrieve definition of '%s'." % term
+        defer.returnValue(uncached(
+            "Could not retrieve definition of '%s'." % term))
 
     # Look for definition
     m = UD_DEF_DIV.search(ud_site)
@@ -293,6 +318,6 @@ def urban_dictionary(term):
         definition = strip_html(m.groupdict().get('def'))
         definition = find_first_sentences(definition, 5)
         if len(definition.strip()) > 0:
-            return "'%s': %s" % (term, definition)
+            defer.returnValue("'%s': %s" % (term, definition))
 
-    return "Could not find definition of '%s'." % term
+    defer.returnValue("Could not find definition of '%s'." % term)
@@ -37,6 +37,8 @@ class Config(object):
         self.rejoin_on_kick = False
 
         self.cmd_prefix = '.'
+        self.threaded_commands = False
+        self.command_threads = 10
         self.plugins = {}
 
     def load_from_file(self, filename):
@@ -103,6 +105,9 @@ class Config(object):
         self.rejoin_on_kick = cfg.get("rejoin_on_kick", self.rejoin_on_kick)
 
         self.cmd_prefix = cfg.get("command_prefix", self.cmd_prefix)
+        self.threaded_commands = cfg.get("threaded_commands",
+                                         self.threaded_commands)
+        self.command_threads = cfg.get("command_threads", self.command_threads)
         self.plugins = self.load_plugins(cfg)
 
     def load_plugins(self, cfg):
@@ -0,0 +1,92 @@
+'''
+Classes of events that plugins are notified about.
+
+Event objects are lightweight, immutable tuples. Each one is created once
+for an IRC event and then shared by all plugins which are notified about it.
+Their fields correspond to arguments of respective methods
+of ``seejoo.ext.Plugin`` (and are in the same order),
+followed by the optional 'hostmask' of user who caused the event.
+
+Batch events (such as 'netsplit') stand for many events of other kind
+that happened at once. Plugins which aren't interested in them
+are notified about the individual events instead.
+'''
+from collections import namedtuple
+
+
+class Event(object):
+    ''' Base class for event objects. '''
+    __slots__ = ()
+
+    #: Name of the event, such as 'message'
+    name = None
+
+    def as_dict(self):
+        ''' Returns the fields of event as dictionary. '''
+        return dict(zip(self._fields, self))
+
+
+class BatchEvent(Event):
+    ''' Base class for events which stand for many individual events. '''
+    __slots__ = ()
+
+    #: Name of the individual events, such as 'quit'
+    expands_to = None
+
+    def expand(self):
+        ''' Returns the list of individual events that this one stands for. '''
+        raise NotImplementedError()
+
+
+def _event_class(name, fields, base_class=Event):
+    ''' Creates a class of events with given name and fields. '''
+    fields = fields.split() + ['hostmask']
+    base = namedtuple(name.capitalize(), fields)
+    cls = type(base.__name__, (base_class, base),
+               {'__slots__': (), 'name': name})
+    cls.__new__.__defaults__ = (None,)  # for hostmask
+    return cls
+
+
+Init = _event_class('init', 'config')
+Connect = _event_class('connect', 'host')
+Join = _event_class('join', 'channel user')
+Part = _event_class('part', 'channel user')
+Kick = _event_class('kick', 'channel kicker kickee reason')
+Quit = _event_class('quit', 'user message')
+Message = _event_class('message', 'channel user message type')
+Nick = _event_class('nick', 'old new')
+Mode = _event_class('mode', 'channel user set modes args')
+Topic = _event_class('topic', 'channel topic user')
+Command = _event_class('command', 'channel user cmd args')
+Tick = _event_class('tick', '')
+
+
+class Netsplit(_event_class('netsplit', 'servers users hostmasks',
+                            BatchEvent)):
+    ''' Users quitting IRC because the servers (given as "server1 server2",
+    like in the quit message) have split.
+    '''
+    __slots__ = ()
+    expands_to = 'quit'
+
+    def expand(self):
+        return [Quit(user, self.servers, hostmask=hostmask)
+                for user, hostmask in zip(self.users, self.hostmasks)]
+
+
+class Netjoin(_event_class('netjoin', 'channel servers users hostmasks',
+                           BatchEvent)):
+    ''' Users rejoining a channel after the servers have reconnected. '''
+    __slots__ = ()
+    expands_to = 'join'
+
+    def expand(self):
+        return [Join(self.channel, user, hostmask=hostmask)
+                for user, hostmask in zip(self.users, self.hostmasks)]
+
+
+#: Event classes by their names
+EVENT_CLASSES = dict((cls.name, cls) for cls in (
+    Init, Connect, Join, Part, Kick, Quit, Message, Nick, Mode, Topic,
+    Command, Tick, Netsplit, Netjoin))
@@ -8,18 +8,52 @@ to register them. Shall be used by external modules to add extensions to seejoo.
 '''
 import collections
 import functools
+import inspect
 import logging
 import os
 import types
 
+from twisted.internet import defer, reactor, threads
+
 from seejoo.config import config
+from seejoo.events import BatchEvent, Event, EVENT_CLASSES
+from seejoo.util.bk_tree import BKTree
+from seejoo.util.cache import LRUCache, SingleFlight
+from seejoo.util.kvstore import KeyValueStore
 from seejoo.util.prefix_tree import PrefixTree
+from seejoo.util.strings import normalize_whitespace
 
 
 BOT_COMMANDS = {'help': 'Displays help about particular command'}
+MAX_SUGGESTION_DISTANCE = 2
+
+# Arguments passed with events which plugins' methods may not accept
+OPTIONAL_EVENT_ARGS = ('hostmask',)
+
+# Names of events that plugins can be notified about
+EVENTS = ('init', 'connect', 'join', 'part', 'kick', 'quit', 'message',
+          'nick', 'mode', 'topic', 'command', 'tick', 'netsplit', 'netjoin')
+
+# Events which stand for many individual ones (e.g. quits during netsplit);
+# plugins have to explicitly subscribe to them
+BATCH_EVENTS = frozenset(name for name, cls in EVENT_CLASSES.iteritems()
+                         if issubclass(cls, BatchEvent))
 
 _commands = PrefixTree()
+_command_names = BKTree()  # for suggesting commands when misspelled
 _plugins = []
+_subscribers = {}  # event name -> list of (plugin, handler) pairs
+_batch_fallbacks = {}  # batch event name -> handlers of individual events
+
+# Routing of the 'command' event: plugins which declare their commands
+# are indexed by command name, while those that don't are catch-all listeners
+_command_routes = {}  # command name -> list of (plugin, handler) pairs
+_command_listeners = []
+
+# Cache for results of commands which have been marked as cacheable
+COMMAND_CACHE_SIZE = 512
+_command_cache = LRUCache(COMMAND_CACHE_SIZE)
+_command_flights = SingleFlight()  # pending calls of cacheable commands
 
 
 def _get_command_doc(cmd_name):
@@ -73,6 +107,7 @@ def register_command(name, cmd_object):
         return
 
     _commands.add(name, cmd_object)
+    _command_names.add(name)
     return cmd_object
 
 
@@ -87,6 +122,199 @@ def get_command(cmd):
     return _commands.get(cmd)
 
 
+def suggest_commands(name):
+    ''' Suggests commands whose names are similar to given one,
+    e.g. because it's a misspelling of one of them.
+
+    The number of typos allowed grows with the length of name,
+    up to MAX_SUGGESTION_DISTANCE.
+
+    @return: List of command names, most similar first
+    '''
+    max_distance = min(MAX_SUGGESTION_DISTANCE, len(name) // 2)
+    if max_distance == 0:
+        return []
+    return [cmd for _, cmd in _command_names.search(name, max_distance)]
+
+
+def reactor_safe(obj):
+    ''' Decorator which marks a command, plugin or plugin's method
+    as safe to be invoked directly in the reactor thread.
+
+    When bot is configured to run commands in a thread pool,
+    such commands will bypass it. This should be used for commands
+    that are quick, don't do any blocking I/O, or modify some state
+    that is not thread-safe, as well as those which are asynchronous
+    (return Deferreds).
+    '''
+    obj.reactor_safe = True
+    return obj
+
+
+def is_reactor_safe(obj):
+    ''' Checks whether given command, plugin or plugin's method
+    has been marked as safe to be invoked in the reactor thread.
+    Generator functions (i.e. asynchronous handlers) are always considered
+    to be safe.
+    '''
+    if getattr(obj, 'reactor_safe', False):
+        return True
+    if inspect.isgeneratorfunction(obj):
+        return True
+
+    plugin = getattr(obj, 'im_self', None)  # method of Plugin object
+    return getattr(plugin, 'reactor_safe', False)
+
+
+def with_user(obj):
+    ''' Decorator which marks a command as wanting to know who has issued it.
+    Such command will receive the user (nick!id@host) as 'user' keyword
+    argument, in addition to command's invocation parameters.
+    '''
+    obj.with_user = True
+    return obj
+
+
+def wants_user(obj):
+    ''' Checks whether given command object has been marked
+    as receiving the user who has issued it.
+    '''
+    return getattr(obj, 'with_user', False)
+
+
+def call_command(handler, *args, **kwargs):
+    ''' Calls a command handler: either a command object
+    or plugin's handler of the 'command' event.
+
+    If bot is configured to run commands in threads, the handler is called
+    in reactor's thread pool, unless it has been marked as reactor-safe.
+
+    Handler can return its result directly, or asynchronously: as a Deferred
+    or a generator (treated as if it was decorated with inlineCallbacks).
+    @return: Deferred with the result of handler
+    '''
+    if config.threaded_commands and not is_reactor_safe(handler):
+        d = threads.deferToThread(handler, *args, **kwargs)
+    else:
+        d = defer.maybeDeferred(handler, *args, **kwargs)
+    d.addCallback(_resolve_result)
+    return d
+
+
+def cacheable(ttl):
+    ''' Decorator which marks a command, plugin or plugin's method
+    as cacheable, i.e. returning the same results for the same arguments
+    for a while. Those results will then be reused for given number of seconds.
+
+    For plugins handling more than one command, the time can also be
+    a dictionary mapping command names to their cache times.
+    '''
+    def decorator(obj):
+        obj.cache_ttl = ttl
+        return obj
+    return decorator
+
+
+class _Uncached(object):
+    ''' Result of a cacheable handler which shall not be cached. '''
+    __slots__ = ('result',)
+
+    def __init__(self, result):
+        self.result = result
+
+
+def uncached(result):
+    ''' Wraps the result of cacheable command or plugin's handler,
+    so that it's returned as usual, but not stored in the cache.
+    This should be used for results of transient failures
+    (e.g. when some web service cannot be reached at the moment).
+    '''
+    return _Uncached(result)
+
+
+def get_cache_ttl(obj, cmd, resolve=True):
+    ''' Retrieves the time (in seconds) for which results of given command
+    (handled by given command object, plugin or plugin's method)
+    can be cached. Returns None if they shouldn't be.
+
+    :param resolve: Whether the per-command cache times shall be looked up.
+                    If False, the dictionary of them may be returned.
+    '''
+    ttl = getattr(obj, 'cache_ttl', None)
+    if ttl is None:
+        plugin = getattr(obj, 'im_self', None)  # method of Plugin object
+        ttl = getattr(plugin, 'cache_ttl', None)
+    if resolve and isinstance(ttl, collections.Mapping):
+        ttl = ttl.get(cmd)
+    return ttl
+
+
+def call_cached(handler, cache_key, refresh, *args, **kwargs):
+    ''' Calls a command handler, just like :func:`call_command`,
+    but reuses its cached result if the handler is cacheable.
+    Concurrent calls of cacheable handler with the same arguments
+    are also merged into one.
+
+    :param cache_key: Pair of command name and its arguments
+    :param refresh: Whether the cached result shall be bypassed
+                    (and replaced with the fresh one)
+    @return: Deferred with the result of handler
+    '''
+    cmd, cmd_args = cache_key
+    ttl = get_cache_ttl(handler, cmd)
+    if ttl is None:
+        d = call_command(handler, *args, **kwargs)
+        d.addCallback(_unwrap_uncached)
+        return d
+
+    owner = getattr(handler, 'plugin', None) or \
+        getattr(handler, 'im_self', handler)
+    key = (owner, cmd, normalize_whitespace(cmd_args or '').strip())
+    if not refresh:
+        result = _command_cache.get(key, _command_cache)
+        if result is not _command_cache:
+            logging.debug("Cached result of command '%s' (%s)", cmd,
+                          ", ".join("%s: %s" % item
+                                    for item in get_cache_stats().items()))
+            return defer.succeed(result)
+
+    def store_result(result):
+        if isinstance(result, _Uncached):
+            return result.result
+        _command_cache.put(key, result, ttl)
+        return result
+
+    def call():
+        d = call_command(handler, *args, **kwargs)
+        d.addCallback(store_result)
+        return d
+
+    return _command_flights.call(key, call)
+
+
+def _unwrap_uncached(result):
+    return result.result if isinstance(result, _Uncached) else result
+
+
+def get_cache_stats():
+    ''' Returns a dictionary with statistics of the command results' cache:
+    its size, numbers of hits and misses, as well as the number of calls
+    which were merged with identical ones in progress.
+    '''
+    stats = _command_cache.stats()
+    stats['merged'] = _command_flights.merged
+    return stats
+
+
+def _resolve_result(result):
+    ''' Turns an asynchronous result of command or plugin's handler
+    into a Deferred. Other results are returned unchanged.
+    '''
+    if inspect.isgenerator(result):
+        return defer.inlineCallbacks(lambda: result)()
+    return result
+
+
 # Plugins
 
 def register_plugin(plugin):
@@ -103,7 +331,16 @@ def register_plugin(plugin):
     and produced by bot instead of looking up a command and executing it.
 
     Plugins can also have a list of commands specified explicitly as their 'commands'
-    attribute. This way the bot can offer help for the commands upon request.
+    attribute. This way the bot can offer help for the commands upon request,
+    and only notify the plugin about commands it has declared. Plugins without
+    the 'commands' attribute are notified about every command.
+
+    Plugin is only notified about events it subscribes to. For instances
+    of :class:`Plugin`, those are the events whose methods it overrides.
+    Function plugins can list their events in an 'events' attribute;
+    if they don't, they will receive all of them except for batch events
+    (such as 'netsplit'). Plugins which don't subscribe to a batch event
+    receive the individual events (such as 'quit') that it stands for.
     @param plugin: Plugin object
     '''
     if not callable(plugin):
@@ -122,11 +359,151 @@ def register_plugin(plugin):
 
     global _plugins
     _plugins.append(plugin)
+    _rebuild_subscribers()
+
+
+def unregister_plugin(plugin):
+    ''' Unregisters a previously registered plugin,
+    so that it will no longer be notified about any events.
+    @return: Whether the plugin was registered before
+    '''
+    global _plugins
+    if plugin not in _plugins:
+        return False
+
+    _plugins.remove(plugin)
+    _rebuild_subscribers()
+    return True
+
+
+def get_plugin_events(plugin):
+    ''' Determines the set of events that given plugin subscribes to. '''
+    events = getattr(plugin, 'events', None)
+    if events is not None:
+        return frozenset(events)
+
+    # Plugin objects only care about events whose handlers they override,
+    # unless they take over the dispatch itself
+    if isinstance(plugin, Plugin) and not _overrides(plugin, '__call__'):
+        return frozenset(e for e in EVENTS if _overrides(plugin, e))
+    return frozenset(EVENTS) - BATCH_EVENTS
+
+
+def _overrides(plugin, name):
+    ''' Checks whether given Plugin object overrides a method of base class. '''
+    method = getattr(type(plugin), name, None)
+    return getattr(method, 'im_func', method) is not Plugin.__dict__[name]
+
+
+def _get_handler(plugin, event):
+    ''' Returns a callable which handles given event on behalf of a plugin.
+    It accepts the bot object and the event object.
+    '''
+    if isinstance(plugin, Plugin) and not _overrides(plugin, '__call__'):
+        return _get_method_handler(plugin, getattr(plugin, event),
+                                   EVENT_CLASSES[event])
+
+    if getattr(plugin, 'event_objects', False):
+        handler = lambda bot, e: plugin(bot, e)
+    else:
+        handler = lambda bot, e: plugin(bot, e.name, **e.as_dict())
+    return _as_handler_of(plugin, plugin, handler)
+
+
+def _get_method_handler(plugin, method, event_class):
+    ''' Returns a callable which invokes given method of Plugin object
+    with fields of event object as arguments. Optional fields
+    (from OPTIONAL_EVENT_ARGS) are omitted if method doesn't accept them.
+    '''
+    fields = event_class._fields
+    try:
+        spec = inspect.getargspec(method)
+    except TypeError:
+        spec = None
+
+    if spec is None or spec.keywords:
+        handler = lambda bot, e: method(bot, **e.as_dict())
+    else:
+        args = tuple(spec.args[2:])  # without self and bot
+        if args == fields:
+            handler = lambda bot, e: method(bot, *e)
+        elif args == fields[:len(args)] and all(
+                f in OPTIONAL_EVENT_ARGS for f in fields[len(args):]):
+            count = len(args)
+            handler = lambda bot, e: method(bot, *e[:count])
+        else:
+            # Arguments are named or ordered differently than the fields
+            args = [a for a in args if a in fields]
+            handler = lambda bot, e: method(
+                bot, **dict((a, getattr(e, a)) for a in args))
+    return _as_handler_of(plugin, method, handler)
+
+
+def _as_handler_of(plugin, obj, handler):
+    ''' Makes the handler function carry the attributes of object
+    (plugin or its method) that it calls on behalf of a plugin.
+    '''
+    handler.plugin = plugin
+    handler.reactor_safe = is_reactor_safe(obj)
+    handler.cache_ttl = get_cache_ttl(obj, None, resolve=False)
+    return handler
+
+
+def _rebuild_subscribers():
+    ''' Rebuilds the per-event lists of plugins' handlers,
+    as well as the routing index for commands.
+    '''
+    global _subscribers, _batch_fallbacks
+    global _command_routes, _command_listeners
+
+    subscribers = dict((event, []) for event in EVENTS)
+    for plugin in _plugins:
+        for event in get_plugin_events(plugin):
+            handler = _get_handler(plugin, event)
+            subscribers.setdefault(event, []).append((plugin, handler))
+
+    fallbacks = {}
+    for event in BATCH_EVENTS:
+        batched = [plugin for plugin, _ in subscribers[event]]
+        expands_to = EVENT_CLASSES[event].expands_to
+        fallbacks[event] = [(plugin, handler)
+                            for plugin, handler in subscribers[expands_to]
+                            if plugin not in batched]
+
+    routes = {}
+    listeners = []
+    for plugin, handler in subscribers['command']:
+        cmds = getattr(plugin, 'commands', None)
+        if cmds is None:
+            listeners.append((plugin, handler))
+            continue
+        for cmd in cmds:
+            routes.setdefault(str(cmd), []).append((plugin, handler))
+
+    _subscribers = subscribers
+    _batch_fallbacks = fallbacks
+    _command_routes = routes
+    _command_listeners = listeners
+
+
+def get_command_handlers(cmd):
+    ''' Retrieves handlers of plugins that should be notified
+    about given command being issued.
+
+    Those include plugins which declare the command in their 'commands'
+    attribute, followed by all plugins that listen to every command.
+    @return: List of (plugin, handler) pairs
+    '''
+    routes = _command_routes.get(cmd)
+    return routes + _command_listeners if routes else _command_listeners
 
 
 class Plugin(object):
     '''Base class that can be derived in by plugin objects.
     # It intercepts events and converts them to method calls.
+
+    Besides the arguments listed below, methods may accept 'hostmask':
+    the parsed hostmask (util.irc.Hostmask) of user who caused the event.
     '''
     def init(self, bot, config):
         pass
@@ -164,11 +541,19 @@ class Plugin(object):
     def tick(self, bot):
         pass
 
+    def netsplit(self, bot, servers, users, hostmasks):
+        pass
+
+    def netjoin(self, bot, channel, servers, users, hostmasks):
+        pass
+
     def __call__(self, bot, event, **kwargs):
         try:
-            return getattr(self, event)(bot, **kwargs)
+            method = getattr(self, event)
         except AttributeError:
-            pass  # Should not happen
+            return  # Should not happen
+        handler = _get_method_handler(self, method, EVENT_CLASSES[event])
+        return handler(bot, EVENT_CLASSES[event](**kwargs))
 
 
 def plugin(plugin):
@@ -184,32 +569,87 @@ def plugin(plugin):
     return plugin
 
 
-def notify(bot, event, **kwargs):
-    ''' Notifies all registered plugins about an IRC event. '''
+def notify(bot, event, nocache=False, **kwargs):
+    ''' Notifies plugins subscribed to an IRC event.
+
+    Plugins' handlers may return Deferreds or be written as generators
+    (in the inlineCallbacks fashion), in which case they are not waited for,
+    except for the 'command' event.
+
+    :param event: Event object (from seejoo.events),
+                  or name of the event with its fields as keyword arguments
+    :param nocache: For the 'command' event, whether cached results
+                    of plugins that are cacheable shall be bypassed
+
+    Fields from OPTIONAL_EVENT_ARGS (such as 'hostmask') are only passed
+    to methods of Plugin objects which accept them.
+    Batch events are expanded into individual ones for plugins
+    which don't subscribe to them.
+
+    @return: For the 'command' event, a Deferred with the list
+             of plugins' results, or None if they didn't produce any
+    '''
+    if not isinstance(event, Event):
+        event = EVENT_CLASSES[event](**kwargs)
+    if event.name == 'command':
+        return _notify_command(bot, event, nocache)
+
+    _dispatch(bot, event, _subscribers.get(event.name, ()))
+    if event.name in BATCH_EVENTS:
+        fallbacks = _batch_fallbacks.get(event.name)
+        if fallbacks:
+            for individual_event in event.expand():
+                _dispatch(bot, individual_event, fallbacks)
+
+
+def _dispatch(bot, event, handlers):
+    ''' Passes the event to given handlers of plugins. '''
     try:
-        if event == 'command':
-            def supports_command(plugin, command):
-                if not hasattr(plugin, 'commands'):
-                    return True
-                return command in plugin.commands
-
-            command = kwargs['cmd']
-
-            # Get command results, remove Nones
-            # and turn whole result to None if nothing remains
-            res = [plugin(bot, event, **kwargs)
-                   for plugin in _plugins
-                   if supports_command(plugin, command)]
-            res = filter(lambda x: x is not None, res)
-            return res or None
-        else:
-            for plugin in _plugins:
-                plugin(bot, event, **kwargs)
+        for _, handler in handlers:
+            res = handler(bot, event)
+            if res is not None:
+                res = _resolve_result(res)
+                if isinstance(res, defer.Deferred):
+                    res.addErrback(_log_notify_error)
     except Exception, e:
         logging.exception("Error while notifying plugins: %s - %s",
                           type(e).__name__, e)
 
 
+def _notify_command(bot, event, nocache=False):
+    ''' Notifies plugins about a command being issued.
+    @return: Deferred with the list of plugins' results, or None
+    '''
+    def collect_results(results):
+        # Get command results, remove Nones
+        # and turn whole result to None if nothing remains
+        res = []
+        for success, result in results:
+            if not success:
+                _log_notify_error(result)
+            elif result is not None:
+                res.append(result)
+        return res or None
+
+    handlers = get_command_handlers(event.cmd)
+    if not handlers:
+        return defer.succeed(None)
+
+    cache_key = (event.cmd, event.args)
+    d = defer.DeferredList([call_cached(handler, cache_key, nocache,
+                                        bot, event)
+                            for _, handler in handlers],
+                           consumeErrors=True)
+    d.addCallback(collect_results)
+    return d
+
+
+def _log_notify_error(failure):
+    logging.error("Error while notifying plugins: %s - %s\n%s",
+                  failure.type.__name__, failure.value,
+                  failure.getTraceback())
+
+
 # Flags used by seejoo when notifying plugins
 MSG_SAY = "say"
 MSG_ACTION = "action"
@@ -218,6 +658,24 @@ MSG_NOTICE = "notice"
 
 # API available for plugins
 
+DATA_DIR = "~/.seejoo/data"
+STORAGE_FILE = "storage.db"
+
+_storage = None
+
+
+def _get_plugin_name(plugin):
+    ''' Retrieves the fully qualified name of plugin's function or class. '''
+    try:
+        if isinstance(plugin, types.FunctionType):
+            name = plugin.__name__
+        else:
+            name = plugin.__class__.__name__
+        return plugin.__module__ + '.' + name
+    except AttributeError:
+        return None
+
+
 def get_storage_dir(plugin):
     '''
     Retrieves a path to a directory which can be used for storing
@@ -226,18 +684,10 @@ def get_storage_dir(plugin):
     if not plugin:
         return None
 
-    data_dir = os.path.expanduser("~/.seejoo/data/plugins")
+    data_dir = os.path.join(os.path.expanduser(DATA_DIR), "plugins")
 
     # Form the name of directory
-    name = None
-    try:
-        if isinstance(plugin, types.FunctionType):
-            name = plugin.__name__
-        else:
-            name = plugin.__class__.__name__
-        name = plugin.__module__ + '.' + name
-    except AttributeError:
-        pass
+    name = _get_plugin_name(plugin)
     if not name:
         return None
 
@@ -247,3 +697,27 @@ def get_storage_dir(plugin):
         os.makedirs(plugin_dir)
 
     return plugin_dir
+
+
+def get_storage(plugin):
+    '''
+    Retrieves the part of bot's key-value store (seejoo.util.kvstore)
+    where given plugin can keep its data. Values must be serializable
+    to JSON.
+
+    The store is shared by all plugins, each having its own namespace.
+    Writes can be grouped using the transaction() context manager.
+    '''
+    name = _get_plugin_name(plugin)
+    if not name:
+        return None
+
+    global _storage
+    if _storage is None:
+        data_dir = os.path.expanduser(DATA_DIR)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        _storage = KeyValueStore(os.path.join(data_dir, STORAGE_FILE))
+        reactor.addSystemEventTrigger('after', 'shutdown', _storage.close)
+
+    return _storage.namespace(name)
@@ -6,14 +6,15 @@ Created on Jan 7, 2012
 import json
 from urllib import urlencode
 
-from seejoo.ext import plugin, Plugin
-from seejoo.util.common import download
+from seejoo.ext import plugin, Plugin, reactor_safe
+from seejoo.util.http import fetch
 
 
 JOKES_URL = 'http://api.icndb.com/jokes/random'
 
 
 @plugin
+@reactor_safe
 class Chuck(Plugin):
     commands = {
         'j': 'Says facts about Chuck Norris.'
@@ -28,7 +29,11 @@ class Chuck(Plugin):
                 url_params['lastName'] = names[1]
             url += '?' +  urlencode(url_params)
 
-        jsonData = download(url)
+        d = fetch(url)
+        d.addCallback(self._format_joke)
+        return d
+
+    def _format_joke(self, jsonData):
         if not jsonData:
             return "Jokes not available at the moment."
 
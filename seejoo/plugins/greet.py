@@ -7,13 +7,15 @@ Greetings plugin. Allows users to specify personalized greetings
 and have them used by bot when they enter the channel.
 '''
 import json
-import os.path
+import os
 
-from seejoo.ext import Plugin, plugin, get_storage_dir
+from seejoo.ext import (Plugin, plugin, reactor_safe,
+                        get_storage, get_storage_dir)
 from seejoo.util import irc
 
 
 @plugin
+@reactor_safe
 class Greetings(Plugin):
     '''
     Greetings plugin class.
@@ -26,26 +28,24 @@ class Greetings(Plugin):
         '''
         Constructor.
         '''
-        self.greets = {}
+        self.greets = get_storage(self)
+        self._import_legacy_file()
 
-        # Load the greets
-        self.file = get_storage_dir(self) + 'greets.json'
-        self._load()
-
-    def _load(self):
+    def _import_legacy_file(self):
         '''
-        Loads the greetings from internal file.
+        Imports the greetings from file where they used to be kept.
         '''
-        if os.path.exists(self.file):
-            with open(self.file) as f:
-                self.greets = json.load(f)
+        legacy_file = get_storage_dir(self) + 'greets.json'
+        if not os.path.exists(legacy_file):
+            return
 
-    def _save(self):
-        '''
-        Saves the greetings to internal file.
-        '''
-        with open(self.file, 'w') as f:
-            json.dump(self.greets, f)
+        with open(legacy_file) as f:
+            greets = json.load(f)
+        with self.greets.transaction():
+            for nick, greet in greets.iteritems():
+                if greet:
+                    self.greets[nick] = greet
+        os.rename(legacy_file, legacy_file + '.imported')
 
     def join(self, bot, channel, user):
         '''
@@ -60,12 +60,20 @@ class Greetings(Plugin):
         greet = self.greets.get(nick)
         if greet:   irc.say(bot, channel, greet)
 
+    def netjoin(self, bot, channel, servers, users, hostmasks):
+        '''
+        Called when users rejoin a channel after netsplit.
+        They haven't really left, so they are not greeted.
+        '''
+
     def command(self, bot, channel, user, cmd, args):
         """Handles the .greet command."""
         # Remember the greeting
         nick = irc.get_nick(user)
-        self.greets[nick] = str(args) if args else None
-        self._save()
+        if args:
+            self.greets[nick] = str(args)
+        else:
+            self.greets.delete(nick)
 
         # Serve a response
         return "Greeting %s for user '%s'" % ('set' if args else 'reset', nick)
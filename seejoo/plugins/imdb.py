@@ -11,14 +11,16 @@ import json
 import urllib2
 import re
 
-from seejoo.util.common import download
-from seejoo.ext import plugin, Plugin
+from seejoo.util.http import fetch
+from seejoo.ext import cacheable, plugin, Plugin, reactor_safe, uncached
 
 
 API_URL = "http://www.omdbapi.com/"
 
 
 @plugin
+@cacheable(60 * 60)
+@reactor_safe
 class Imdb(Plugin):
     commands = {
         'im': ("Polls Open Movie Database for "
@@ -42,9 +44,13 @@ class Imdb(Plugin):
             year = ''
 
         url = API_URL + "?t=%s&y=%s" % (urllib2.quote(title), year)
-        json_data = download(url)
+        d = fetch(url)
+        d.addCallback(self._format_movie, bot, channel)
+        return d
+
+    def _format_movie(self, json_data, bot, channel):
         if not json_data:
-            return "IMDB not available at the moment."
+            return uncached("IMDB not available at the moment.")
 
         try:
             data = json.loads(json_data)
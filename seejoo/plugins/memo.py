@@ -10,15 +10,31 @@ from __future__ import unicode_literals
 from datetime import datetime
 import fnmatch
 import json
+import logging
 import os
+import re
 import time
 import urllib
 
-from seejoo.ext import Plugin, plugin, get_storage_dir
+from seejoo.ext import Plugin, plugin, reactor_safe, get_storage_dir
 from seejoo.util import irc
+from seejoo.util.journal import Journal
+
+
+JOURNAL_FILE = "memos.journal"
+
+#: Size of journal (in bytes) after which it will be compacted,
+#: unless it's still smaller than twice its size after last compaction
+COMPACTION_THRESHOLD = 64 * 1024
+
+
+def is_pattern(recipient):
+    """Checks whether recipient is a wildcard pattern rather than a nick."""
+    return any(c in recipient for c in "*?[")
 
 
 @plugin
+@reactor_safe
 class Memos(Plugin):
     """Memo plugin.
     Allows users to leave messages to be delivered to others.
@@ -31,55 +47,140 @@ class Memos(Plugin):
     def __init__(self):
         self.dir = get_storage_dir(self)
 
-    def _list_recipients(self):
-        """Lists recipients of the messages stored by the bot.
-        :return: A generator function yielding recipients
+        # Messages waiting for their recipients (nicks or wildcard patterns),
+        # persisted as journal of their storing and delivery
+        self.memos = {}
+        self.journal = Journal(os.path.join(self.dir, JOURNAL_FILE))
+        for record in self.journal.replay():
+            self._apply(record)
+        self._import_legacy_files()
+        self.compaction_threshold = max(COMPACTION_THRESHOLD,
+                                        2 * self.journal.size)
+
+        self.delivery_log = open(os.path.join(self.dir, "delivery.log"), 'a')
+
+        # Index of recipients who have messages waiting for them:
+        # exact nicks, and wildcard patterns matched by a single regex
+        self.nicks = set()
+        self.patterns = set()
+        self.patterns_re = None
+        for recipient in self.memos:
+            self._add_recipient(recipient)
+
+    def _add_recipient(self, recipient):
+        """Adds recipient to the index of those with waiting messages."""
+        if not is_pattern(recipient):
+            self.nicks.add(recipient)
+        elif recipient not in self.patterns:
+            self.patterns.add(recipient)
+            self._compile_patterns()
+
+    def _remove_recipients(self, recipients):
+        """Removes recipients from the index."""
+        self.nicks.difference_update(recipients)
+        if self.patterns.intersection(recipients):
+            self.patterns.difference_update(recipients)
+            self._compile_patterns()
+
+    def _compile_patterns(self):
+        """Compiles the wildcard patterns into a single regex."""
+        if not self.patterns:
+            self.patterns_re = None
+            return
+        self.patterns_re = re.compile("|".join(
+            "(?:%s)" % fnmatch.translate(p) for p in self.patterns))
+
+    def _find_recipients(self, nick):
+        """Finds recipients (nicks or patterns) which given nick matches."""
+        recipients = [nick] if nick in self.nicks else []
+        if self.patterns_re and self.patterns_re.match(nick):
+            recipients.extend(p for p in self.patterns
+                              if fnmatch.fnmatchcase(nick, p))
+        return recipients
+
+    # Persistence
+
+    def _apply(self, record):
+        """Applies a journal record to the messages kept in memory."""
+        if record['op'] == 'store':
+            item = dict((k, record[k]) for k in ('from', 'message', 'timestamp'))
+            self.memos.setdefault(record['to'], []).append(item)
+        elif record['op'] == 'deliver':
+            self.memos.pop(record['to'], None)
+
+    def _record(self, record):
+        """Appends a record to the journal and applies it."""
+        self.journal.append(record)
+        self._apply(record)
+
+        if self.journal.size > self.compaction_threshold \
+                and not self.journal.compacting:
+            self._compact()
+
+    def _compact(self):
+        """Compacts the journal in background, so that it only contains
+        the messages which are still waiting for delivery.
+        """
+        records = [dict(item, op='store', to=recipient)
+                   for recipient, items in self.memos.iteritems()
+                   for item in items]
+
+        def adjust_threshold(_):
+            self.compaction_threshold = max(COMPACTION_THRESHOLD,
+                                            2 * self.journal.size)
+            logging.debug("Compacted memo journal to %s bytes",
+                          self.journal.size)
+
+        def log_failure(failure):
+            logging.error("Could not compact memo journal: %s",
+                          failure.getErrorMessage())
+
+        d = self.journal.compact(records)
+        d.addCallbacks(adjust_threshold, log_failure)
+
+    def _import_legacy_files(self):
+        """Imports messages from files where they used to be kept
+        (one per recipient), removing them afterwards.
         """
         for filename in fnmatch.filter(os.listdir(self.dir), "*.json"):
             name, _ = os.path.splitext(filename)
-            yield urllib.unquote(name)
-
-    def _get_filename(self, recipient):
-        """Get file name for storing messages to given recipient."""
-        filename = urllib.quote(recipient, '')
-        return os.path.join(self.dir, filename + ".json")
+            path = os.path.join(self.dir, filename)
+            with open(path) as f:
+                items = json.load(f)
+            recipient = urllib.unquote(str(name)).decode('utf-8', 'replace')
+            for item in items:
+                record = dict(item, op='store', to=recipient)
+                self.journal.append(record)
+                self._apply(record)
+            os.unlink(path)
 
     def _store_message(self, sender, recipient, message):
         """Stores a message for to given recipient, sent by given sender."""
-        item = {
+        self._record({
+            'op': 'store',
+            'to': recipient,
             'from': sender,
             'message': message,
-            'timestamp': time.time()
-        }
-
-        # Read the current messages to this recipient
-        filename = self._get_filename(recipient)
-        if os.path.exists(filename):
-            with open(filename) as f:
-                items = json.load(f)
-        else:
-            items = []
+            'timestamp': time.time(),
+        })
 
-        # Add this one and save
-        items.append(item)
-        with open(filename, 'w') as f:
-            json.dump(items, f)
+    # Events
 
-    def message(self, bot, channel, user, message, type):
+    def message(self, bot, channel, user, message, type, hostmask=None):
         """Called when bot "hears" a message."""
         if not channel:
             return          # Only interested in channel messages
-        nick = irc.get_nick(user)
+        nick = hostmask.nick if hostmask else irc.get_nick(user)
 
         # Collect messages pertaining to this user
+        recipients = self._find_recipients(nick)
+        if not recipients:
+            return
         messages = []
-        files = []
-        for recp in self._list_recipients():
-            if fnmatch.fnmatch(nick, recp):
-                filename = self._get_filename(recp)
-                with open(filename) as f:
-                    messages.extend(json.load(f))
-                files.append(filename)
+        for recp in recipients:
+            messages.extend(self.memos.get(recp, ()))
+            self._record({'op': 'deliver', 'to': recp})
+        self._remove_recipients(recipients)
 
         # Format and send them
         msgs = []
@@ -92,15 +193,10 @@ class Memos(Plugin):
             msgs.append(msg)
         irc.say(bot, channel, msgs)
 
-        # Delete files
-        for file in files:
-            os.unlink(file)
-
         # Log delivery
-        log_file = os.path.join(self.dir, "delivery.log")
-        with open(log_file, 'a') as log:
-            log.writelines((m + os.linesep).encode('utf-8', 'ignore')
-                           for m in msgs)
+        self.delivery_log.writelines((m + os.linesep).encode('utf-8', 'ignore')
+                                     for m in msgs)
+        self.delivery_log.flush()
 
     def command(self, bot, channel, user, cmd, args):
         """Called when user issues the .msg command."""
@@ -112,7 +208,7 @@ class Memos(Plugin):
 
         # Get recipient and message from arguments
         try:
-            recipient, message = args.split(None, 1)
+            recipient, message = (args or "").split(None, 1)
         except ValueError:
             message = None
         if not message:
@@ -120,4 +216,5 @@ class Memos(Plugin):
 
         # Store it
         self._store_message(nick, recipient, message)
+        self._add_recipient(recipient)
         return "I will notify %s should they appear." % recipient
@@ -2,17 +2,49 @@
 Plugin for occasional polling of one or more RSS feeds.
 @author Karol Kuczmarski
 """
+from collections import OrderedDict
+import functools
 import re
 import logging
+import random
+import time
 from datetime import datetime, timedelta
+from email.utils import mktime_tz, parsedate_tz
+from io import BytesIO
 from itertools import takewhile
 
 from lxml import etree
 from dateutil.parser import parse as parse_date
 import pytz
+from twisted.internet import defer
 
-from seejoo.ext import plugin, Plugin
-from seejoo.util import irc
+from seejoo.ext import plugin, Plugin, get_storage, reactor_safe
+from seejoo.util import http, irc
+
+
+MIN_POLL_INTERVAL = 1.0  # seconds, e.g. if feed's frequency is invalid
+MAX_CONCURRENT_POLLS = 4
+
+# Fraction of feed's frequency that is randomly added to the time
+# of every poll, so that feeds aren't polled in lockstep
+POLL_JITTER = 0.1
+
+# Limit for intervals between polls of a feed that keeps failing,
+# which are doubled with every failure
+MAX_POLL_BACKOFF = 6 * 60 * 60  # seconds
+
+# Number of GUIDs of most recent items that are remembered for every feed,
+# so that items which appear out of order aren't announced again
+MAX_SEEN_ITEMS = 500
+
+# Parts of feed's state which are kept in storage, surviving restarts
+PERSISTENT_STATE = ('last_item', 'last_poll_time', 'etag', 'last_modified')
+
+EPOCH = datetime(1970, 1, 1)
+
+# Limits for digests of many new items, announced together
+DIGEST_LINE_LENGTH = 400
+DIGEST_MAX_LINES = 3
 
 
 @plugin
@@ -26,6 +58,7 @@ class Rss(Plugin):
         plugins:
         - module: seejoo.plugins.rss
           config:
+            max_concurrent_polls: 4  # default
             feeds:
             - name: Some webpage feed
               url: http://somewebpage.com/rss_feed
@@ -38,24 +71,44 @@ class Rss(Plugin):
               announce:
               - one_channel
               - other_channel
+              digest: 5  # summarize more than 5 new items in few lines
     """
+    commands = {
+        'feeds': ("Shows when RSS feeds will be polled next, how long their "
+                  "last fetch took and whether they fail, "
+                  "e.g.: #cmd# [feed]"),
+    }
+
     def __init__(self):
         self.feeds = {}
         self.state = None
-        self.next_poll = datetime.utcnow()  # will be in the past for the next tick()
+        self.polls = defer.DeferredSemaphore(MAX_CONCURRENT_POLLS)
+        self.storage = get_storage(self)
 
     def init(self, bot, config):
-        """ Remembers configuration of the plugin. """
+        """ Remembers configuration of the plugin
+        and schedules polling of the feeds.
+        """
         self.bot = bot
 
         feeds = config.get('feeds') if config else None
         if feeds:
-            feeds = dict((f['name'], f) for f in feeds if 'name' in f)
+            # configuration is processed again on every reconnect,
+            # so it mustn't be modified in place
+            feeds = dict((f['name'], dict(f)) for f in feeds if 'name' in f)
             for f in feeds.itervalues():
                 self._process_feed_config(f)
 
         self.feeds = feeds or {}
-        self.state = dict((feed, {}) for feed in self.feeds.iterkeys())
+        self.state = dict((feed, self._load_state(feed))
+                          for feed in self.feeds.iterkeys())
+
+        max_polls = config.get('max_concurrent_polls') if config else None
+        self.polls = defer.DeferredSemaphore(
+            max_polls or MAX_CONCURRENT_POLLS)
+
+        for name, state in self.state.iteritems():
+            self._schedule_poll(name, state, 0)
 
     def _process_feed_config(self, f):
         """ Does a processing on feed configuration, preparing it
@@ -76,43 +129,136 @@ class Rss(Plugin):
             f['announce'] = [chan if chan.startswith('#') else '#' + chan
                              for chan in announce]
 
-    def tick(self, bot):
-        """ Called every second. Checks the feeds for new items. """
-        if not self.state:
+    def _load_state(self, name):
+        """ Retrieves the state of a feed from storage. """
+        state = self.storage.get('state:' + name) or {}
+        if state.get('last_poll_time') is not None:
+            state['last_poll_time'] = datetime.utcfromtimestamp(
+                state['last_poll_time'])
+        state['seen'] = OrderedDict.fromkeys(
+            self.storage.get('seen:' + name, ()))
+        return state
+
+    def _save_state(self, name, state, seen=False):
+        """ Writes the state of a feed to storage.
+        :param seen: Whether the GUIDs of seen items shall be written, too
+        """
+        persistent = dict((key, state.get(key)) for key in PERSISTENT_STATE)
+        if persistent['last_poll_time'] is not None:
+            persistent['last_poll_time'] = (
+                persistent['last_poll_time'] - EPOCH).total_seconds()
+
+        with self.storage.transaction():
+            self.storage['state:' + name] = persistent
+            if seen:
+                self.storage['seen:' + name] = list(state['seen'])
+
+    def get_stats(self):
+        """ Returns a dictionary with statistics of polling every feed:
+        time of its next poll (in UTC), duration of the last fetch
+        (in seconds) and the number of failed polls in a row.
+        """
+        return dict((name, {
+            'next_poll': state.get('next_poll'),
+            'last_fetch_duration': state.get('last_fetch_duration'),
+            'failures': state.get('failures', 0),
+        }) for name, state in (self.state or {}).iteritems())
+
+    @reactor_safe
+    def command(self, bot, channel, user, cmd, args):
+        """ Called when user issues the .feeds command. """
+        stats = self.get_stats()
+        name = (args or '').strip()
+        if name:
+            if name not in stats:
+                return "Unknown feed '%s'." % name
+            stats = {name: stats[name]}
+        if not stats:
+            return "No feeds are being polled."
+        return " | ".join(format_feed_stats(name, stats[name])
+                          for name in sorted(stats))
+
+    def _schedule_poll(self, name, state, delay):
+        """ Schedules the next poll of a feed after given number of seconds,
+        plus random jitter.
+        """
+        if not self._is_current(name, state):
             return
 
-        if self.next_poll > datetime.utcnow():
-            return
+        interval = self._get_poll_interval(name)
+        delay += random.uniform(0, interval * POLL_JITTER)
+        state['next_poll'] = datetime.utcnow() + timedelta(seconds=delay)
+        self.bot.schedule(delay, functools.partial(
+            self._poll_and_update_feed, name, state))
 
-        global_next_poll = None
-        for st in self.state.iteritems():
-            next_poll = self._poll_and_update_feed(*st)
-            global_next_poll = (min(next_poll, global_next_poll)
-                                if global_next_poll else next_poll)
-        if global_next_poll:
-            self.next_poll = global_next_poll
+    def _is_current(self, name, state):
+        """ Checks whether given state of a feed is still the current one,
+        i.e. plugin hasn't been initialized again (on reconnect)
+        since the state was loaded.
+        """
+        return self.state.get(name) is state
+
+    def _get_poll_interval(self, name):
+        """ Returns the number of seconds between polls of a feed. """
+        interval = self.feeds[name]['frequency'].total_seconds()
+        return max(interval, MIN_POLL_INTERVAL)
 
+    @defer.inlineCallbacks
     def _poll_and_update_feed(self, name, state):
         """ Polls the items from feed of given name and updates its state.
-        :return: Time of the next scheduled poll for this feed
+        Schedules the next poll according to feed's frequency,
+        or later if it keeps failing.
         """
         feed = self.feeds[name]
-
+        delay = self._get_poll_interval(name)
+        try:
+            content = yield self.polls.run(fetch_rss_feed, feed['url'], state)
+            if not self._is_current(name, state):
+                return  # the new state is being polled already
+            seen = False
+            if content is not None:  # i.e. it has been modified
+                seen = self._update_feed(name, state, content)
+            state['last_poll_time'] = datetime.utcnow()
+            state['failures'] = 0
+            self._save_state(name, state, seen)
+        except Exception, e:
+            state['failures'] = state.get('failures', 0) + 1
+            delay = min(delay * 2 ** state['failures'],
+                        max(delay, MAX_POLL_BACKOFF))
+            logging.error("Error while polling feed %s (%s: %s); "
+                          "retrying in %d seconds",
+                          name, type(e).__name__, e, delay)
+        finally:
+            self._schedule_poll(name, state, delay)
+
+    def _update_feed(self, name, state, content):
+        """ Finds new items in downloaded content of the feed,
+        and announces them.
+        :return: Whether any items have been added to the seen ones
+        """
         last_item = state.get('last_item')
         min_pub_date = state.get('last_poll_time') or datetime.utcnow()
 
-        items = poll_rss_feed(feed['url'], until=lambda item: (
-            item.get('guid') == last_item or
-            item.get('pubDate', datetime.min) < min_pub_date)
-        )
+        if last_item:
+            items = get_new_items(content, until=lambda item: (
+                get_item_id(item) == last_item or
+                item.get('pubDate', datetime.min) < min_pub_date)
+            )
+        else:
+            items = get_new_items(content)  # only to remember them
+
+        seen = state['seen']
+        new_items = [item for item in items if get_item_id(item) not in seen]
         if last_item:  # do not announce full feed
-            self._announce_feed(name, items)
+            self._announce_feed(name, new_items)
 
-        state['last_poll_time'] = datetime.utcnow()
         if items:
-            state['last_item'] = items[0]['guid']
-
-        return datetime.utcnow() + feed['frequency']
+            state['last_item'] = get_item_id(items[0])
+        for item in reversed(new_items):  # from the oldest one
+            seen[get_item_id(item)] = None
+        while len(seen) > MAX_SEEN_ITEMS:
+            seen.popitem(last=False)
+        return bool(new_items)
 
     def _announce_feed(self, name, items):
         """ Announces polled feed items to all target channels. """
@@ -121,22 +267,69 @@ class Rss(Plugin):
         if not channels or channels in ['everywhere', 'all']:
             channels = self.bot.channels
 
-        for item in items:
-            title = item['title']
-            if 'filter' in feed and not feed['filter'].match(title):
-                continue
+        if 'filter' in feed:
+            items = [item for item in items
+                     if feed['filter'].match(item['title'])]
+        if not items:
+            return
 
-            # don't display '(by X)' if there's no author
-            author = item.get('authorName')
-            by = " (by %s)" % author if author else ""
+        digest_threshold = feed.get('digest')
+        if digest_threshold and len(items) > digest_threshold:
+            lines = format_digest(name, items)
+        else:
+            lines = ["@ %s -> %s" % (name, format_item(item))
+                     for item in items]
 
-            item_text = "@ %s -> %s%s -- %s" % (name, title, by, item['link'])
-            for channel in channels:
-                irc.say(self.bot, channel, item_text)
+        # same lines go to many channels, so send them to several at once
+        irc.say_to_all(self.bot, list(channels), lines)
 
 
 # Utility functions
 
+def format_item(item):
+    """ Formats RSS item for announcing it. """
+    # don't display '(by X)' if there's no author
+    author = item.get('authorName')
+    by = " (by %s)" % author if author else ""
+    return "%s%s -- %s" % (item['title'], by, item['link'])
+
+
+def format_digest(name, items):
+    """ Formats a digest of many RSS items, which fits in a few lines.
+    :return: List of lines
+    """
+    lines = []
+    line = "@ %s -> %d new items: " % (name, len(items))
+    for i, item in enumerate(items):
+        text = "%s <%s>" % (item['title'], item['link'])
+        if len(line) + len(text) > DIGEST_LINE_LENGTH \
+                and not line.endswith(": "):
+            if len(lines) + 1 == DIGEST_MAX_LINES:
+                line += "... and %d more" % (len(items) - i)
+                break
+            lines.append(line.rstrip(" |"))
+            line = "@ %s -> " % name
+        line += text + " | "
+    lines.append(line.rstrip(" |"))
+    return lines
+
+
+def format_feed_stats(name, stats, now=None):
+    """ Formats statistics of polling a feed (as returned by get_stats). """
+    parts = []
+    if stats['next_poll']:
+        delay = stats['next_poll'] - (now or datetime.utcnow())
+        delay = timedelta(seconds=max(0, int(delay.total_seconds())))
+        parts.append("next poll in %s" % delay)
+    if stats['last_fetch_duration'] is not None:
+        parts.append("last fetch took %.2fs" % stats['last_fetch_duration'])
+    else:
+        parts.append("not fetched yet")
+    if stats['failures']:
+        parts.append("%d failed poll(s) in a row" % stats['failures'])
+    return "%s: %s" % (name, ", ".join(parts))
+
+
 def parse_frequency(frequency):
     """ Parses the "frequency" configuration paramater, converting
     it to timedelta.
@@ -154,58 +347,110 @@ def parse_frequency(frequency):
         return timedelta()
 
 
-def poll_rss_feed(feed_url, until=None):
-    """ Polls an RSS feed, retrieving all new items
+def fetch_rss_feed(url, state):
+    """ Downloads an RSS feed, unless it hasn't changed since it was
+    downloaded before (according to ETag/Last-Modified kept in state).
+
+    :return: Deferred with content of the feed,
+             or None if it's not modified
+    """
+    def remember_validators((content, etag, last_modified)):
+        state['etag'], state['last_modified'] = etag, last_modified
+        return content
+
+    def record_duration(result):
+        state['last_fetch_duration'] = time.time() - start
+        return result
+
+    start = time.time()
+    d = http.get_client().fetch_if_modified(
+        url, state.get('etag'), state.get('last_modified'))
+    d.addCallback(remember_validators)
+    d.addBoth(record_duration)
+    return d
+
+
+def get_item_id(item):
+    """ Returns the identifier of RSS item: its GUID, or link if it's missing.
+    """
+    return item.get('guid') or item.get('link')
+
+
+def get_new_items(content, until=None):
+    """ Retrieves new items from RSS feed,
     up until a specific condition is met.
 
+    Feed is parsed incrementally, so that items which come after
+    (i.e. are older than) the last new one aren't even looked at.
+
     :param until: Optional filter predicate for RSS items.
                   If specified, only items up to first one
                   that doesn't satisfy it will be returned.
 
-    :return: List of RSS items, where each one is a dictionary
+    :return: List of RSS items (dictionaries), sorted by date, descending
     """
-    rss_items = get_rss_items(feed_url)
-    if until is None:
-        return rss_items
+    items = iter_rss_items(content)
+    if until is not None:
+        items = takewhile(lambda item: not until(item), items)
 
-    return list(takewhile(lambda item: not until(item), rss_items))
+    return sorted(items,
+                  key=lambda item: item.get('pubDate', datetime.min),
+                  reverse=True)
 
 
-def get_rss_items(url):
-    """ Retrieves RSS items from given URL.
+def iter_rss_items(content):
+    """ Parses RSS items from content of a feed, one by one,
+    in the order they appear in the feed (usually newest first).
 
-    .. note:: All <channel> elements are merged into flat list.
+    .. note:: Items of all <channel> elements are yielded.
 
-    :return: List of RSS items (dictionaries)
+    :return: Iterable of RSS items (dictionaries)
     """
     try:
-        rss = etree.parse(url)
-    except Exception:
-        logging.exception("Error while downloading feed %s", url)
-        return []
-
-    # parse the RSS content
-    res = []
-    for channel in rss.getroot().iter('channel'):
-        for item in channel.iter('item'):
+        for _, item in etree.iterparse(BytesIO(content), tag='item'):
             rss_item = dict((elem.tag, elem.text)
                             for elem in item.iter(tag=etree.Element)
                             if elem.tag != 'item')
 
             # conveniently convert pubDate to datetime objects,
             # in UTC but without timezone info (simplifies things later)
-            try:
-                pub_date = parse_date(rss_item['pubDate'])
-                if pub_date.tzinfo is not None:
-                    pub_date = pub_date.astimezone(pytz.utc)
-                    pub_date = pub_date.replace(tzinfo=None)
+            pub_date = parse_pub_date(rss_item.get('pubDate'))
+            if pub_date:
                 rss_item['pubDate'] = pub_date
-            except (KeyError, ValueError):
+            else:
                 rss_item.pop('pubDate', None)  # remove if invalid
 
-            res.append(rss_item)
+            # free the memory taken by items parsed so far
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
 
-    # sort it by date, descending
-    return sorted(res,
-                  key=lambda item: item.get('pubDate', datetime.min),
-                  reverse=True)
+            yield rss_item
+    except etree.XMLSyntaxError:
+        logging.exception("Error while parsing feed")
+
+
+def parse_pub_date(pub_date):
+    """ Parses the publication date of RSS item.
+    :return: datetime in UTC (without timezone info), or None if invalid
+    """
+    if not pub_date:
+        return None
+
+    # RSS dates are supposed to be in RFC 822 format,
+    # which can be parsed much faster than by dateutil
+    parsed = parsedate_tz(pub_date)
+    if parsed and parsed[9] is not None:
+        try:
+            return datetime.utcfromtimestamp(mktime_tz(parsed))
+        except (OverflowError, ValueError):
+            pass
+
+    try:
+        pub_date = parse_date(pub_date)
+    except (OverflowError, ValueError):
+        return None
+    if pub_date.tzinfo is not None:
+        pub_date = pub_date.astimezone(pytz.utc)
+        pub_date = pub_date.replace(tzinfo=None)
+    return pub_date
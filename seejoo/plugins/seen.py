@@ -8,35 +8,123 @@ Created on 2012-01-12
 '''
 from datetime import datetime
 import json
+import logging
 import os
 from time import time
 
-from seejoo.ext import register_plugin, get_storage_dir, MSG_ACTION
+from twisted.internet import reactor, task
+
+from seejoo.ext import (register_plugin, get_storage, get_storage_dir,
+                        MSG_ACTION)
 from seejoo.util import irc
 
 
-def seen_plugin(bot, event, **kwargs):
+def seen_plugin(bot, event):
     ''' Main function. Plugin is implemented as a function because
     it eliminates some redundancy in recording user's activity.
     '''
-    if event in ('init', 'tick'):
+    if event.name == 'init':
+        start_flushing()
         return
-
-    if event == 'command':  # .seen command
-        user_arg = kwargs['args'].strip()
-        if user_arg == irc.get_nick(kwargs['user']):
+    if event.name == 'command':  # .seen command
+        user_arg = (event.args or '').strip()
+        if user_arg == irc.get_nick(event.user):
             return "You might wanna look in the mirror..."
         if user_arg == bot.nickname:
             return "Looking for me?"
         return handle_seen_command(user_arg)
 
-    track_activity(event, **kwargs)
+    track_activity(event)
 
 seen_plugin.commands = {'seen': "Reports last time when user was seen"}
+seen_plugin.events = ('init', 'join', 'part', 'kick', 'quit', 'message',
+                      'nick', 'mode', 'topic', 'command')
+seen_plugin.reactor_safe = True
+seen_plugin.event_objects = True
 register_plugin(seen_plugin)
 
 
-storage_dir = get_storage_dir(seen_plugin)
+# Users' activity is kept in memory, and written to storage periodically
+FLUSH_INTERVAL = 30  # seconds
+
+storage = get_storage(seen_plugin)
+activity_index = {}  # nick -> channel -> last activity
+dirty_nicks = set()  # whose activity hasn't been written yet
+flush_stats = {'flushes': 0, 'last_latency': None, 'max_latency': 0.0}
+flush_task = None
+
+
+def import_legacy_files():
+    ''' Imports users' activity from the files where it used to be kept
+    (one per nick), removing them afterwards.
+    '''
+    storage_dir = get_storage_dir(seen_plugin)
+    files = [f for f in os.listdir(storage_dir)
+             if os.path.isfile(os.path.join(storage_dir, f))]
+    if not files:
+        return
+
+    with storage.transaction():
+        for nick in files:
+            with open(os.path.join(storage_dir, nick)) as f:
+                try:
+                    storage[nick] = json.load(f)
+                except ValueError:
+                    pass
+    for nick in files:
+        os.unlink(os.path.join(storage_dir, nick))
+
+import_legacy_files()
+activity_index.update(storage.scan())
+
+
+def start_flushing():
+    ''' Starts writing the recorded activity to storage periodically,
+    as well as when the bot shuts down.
+    Plugin is initialized again on every reconnect, but this is done once.
+    '''
+    global flush_task
+    if flush_task is not None:
+        return
+
+    flush_task = task.LoopingCall(flush)
+    flush_task.start(FLUSH_INTERVAL, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', flush)
+
+
+def flush():
+    ''' Writes the activity which has been recorded since last flush
+    to storage, in a single transaction.
+    '''
+    if not dirty_nicks:
+        return
+
+    start = time()
+    count = len(dirty_nicks)
+    try:
+        with storage.transaction():
+            for nick in dirty_nicks:
+                storage[nick] = activity_index[nick]
+    except Exception:
+        logging.exception("Error while flushing activity of users")
+        return  # will be retried with the next flush
+    dirty_nicks.clear()
+
+    latency = time() - start
+    flush_stats['flushes'] += 1
+    flush_stats['last_latency'] = latency
+    flush_stats['max_latency'] = max(flush_stats['max_latency'], latency)
+    logging.debug("Flushed activity of %s user(s) in %.3fs", count, latency)
+
+
+def get_stats():
+    ''' Returns a dictionary with statistics of the activity index:
+    number of users known, number of those whose activity hasn't been
+    written to storage yet, and the latency of flushes.
+    '''
+    stats = dict(flush_stats)
+    stats.update(users=len(activity_index), dirty=len(dirty_nicks))
+    return stats
 
 
 # .seen command
@@ -48,13 +136,10 @@ def handle_seen_command(user):
     if not user:
         return "You haven't said who you're looking for."
 
-    user_file = os.path.join(storage_dir, user)
-    if not os.path.exists(user_file):
+    activity = activity_index.get(user)
+    if not activity:
         return "Sorry, I have never heard of '%s'." % user
 
-    with open(user_file, 'r') as f:
-        activity = json.load(f)
-
     channel, last_action = max(activity.iteritems(),
                                key=lambda (_, a): a['timestamp'])
 
@@ -71,83 +156,76 @@ def handle_seen_command(user):
 GLOBAL_CHANNEL = '(global)'
 
 
-def track_activity(event, **kwargs):
+# Fields of events which refer to users whose activity it is
+USER_FIELDS = {
+    'kick': ('kicker', 'kickee'),
+    'nick': ('old', 'new'),
+}
+
+
+def track_activity(event):
     ''' Tracks activity of some user, recording it for further retrieving
     with .seen command.
     '''
     # retrieve user(s) for this activity
-    events_to_user_refs = {
-        'kick': ('kicker', 'kickee'),
-        'nick': ('old', 'new'),
-    }
-    user_refs = events_to_user_refs.get(event, ('user',))
-    users = filter(None, map(kwargs.get, user_refs))
+    user_fields = USER_FIELDS.get(event.name, ('user',))
+    users = filter(None, (getattr(event, f) for f in user_fields))
 
     if users:
-        # replace full user IDs with just their nicks
-        for ref in user_refs:
-            kwargs[ref] = irc.get_nick(kwargs[ref])
-
-        text = format_activity_text(event, **kwargs)
-        channel = kwargs.get('channel')
+        text = format_activity_text(event)
+        channel = getattr(event, 'channel', None)
 
         for user in users:
             record_user_activity(user, channel, text)
 
 
-def format_activity_text(event, **kwargs):
-    ''' Creates a line of text describing an IRC event with given parameters.
+def format_activity_text(event):
+    ''' Creates a line of text describing an IRC event.
 
     It will be recorded as user's activity and eventually displayed
     in response to .seen command.
     '''
-    def format_message_event(d):
-        fmt = "* %s %s" if d.get('type') == MSG_ACTION else "<%s> %s"
-        return fmt % (d['user'], d['message'])
+    nick = lambda e: irc.get_nick(e.user)
+
+    def format_message_event(e):
+        fmt = "* %s %s" if e.type == MSG_ACTION else "<%s> %s"
+        return fmt % (nick(e), e.message)
 
-    def format_mode_event(d):
-        mode_args = d['args']
+    def format_mode_event(e):
+        mode_args = e.args
         formatted_args = (" " + " ".join(mode_args)
                           if mode_args and all(mode_args)
                           else "")
-        sign = "+" if d['set'] else "-"
-        return "* %s sets mode %s%s%s" % (d['user'], sign,
-                                          d['modes'], formatted_args),
+        sign = "+" if e.set else "-"
+        return "* %s sets mode %s%s%s" % (nick(e), sign,
+                                          e.modes, formatted_args),
 
     event_formatters = {
-        'join': lambda d: "* %s joins %s." % (
-            d['user'], d['channel']),
-        'part': lambda d: "* %s leaves %s." % (
-            d['user'], d['channel']),
-        'kick': lambda d: "* %s has been kicked from %s by %s." % (
-            d['kickee'], d['channel'], d['kicker']),
+        'join': lambda e: "* %s joins %s." % (
+            nick(e), e.channel),
+        'part': lambda e: "* %s leaves %s." % (
+            nick(e), e.channel),
+        'kick': lambda e: "* %s has been kicked from %s by %s." % (
+            e.kickee, e.channel, irc.get_nick(e.kicker)),
         'message': format_message_event,
-        'nick': lambda d: "* %s changes nick to %s." % (
-            d['old'], d['new']),
+        'nick': lambda e: "* %s changes nick to %s." % (
+            e.old, e.new),
         'mode': format_mode_event,
-        'topic': lambda d: "* %s sets topic of %s to '%s'." % (
-            d['user'], d['channel'], d['topic']),
-        'quit': lambda d: "* %s quits IRC (%s)." % (
-            d['user'], d['message']) ,
+        'topic': lambda e: "* %s sets topic of %s to '%s'." % (
+            nick(e), e.channel, e.topic),
+        'quit': lambda e: "* %s quits IRC (%s)." % (
+            nick(e), e.message) ,
     }
 
-    fmt = event_formatters.get(event)
-    return fmt(kwargs) if fmt else None
+    fmt = event_formatters.get(event.name)
+    return fmt(event) if fmt else None
 
 
 def record_user_activity(user, channel, text):
     ''' Records activity represented by given text. '''
-    activity = {}
-
-    user_file = os.path.join(storage_dir, irc.get_nick(user))
-    if os.path.exists(user_file):
-        with open(user_file, 'r') as f:
-            try:
-                activity = json.load(f)
-            except ValueError:
-                pass
+    nick = irc.get_nick(user)
+    activity = activity_index.setdefault(nick, {})
 
     channel = channel or GLOBAL_CHANNEL
     activity[channel] = {'text': text, 'timestamp': time()}
-    with open(user_file, 'w') as f:
-        json.dump(activity, f)
+    dirty_nicks.add(nick)
@@ -14,9 +14,10 @@ import logging
 from urllib import urlencode
 
 from taipan.collections import dicts
+from twisted.internet import defer
 
-from seejoo.ext import plugin, Plugin
-from seejoo.util.common import download
+from seejoo.ext import cacheable, plugin, Plugin, reactor_safe
+from seejoo.util.http import fetch
 
 
 DEFAULT_TARGET_LANGUAGE = 'en-US'
@@ -24,6 +25,8 @@ MAX_LANGUAGE_CODE_LEN = 7
 
 
 @plugin
+@cacheable(60 * 60)
+@reactor_safe
 class Translate(Plugin):
     """Translation plugin."""
     commands = {
@@ -72,9 +75,11 @@ class Translate(Plugin):
                 return "Invalid language arguments"
 
         text = " ".join(dropwhile(self._is_lang_flag, arg_parts))
-        translation = fetch_translation(text, target_lang, source_lang)
-        return "{translated_text} ({source_lang} -> {target_lang})".format(
-            **translation.__dict__)
+        d = fetch_translation(text, target_lang, source_lang)
+        d.addCallback(lambda translation:
+            "{translated_text} ({source_lang} -> {target_lang})".format(
+                **translation.__dict__))
+        return d
 
     def _is_lang_flag(self, s):
         """Whether given string specifies an input or output language."""
@@ -113,12 +118,14 @@ def get_translate_url(text, target_lang, source_lang=None):
     return API_ENDPOINT_URL + '?' + urlencode(query_args)
 
 
+@defer.inlineCallbacks
 def fetch_translation(text, target_lang, source_lang=None):
     """Get the translation of given text and return as Translation tuple."""
     url = get_translate_url(text, target_lang, source_lang)
 
     logging.debug("Fetching translation from URL: %s", url)
-    response = unicode(download(url, user_agent=USER_AGENT), 'utf-8')
+    response = yield fetch(url, user_agent=USER_AGENT)
+    response = unicode(response, 'utf-8')
 
     # convert the protobuf wire format to something json module can swallow
     while ',,' in response:
@@ -131,9 +138,9 @@ def fetch_translation(text, target_lang, source_lang=None):
     except IndexError:
         source_lang = source_lang or "?"
 
-    return Translation(
+    defer.returnValue(Translation(
         source_lang=source_lang,
         original_text=data[0][1],
         target_lang=str(target_lang).lower(),
         translated_text=data[0][0],
-    )
+    ))
@@ -2,19 +2,35 @@
 Contains the URLSpy plugin, which provides functionality
 related to URLs spoken by those present on IRC channel.
 """
+import codecs
+from HTMLParser import HTMLParser
 import logging
 import re
 
-from bs4 import BeautifulSoup
+from twisted.internet import reactor
 
 from seejoo.ext import plugin, Plugin
-from seejoo.util import irc
-from seejoo.util.common import download
+from seejoo.util import http, irc
+from seejoo.util.cache import SingleFlight
 from seejoo.util.strings import normalize_whitespace
 
 
 TITLE_MAX_LEN = 250
 
+#: How much of the page will be read at most, looking for its title
+MAX_PAGE_BYTES = 512 * 1024
+
+HTML_MIME_TYPES = frozenset(['text/html', 'application/xhtml+xml'])
+DEFAULT_CHARSET = 'utf-8'
+
+#: If Content-Type doesn't specify the charset, the beginning of page
+#: is searched for its <meta> declaration (like browsers do)
+CHARSET_SNIFF_BYTES = 1024
+META_CHARSET_RE = re.compile(r"""
+    <meta\s[^>]*?charset\s*=\s*     # <meta charset=... or content="...; charset=...
+    ["']?\s*(?P<charset>[-\w.:]+)
+    """, re.IGNORECASE | re.VERBOSE)
+
 URL_RE = re.compile(r"""
     ((https?\:\/\/)|(www\.))    # URLs start with http://, https:// or www.
     (\w+\.)*\w+                 # followed by domain/host part
@@ -30,61 +46,205 @@ class URLSpy(Plugin):
     """Plugin for listening on users pasting URLs and automatically resolving
     where they point to.
     """
-    def message(self, bot, channel, user, message, type):
+    def __init__(self):
+        # URL pasted to several channels at once is only resolved once
+        self._resolving = SingleFlight()
+
+    def message(self, bot, channel, user, message, type, hostmask=None):
         """Called when we hear a message being spoken."""
         if not channel or channel == '*':
             return
+        hostmask = hostmask or irc.parse_hostmask(user)
         # if message comes from server
-        if '!' not in user:
+        if not hostmask or hostmask.host is None:
             return
 
-        if irc.get_nick(user) == bot.nickname:
+        if hostmask.nick == bot.nickname:
             return
 
         url_match = URL_RE.search(message)
         if url_match:
-            result = self._resolve_url(url_match.group(0))
-            if result:
-                type_, title = result
-                irc.say(bot, channel, u"[%s] %s" % (type_, title))
+            url = url_match.group(0)
+            d = self._resolving.call(url, self._resolve_url, url)
+            d.addCallback(self._announce_url, bot, channel)
+            return d
+
+    def _announce_url(self, result, bot, channel):
+        """Say what the resolved URL points to."""
+        if result:
+            type_, title = result
+            irc.say(bot, channel, u"[%s] %s" % (type_, title))
 
     def _resolve_url(self, url):
         """Handle URL being spoken on a channel where the bot is."""
-        page_content = download(url)
-        if not page_content:
-            logging.debug("Could not download URL %s" % url)
-            return
+        client = http.get_client()
 
-        html = BeautifulSoup(page_content)
-        if YOUTUBE_URL_RE.match(url):
-            return self._handle_youtube_video(html)
-        else:
-            return self._handle_regular_page(html)
+        def read_page(response):
+            if not 200 <= response.code < 300:
+                logging.debug("Could not download URL %s (HTTP %s)",
+                              url, response.code)
+                client.abort(response)
+                return
+
+            content_type = response.headers.getRawHeaders(
+                'Content-Type', [''])[0]
+            mime_type, charset = parse_content_type(content_type)
+            if mime_type not in HTML_MIME_TYPES:
+                client.abort(response)
+                return
+
+            is_youtube = YOUTUBE_URL_RE.match(url)
+            parser = PageInfoParser(YOUTUBE_ELEMENTS if is_youtube
+                                    else PAGE_ELEMENTS, charset)
+
+            d = client.read_body(response, max_size=MAX_PAGE_BYTES,
+                                 consumer=parser.feed_chunk)
+            def handle_page(_):
+                parser.finish()
+                if is_youtube:
+                    return self._handle_youtube_video(parser.found)
+                return self._handle_regular_page(parser.found)
+
+            d.addBoth(handle_page)
+            return d
 
-    def _handle_youtube_video(self, html):
+        def log_failure(failure):
+            logging.debug("Could not download URL %s (%s: %s)",
+                          url, failure.type.__name__, failure.value)
+
+        d = client.request(url)
+        d.addCallback(read_page)
+        d.addErrback(log_failure)
+        d.addTimeout(client.read_timeout, reactor)
+        return d
+
+    def _handle_youtube_video(self, found):
         """Special handling of Youtube URLs: shows video title
         and watch counter value.
         """
         try:
-            title = sanitize(html.find('span', id='eow-title').text)
-            watch_tag = sanitize(html.find('span', class_='watch-view-count').text)
+            title = sanitize(found['title'])
+            watch_tag = sanitize(found['views'])
             watch_count = ' '.join(re.findall(r'(?=\d)[\d\s]+(?<=\d)', watch_tag))
-        except AttributeError:
+        except KeyError:
             return "YouTube", "(Unknown video)"
         else:
             return "YouTube", "%s (watched %s times)" % (title, watch_count)
 
-    def _handle_regular_page(self, html):
+    def _handle_regular_page(self, found):
         """Handle regular page by displaying its <title>."""
         try:
-            title = sanitize(html.find('title').text)
+            title = sanitize(found['title'])
             # Title length limit
             title = shorten(title)
             return "", title
-        except AttributeError:
+        except KeyError:
             pass
 
 
+# Page parsing
+
+#: Elements of HTML pages that we're interested in,
+#: as tuples: (name, tag, attribute, attribute value)
+PAGE_ELEMENTS = [('title', 'title', None, None)]
+YOUTUBE_ELEMENTS = [('title', 'span', 'id', 'eow-title'),
+                    ('views', 'span', 'class', 'watch-view-count')]
+
+
+class PageInfoParser(HTMLParser):
+    """Parser which extracts text of particular elements from HTML page.
+
+    The page is fed to the parser in chunks, and it reports when all
+    the elements have been found, so that the rest of page can be skipped.
+    """
+    def __init__(self, elements, charset=None):
+        """
+        :param charset: Charset from Content-Type header, if any.
+                        Without it, the charset declared in page's <meta>
+                        is used, so the page's beginning is buffered
+                        until it's known.
+        """
+        HTMLParser.__init__(self)
+        self.elements = elements
+        self.found = {}
+
+        codec = get_codec(charset)
+        self.decoder = self._get_decoder(codec) if codec else None
+        self._head = ''  # bytes read before the charset is known
+
+        self._current = None  # element whose text is being read
+        self._depth = 0
+        self._text = []
+
+    def feed_chunk(self, chunk):
+        """Feeds a chunk of page's content to the parser.
+        :return: Whether all the elements have been found
+        """
+        if self.decoder is None:
+            self._head += chunk
+            if len(self._head) < CHARSET_SNIFF_BYTES:
+                return False
+            chunk = self._sniff_charset()
+        self.feed(self.decoder.decode(chunk))
+        return len(self.found) == len(self.elements)
+
+    def finish(self):
+        """Feeds the parser with the rest of content that may have been
+        buffered, once the page has been read.
+        """
+        chunk = self._sniff_charset() if self.decoder is None else ''
+        self.feed(self.decoder.decode(chunk, True))
+
+    def _sniff_charset(self):
+        """Sets up the decoder for charset declared in the buffered beginning
+        of page, returning the content buffered so far.
+        """
+        m = META_CHARSET_RE.search(self._head)
+        codec = get_codec(m.group('charset')) if m else None
+        self.decoder = self._get_decoder(codec or DEFAULT_CHARSET)
+
+        head, self._head = self._head, ''
+        return head
+
+    def _get_decoder(self, codec):
+        return codecs.getincrementaldecoder(codec)(errors='replace')
+
+    def handle_starttag(self, tag, attrs):
+        if self._current:
+            if tag == self._current[1]:
+                self._depth += 1
+            return
+
+        for element in self.elements:
+            name, el_tag, attr, value = element
+            if tag != el_tag or name in self.found:
+                continue
+            if attr and value not in (dict(attrs).get(attr) or '').split():
+                continue
+            self._current = element
+            self._depth = 1
+            self._text = []
+            break
+
+    def handle_endtag(self, tag):
+        if not self._current or tag != self._current[1]:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            self.found[self._current[0]] = ''.join(self._text)
+            self._current = None
+
+    def handle_data(self, data):
+        if self._current:
+            self._text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+
 def shorten(text):
     if len(text) < TITLE_MAX_LEN:
         return text
@@ -99,3 +259,30 @@ def shorten(text):
 def sanitize(text):
     """Sanitize text extracted from HTML"""
     return normalize_whitespace(text).strip()
+
+
+def parse_content_type(content_type):
+    """Parse the value of Content-Type header.
+    :return: Tuple of MIME type and charset (which may be None)
+    """
+    parts = content_type.split(';')
+    mime_type = parts[0].strip().lower()
+
+    charset = None
+    for param in parts[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            charset = value.strip().strip('"\'')
+    return mime_type, charset
+
+
+def get_codec(charset):
+    """Returns the name of Python codec for given charset,
+    or None if it's not supported.
+    """
+    if not charset:
+        return None
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
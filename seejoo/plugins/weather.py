@@ -8,14 +8,16 @@ from __future__ import unicode_literals
 import json
 import urllib2
 
-from seejoo.util.common import download
-from seejoo.ext import plugin, Plugin
+from seejoo.util.http import fetch
+from seejoo.ext import cacheable, plugin, Plugin, reactor_safe, uncached
 
 
 WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
 
 
 @plugin
+@cacheable(10 * 60)
+@reactor_safe
 class OpenWeather(Plugin):
     commands = {
         'f': ("Polls openweathermap.org for current weather "
@@ -27,9 +29,13 @@ class OpenWeather(Plugin):
             return
 
         url = WEATHER_URL + "?q=%s&lang=eng" % urllib2.quote(args)
-        json_data = download(url)
+        d = fetch(url)
+        d.addCallback(self._format_weather, bot, channel)
+        return d
+
+    def _format_weather(self, json_data, bot, channel):
         if not json_data:
-            return "Weather not available at the moment."
+            return uncached("Weather not available at the moment.")
 
         try:
             data = json.loads(json_data)
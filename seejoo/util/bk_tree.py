@@ -0,0 +1,86 @@
+'''
+A BK-tree, for finding strings similar to a given one.
+'''
+from seejoo.util.strings import edit_distance
+
+
+class BKTreeNode(object):
+    '''
+    A node of BK-tree. Node contains:
+    - a string
+    - children, indexed by their distance from the string
+    '''
+    __slots__ = ('word', 'children')
+
+    def __init__(self, word):
+        self.word = word
+        self.children = {}
+
+
+class BKTree(object):
+    '''
+    A tree of strings, organized by the edit distance between them.
+
+    Finding strings within some distance from a given one only has to
+    look at the part of tree where such strings can possibly be,
+    rather than compare against every string in it.
+    '''
+    def __init__(self, distance=edit_distance):
+        '''
+        Initializes the tree.
+        @param distance: Function computing the distance between two strings.
+                         It must be a metric, like the edit distance
+        '''
+        self.distance = distance
+        self.root = None
+        self.size = 0
+
+    def add(self, word):
+        '''
+        Adds a string to the tree.
+        @return: Whether the string has been added (i.e. it wasn't there)
+        '''
+        if self.root is None:
+            self.root = BKTreeNode(word)
+            self.size += 1
+            return True
+
+        node = self.root
+        while True:
+            d = self.distance(word, node.word)
+            if d == 0:
+                return False
+            child = node.children.get(d)
+            if child is None:
+                node.children[d] = BKTreeNode(word)
+                self.size += 1
+                return True
+            node = child
+
+    def search(self, word, max_distance):
+        '''
+        Finds strings which are within given distance from the word.
+        @return: List of (distance, string) pairs, closest strings first
+        '''
+        if self.root is None:
+            return []
+
+        res = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = self.distance(word, node.word)
+            if d <= max_distance:
+                res.append((d, node.word))
+            for child_d, child in node.children.iteritems():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+
+        res.sort()
+        return res
+
+    def __contains__(self, word):
+        return self.search(word, 0) != []
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,136 @@
+'''
+Caching utilities.
+'''
+from collections import OrderedDict
+import logging
+import time
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class LRUCache(object):
+    '''
+    A cache of bounded size, which evicts least recently used items
+    when it's full. Items can also expire after some time.
+    '''
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        '''
+        Initializes the cache.
+        @param max_size: Maximum number of items in the cache
+        @param ttl: Default time (in seconds) after which items expire,
+                    or None if they shouldn't
+        @param clock: Function returning current time in seconds
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (value, expiration time)
+
+    def get(self, key, default=None):
+        ''' Retrieves an item from the cache, or default if it's not there. '''
+        try:
+            value, expires = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and expires <= self.clock():
+            self.misses += 1
+            return default
+
+        self._items[key] = value, expires  # mark as most recently used
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        ''' Puts an item into the cache.
+        @param ttl: Time (in seconds) after which the item expires,
+                    if different than default for the cache
+        '''
+        ttl = self.ttl if ttl is None else ttl
+        expires = self.clock() + ttl if ttl is not None else None
+
+        self._items.pop(key, None)
+        self._items[key] = value, expires
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def discard(self, key):
+        ''' Removes an item from the cache, if it's there. '''
+        self._items.pop(key, None)
+
+    def clear(self):
+        ''' Removes all items from the cache. '''
+        self._items.clear()
+
+    def stats(self):
+        ''' Returns a dictionary with statistics of the cache usage. '''
+        return {'size': len(self._items), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        try:
+            _, expires = self._items[key]
+        except KeyError:
+            return False
+        return expires is None or expires > self.clock()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls of asynchronous functions:
+    while a call identified by some key is in progress, subsequent calls
+    with the same key don't invoke the function again, but wait for
+    the result of the pending call instead.
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.merged = 0
+        self._waiters = {}  # key -> list of Deferreds waiting for result
+
+    def call(self, key, func, *args, **kwargs):
+        ''' Calls the function with given arguments, unless a call
+        with the same key is already in flight.
+        @return: Deferred with the result of the call
+        '''
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            self.merged += 1
+            logging.debug("Joined pending call for %r (%s merged so far)",
+                          key, self.merged)
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+
+        self.calls += 1
+        waiters = self._waiters[key] = []
+
+        def finish(result):
+            del self._waiters[key]
+            for d in waiters:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+
+        d = defer.maybeDeferred(func, *args, **kwargs)
+        d.addBoth(finish)
+        return d
+
+    def stats(self):
+        ''' Returns a dictionary with statistics of the calls:
+        how many were made, how many were merged into pending ones,
+        and how many are still in flight.
+        '''
+        return {'calls': self.calls, 'merged': self.merged,
+                'in_flight': len(self._waiters)}
+
+    def __contains__(self, key):
+        return key in self._waiters
@@ -13,6 +13,10 @@ from taipan.collections import dicts
 def download(url, **headers):
     """Downloads content of given URL.
     Additional headers can be passed as keyword arguments.
+
+    .. warning:: This function blocks until the content is downloaded,
+                 stalling the whole bot. Use :func:`seejoo.util.http.fetch`
+                 instead, which returns a Deferred.
     """
     def header_arg_to_name(header):
         """Convert header argument (e.g. user_agent) into actual
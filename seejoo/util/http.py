@@ -0,0 +1,353 @@
+"""
+Asynchronous HTTP client, used by commands and plugins to talk
+to web services without blocking the bot.
+
+Connections are kept alive and reused through a shared pool,
+while responses are transparently decompressed if the server
+has chosen to gzip/deflate them.
+"""
+import logging
+import zlib
+
+from taipan.collections import dicts
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.web.client import (Agent, BrowserLikeRedirectAgent,
+                                HTTPConnectionPool, ResponseDone,
+                                ResponseNeverReceived)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from seejoo.util.cache import SingleFlight
+
+
+USER_AGENT = "seejoo"
+
+CONNECT_TIMEOUT = 5  # seconds
+READ_TIMEOUT = 15  # seconds
+MAX_BODY_SIZE = 2 * 1024 * 1024  # bytes
+
+MAX_RETRIES = 2
+RETRY_DELAY = 0.5  # seconds; doubled with every subsequent retry
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+MAX_CONNECTIONS_PER_HOST = 4
+IDLE_CONNECTION_TIMEOUT = 120  # seconds
+MAX_REDIRECTS = 5
+
+
+class HTTPError(Exception):
+    """Raised when server responds with non-successful status code."""
+    def __init__(self, url, code):
+        super(HTTPError, self).__init__("HTTP %s for %s" % (code, url))
+        self.url = url
+        self.code = code
+
+
+class ResponseTooLarge(Exception):
+    """Raised when response body exceeds the allowed size."""
+
+
+class HTTPClient(object):
+    """HTTP client which keeps persistent connections to hosts.
+
+    Unless stated otherwise, all methods return Deferreds.
+    """
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_body_size=MAX_BODY_SIZE,
+                 max_retries=MAX_RETRIES):
+        """Constructor.
+
+        :param connect_timeout: Timeout for establishing a connection
+        :param read_timeout: Timeout for the whole request,
+                             including reading the response body
+        :param max_body_size: Maximum size of response body
+                              (after decompression) that will be accepted
+        :param max_retries: How many times a request should be retried
+                            if it failed because of connection errors
+                            or temporary unavailability of the server
+        """
+        self.read_timeout = read_timeout
+        self.max_body_size = max_body_size
+        self.max_retries = max_retries
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = MAX_CONNECTIONS_PER_HOST
+        self.pool.cachedConnectionTimeout = IDLE_CONNECTION_TIMEOUT
+
+        agent = Agent(reactor, connectTimeout=connect_timeout, pool=self.pool)
+        self.agent = BrowserLikeRedirectAgent(agent,
+                                              redirectLimit=MAX_REDIRECTS)
+
+    @defer.inlineCallbacks
+    def request(self, url, method='GET', headers=None):
+        """Performs an HTTP request, retrying it if necessary.
+
+        :param headers: Dictionary of HTTP headers
+        :return: Deferred with the response (IResponse),
+                 whose body hasn't been read yet
+        """
+        url = normalize_url(url)
+        headers = Headers(dict((name, [value])
+                               for name, value in (headers or {}).iteritems()))
+        headers.setRawHeaders('Accept-Encoding', ['gzip, deflate'])
+        if not headers.hasHeader('User-Agent'):
+            headers.setRawHeaders('User-Agent', [USER_AGENT])
+
+        retries = self.max_retries if method in ('GET', 'HEAD') else 0
+        for attempt in xrange(retries + 1):
+            if attempt > 0:
+                delay = RETRY_DELAY * 2 ** (attempt - 1)
+                logging.debug("Retrying %s %s in %.1fs", method, url, delay)
+                yield task.deferLater(reactor, delay, lambda: None)
+
+            try:
+                response = yield self.agent.request(method, url, headers)
+            except (error.ConnectError, error.TimeoutError,
+                    ResponseNeverReceived), e:
+                if _is_cancellation(e):
+                    raise defer.CancelledError()
+                if attempt == retries:
+                    raise
+                logging.debug("Request to %s failed (%s: %s)",
+                              url, type(e).__name__, e)
+                continue
+
+            if response.code in RETRY_STATUS_CODES and attempt < retries:
+                response.deliverBody(_Discard())
+                continue
+            defer.returnValue(response)
+
+    def read_body(self, response, max_size=None, consumer=None):
+        """Reads the body of given response, decompressing it if needed.
+
+        :param max_size: Maximum size of the body;
+                         if exceeded, reading fails with ResponseTooLarge
+        :param consumer: Optional callable which will receive the body
+                         in chunks, as they arrive, instead of having it
+                         accumulated in memory. If it returns True,
+                         the rest of the body will not be read.
+        :return: Deferred with the body as string
+                 (or None, if consumer has been given)
+        """
+        max_size = max_size or self.max_body_size
+        encoding = response.headers.getRawHeaders('Content-Encoding', [''])[0]
+
+        finished = defer.Deferred(lambda _: receiver.abort())
+        receiver = _BodyReceiver(finished, max_size, encoding.lower(),
+                                 consumer)
+        if consumer is None and response.length is not UNKNOWN_LENGTH \
+                and response.length > max_size:
+            receiver.abort(ResponseTooLarge(
+                "Content-Length of %s exceeds %s bytes" % (
+                    response.length, max_size)))
+        response.deliverBody(receiver)
+        return finished
+
+    def abort(self, response):
+        """Closes the connection of given response without reading its body."""
+        finished = defer.Deferred()
+        finished.addErrback(lambda _: None)
+        receiver = _BodyReceiver(finished, 0)
+        receiver.abort()
+        response.deliverBody(receiver)
+
+    def fetch(self, url, headers=None, max_size=None):
+        """Retrieves the content of given URL.
+
+        :param headers: Dictionary of HTTP headers
+        :return: Deferred with the content as string.
+                 Fails with HTTPError if the response was not successful.
+        """
+        def read_response(response):
+            if not 200 <= response.code < 300:
+                response.deliverBody(_Discard())
+                raise HTTPError(url, response.code)
+            return self.read_body(response, max_size)
+
+        d = self.request(url, headers=headers)
+        d.addCallback(read_response)
+        d.addTimeout(self.read_timeout, reactor)
+        return d
+
+    def fetch_if_modified(self, url, etag=None, last_modified=None,
+                          headers=None, max_size=None):
+        """Retrieves the content of given URL, unless it hasn't changed
+        since it was last retrieved (using a conditional GET request).
+
+        :param etag: ETag header of previous response
+        :param last_modified: Last-Modified header of previous response
+        :return: Deferred with (content, etag, last_modified) triple,
+                 where content is None if it hasn't been modified.
+                 Fails with HTTPError if the response was not successful.
+        """
+        headers = dict(headers or {})
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        def read_response(response):
+            if response.code == 304:
+                response.deliverBody(_Discard())
+                return None, etag, last_modified
+            if not 200 <= response.code < 300:
+                response.deliverBody(_Discard())
+                raise HTTPError(url, response.code)
+
+            get_header = lambda name: response.headers.getRawHeaders(
+                name, [None])[0]
+            validators = (get_header('ETag'), get_header('Last-Modified'))
+            d = self.read_body(response, max_size)
+            d.addCallback(lambda content: (content,) + validators)
+            return d
+
+        d = self.request(url, headers=headers)
+        d.addCallback(read_response)
+        d.addTimeout(self.read_timeout, reactor)
+        return d
+
+
+class _BodyReceiver(protocol.Protocol):
+    """Protocol which receives response body,
+    decompressing it and keeping it within size limit.
+    """
+    def __init__(self, finished, max_size, encoding=None, consumer=None):
+        self.finished = finished
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+        self.consumer = consumer
+        self.decompressor = (zlib.decompressobj(32 + zlib.MAX_WBITS)
+                             if encoding in ('gzip', 'deflate') else None)
+        self.error = None
+        self.stopped = False
+
+    def connectionMade(self):
+        if self.error:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.error or self.stopped:
+            return
+        try:
+            if self.decompressor:
+                data = self.decompressor.decompress(data)
+        except zlib.error, e:
+            self.abort(e)
+            return
+
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.abort(ResponseTooLarge(
+                "Response exceeds %s bytes" % self.max_size))
+            return
+
+        if self.consumer is None:
+            self.chunks.append(data)
+            return
+        try:
+            self.stopped = bool(self.consumer(data))
+        except Exception, e:
+            self.abort(e)
+            return
+        if self.stopped:
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return  # cancelled
+        if self.error:
+            self.finished.errback(self.error)
+        elif self.stopped:
+            self.finished.callback(None)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            rest = self.decompressor.flush() if self.decompressor else ''
+            if self.consumer is None:
+                self.finished.callback(''.join(self.chunks) + rest)
+            else:
+                if rest:
+                    self.consumer(rest)
+                self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+    def abort(self, error=None):
+        """Stops receiving the body, failing with given error."""
+        self.error = error or defer.CancelledError()
+        if self.transport:
+            self.transport.stopProducing()
+
+
+class _Discard(protocol.Protocol):
+    """Protocol which ignores the response body."""
+
+
+def _is_cancellation(e):
+    """Checks whether given request error was caused by cancelling it."""
+    reasons = getattr(e, 'reasons', ())
+    return any(r.check(defer.CancelledError) for r in reasons)
+
+
+# Shared client
+
+_client = None
+_fetches = SingleFlight()  # concurrent fetches of the same URL
+
+
+def get_client():
+    """Returns the HTTP client shared by all commands and plugins."""
+    global _client
+    if _client is None:
+        _client = HTTPClient()
+    return _client
+
+
+def fetch(url, **headers):
+    """Retrieves the content of given URL, using the shared HTTP client.
+    Additional headers can be passed as keyword arguments,
+    e.g. ``user_agent`` for the User-Agent header.
+
+    If the same URL is already being fetched, the content
+    of that pending request is shared instead of making another one.
+
+    :return: Deferred with the content as string,
+             or None if it could not be retrieved
+    """
+    def log_failure(failure):
+        logging.debug("Could not fetch %s (%s: %s)", url,
+                      failure.type.__name__, failure.value)
+
+    headers = dicts.mapkeys(header_arg_to_name, headers)
+    key = (normalize_url(url), tuple(sorted(headers.iteritems())))
+    d = _fetches.call(key, get_client().fetch, url, headers)
+    d.addErrback(log_failure)
+    return d
+
+
+def get_fetch_stats():
+    """Returns a dictionary with statistics of :func:`fetch` calls,
+    including the number of those merged with pending requests.
+    """
+    return _fetches.stats()
+
+
+# Utility functions
+
+def header_arg_to_name(header):
+    """Convert header argument (e.g. user_agent) into actual
+    HTTP header name (e.g. User-Agent).
+    """
+    parts = header.split('_')
+    return '-'.join(part.capitalize() for part in parts)
+
+
+def normalize_url(url):
+    """Makes given URL suitable to be requested:
+    adds the http:// scheme if it's missing and encodes it as bytes.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    if '://' not in url:
+        url = 'http://' + url
+    return url
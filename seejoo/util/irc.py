@@ -5,15 +5,22 @@ Created on 2010-12-10
 
 Utility module containing IRC-related functions.
 '''
-import functools
 import logging
 import re
+import string
+import threading
+
+from twisted.internet import reactor
+from twisted.python import threadable
+
+from seejoo.util.cache import LRUCache
 
 
 # Sending messages
 
 LINE_MAX_LEN = 512
 MESSAGE_MAX_LEN = 768
+TARGETS_MAX_LEN = 128  # of comma-separated targets of a single message
 
 
 def say(bot, recipient, messages, log=True):
@@ -22,7 +29,14 @@ def say(bot, recipient, messages, log=True):
     :param bot: IRC bot object
     :param messages: List of messages to say
     :param log: Whether the saying should be logged
+
+    .. note:: This function can be safely called from threads other than
+              the reactor one (e.g. from commands executed in thread pool).
     """
+    if threadable.ioThread and not threadable.isInIOThread():
+        reactor.callFromThread(say, bot, recipient, messages, log)
+        return
+
     if isinstance(messages, basestring):
         messages = [messages]
     target = get_nick(recipient) or recipient
@@ -37,23 +51,182 @@ def say(bot, recipient, messages, log=True):
             logging.debug("[SEND] <%s/%s> %s", "__me__", recipient, msg)
 
 
+def say_to_all(bot, recipients, messages, log=True):
+    """Sends message to several channels or nicks, addressing
+    as many of them at once as the server allows (per its TARGMAX).
+
+    :param recipients: List of channels or nicks
+    :param messages: List of messages to say
+    """
+    max_targets = get_max_targets(bot, 'PRIVMSG')
+    for targets in group_targets(recipients, max_targets):
+        say(bot, targets, messages, log)
+
+
+def get_max_targets(bot, command):
+    """Retrieves the maximum number of targets (channels or nicks)
+    that given command can be sent to at once,
+    as announced by the server in RPL_ISUPPORT.
+
+    :return: Number of targets, or None if it's unlimited
+    """
+    supported = getattr(bot, 'supported', None)
+    if supported is None:
+        return 1
+
+    targmax = supported.getFeature('TARGMAX')
+    if targmax is not None:
+        return targmax.get(command, 1)  # where None means no limit
+    maxtargets = supported.getFeature('MAXTARGETS')
+    try:
+        return max(int(maxtargets[0]), 1) if maxtargets else 1
+    except ValueError:
+        return 1
+
+
+def group_targets(targets, max_targets, max_length=TARGETS_MAX_LEN):
+    """Groups message targets into comma-separated lists,
+    each with at most given number of targets (unless it's None)
+    and not much longer than max_length.
+
+    :return: List of strings with comma-separated targets
+    """
+    groups = []
+    group, length = [], 0
+    for target in targets:
+        if group and (len(group) == max_targets or
+                      length + 1 + len(target) > max_length):
+            groups.append(",".join(group))
+            group, length = [], 0
+        length += len(target) + bool(group)
+        group.append(target)
+    if group:
+        groups.append(",".join(group))
+    return groups
+
+
 # User information extraction
 
 USER_RE = re.compile(r"(?P<nick>[^\!]+)(\!(?P<id>[^\@]+)?\@(?P<host>.*))?")
 
+HOSTMASK_CACHE_SIZE = 1024
+
+
+class Hostmask(object):
+    '''
+    Immutable representation of user's hostmask (nick!id@host),
+    with its parts already extracted.
+    '''
+    __slots__ = ('raw', 'nick', 'id', 'host')
+
+    def __init__(self, raw, nick, id=None, host=None):
+        for name, value in zip(self.__slots__, (raw, nick, id, host)):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def parse(cls, user_host):
+        '''
+        Parses the hostmask from string.
+        @return: Hostmask object, or None if string is not a hostmask
+        '''
+        m = USER_RE.match(user_host)
+        return cls(user_host, *m.group('nick', 'id', 'host')) if m else None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Hostmask objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Hostmask objects are immutable")
+
+    def __reduce__(self):
+        return Hostmask, (self.raw, self.nick, self.id, self.host)
 
-def _get_host_part(part, user_host):
+    def __eq__(self, other):
+        return isinstance(other, Hostmask) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __str__(self):
+        return self.raw
+
+    def __repr__(self):
+        return "<Hostmask %r>" % (self.raw,)
+
+
+_hostmasks = LRUCache(HOSTMASK_CACHE_SIZE)
+_hostmasks_lock = threading.Lock()  # plugins may use it from other threads
+
+
+def parse_hostmask(user_host):
     '''
-    Retrieves the part of user's host specified by the first parameter.
+    Retrieves the parsed hostmask of given user.
+    Since the same users keep appearing, the results are cached.
+    @return: Hostmask object, or None if it's not a valid hostmask
     '''
     if not user_host:
         return None
+    if isinstance(user_host, Hostmask):
+        return user_host
+
+    with _hostmasks_lock:
+        hostmask = _hostmasks.get(user_host, _hostmasks)
+        if hostmask is _hostmasks:
+            hostmask = Hostmask.parse(user_host)
+            _hostmasks.put(user_host, hostmask)
+    return hostmask
+
+
+# Functions to retrieve specific parts
+
+def get_nick(user_host):
+    ''' Retrieves the nick part of user's hostmask. '''
+    hostmask = parse_hostmask(user_host)
+    return hostmask.nick if hostmask else None
 
-    m = USER_RE.match(user_host)
-    return m.groupdict().get(part) if m else None
 
+def get_user_id(user_host):
+    ''' Retrieves the id (username) part of user's hostmask. '''
+    hostmask = parse_hostmask(user_host)
+    return hostmask.id if hostmask else None
 
-# Function to retrieve specific parts
-get_nick = functools.partial(_get_host_part, 'nick')
-get_user_id = functools.partial(_get_host_part, 'id')
-get_host = functools.partial(_get_host_part, 'host')
+
+def get_host(user_host):
+    ''' Retrieves the host part of user's hostmask. '''
+    hostmask = parse_hostmask(user_host)
+    return hostmask.host if hostmask else None
+
+
+# Case mapping of nicks and channel names
+
+def _casemapping(upper, lower):
+    ''' Creates translation tables which map uppercase ASCII letters
+    (and given extra characters) to lowercase ones.
+    '''
+    upper = string.ascii_uppercase + upper
+    lower = string.ascii_lowercase + lower
+    return (string.maketrans(upper, lower),
+            dict(zip(map(ord, upper), map(ord, lower))))
+
+
+#: Translation tables (for str and unicode) for the case mappings
+#: which server can announce in RPL_ISUPPORT
+CASEMAPPINGS = {
+    'ascii': _casemapping('', ''),
+    'rfc1459': _casemapping('[]\\~', '{}|^'),
+    'strict-rfc1459': _casemapping('[]\\', '{}|'),
+}
+DEFAULT_CASEMAPPING = 'rfc1459'
+
+
+def irc_lower(name, casemapping=DEFAULT_CASEMAPPING):
+    '''
+    Converts nick or channel name to lowercase, the way IRC server does
+    when comparing them (e.g. "[Foo]" and "{foo}" are the same nick
+    under rfc1459 case mapping).
+    '''
+    tables = CASEMAPPINGS.get(casemapping) or CASEMAPPINGS[DEFAULT_CASEMAPPING]
+    return name.translate(tables[isinstance(name, unicode)])
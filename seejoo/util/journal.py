@@ -0,0 +1,125 @@
+'''
+Append-only journal of records, kept in a file.
+
+Records (JSON-serializable objects) are written one per line, so that
+adding one is a single append. Since the journal only grows, it can be
+compacted from time to time: replaced with a (usually much shorter)
+sequence of records which yields the same state when replayed.
+'''
+import json
+import logging
+import os
+
+from twisted.internet import threads
+
+
+class Journal(object):
+    '''
+    Journal stored in a file, which is kept open for appending.
+
+    Every record is flushed to the operating system as soon as it's
+    appended, so it will survive the bot's process crashing.
+    '''
+    def __init__(self, path):
+        self.path = path
+        _truncate_partial_record(path)
+        self.file = open(path, 'a')
+        self.size = self.file.tell()
+
+        self._compaction = None  # Deferred of compaction in progress
+        self._backlog = []  # lines appended during compaction
+
+    def replay(self):
+        '''
+        Reads the records from journal.
+        @return: List of records, in the order they were appended
+        '''
+        records = []
+        with open(self.path) as f:
+            for i, line in enumerate(f, 1):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Most likely the last line, only partially written
+                    # when the bot was going down
+                    logging.warning("Skipping invalid record in %s:%s",
+                                    self.path, i)
+        return records
+
+    def append(self, record):
+        ''' Appends a record to the journal. '''
+        line = json.dumps(record) + '\n'
+        self.file.write(line)
+        self.file.flush()
+        self.size += len(line)
+        if self._compaction:
+            self._backlog.append(line)
+
+    def compact(self, records):
+        '''
+        Replaces the journal's content with given records, in background.
+        Records appended in the meantime are preserved.
+
+        @param records: Records representing current state of the journal
+        @return: Deferred which fires when compaction is complete
+        '''
+        if self._compaction:
+            return self._compaction
+
+        tmp_path = self.path + '.tmp'
+
+        def write_records():
+            with open(tmp_path, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+        def replace_journal(_):
+            with open(tmp_path, 'a') as f:
+                f.writelines(self._backlog)
+            self.file.close()
+            os.rename(tmp_path, self.path)
+            self.file = open(self.path, 'a')
+            self.size = self.file.tell()
+
+        def finish(result):
+            self._compaction = None
+            self._backlog = []
+            return result
+
+        self._compaction = d = threads.deferToThread(write_records)
+        d.addCallback(replace_journal)
+        d.addBoth(finish)
+        return d
+
+    @property
+    def compacting(self):
+        ''' Whether the journal is being compacted. '''
+        return self._compaction is not None
+
+    def close(self):
+        self.file.close()
+
+
+def _truncate_partial_record(path, chunk_size=4096):
+    ''' Cuts off the record at the end of journal file that was only
+    partially written (e.g. when the bot crashed), so that records appended
+    afterwards don't end up on the same line with it.
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        end = pos = f.tell()
+        while pos > 0:
+            start = max(0, pos - chunk_size)
+            f.seek(start)
+            newline = f.read(pos - start).rfind('\n')
+            if newline >= 0:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos < end:
+            logging.warning("Truncating partial record at the end of %s", path)
+            f.truncate(pos)
@@ -0,0 +1,182 @@
+'''
+Embedded key-value store, backed by SQLite.
+
+All data is kept in a single database file, divided into namespaces
+(e.g. one for every plugin). Values are serialized as JSON.
+'''
+from contextlib import contextmanager
+import json
+import re
+import sqlite3
+import threading
+
+
+GLOB_SPECIAL_RE = re.compile(r'([*?[])')
+
+
+class KeyValueStore(object):
+    '''
+    Store of key-value pairs in SQLite database.
+
+    Database is opened once and kept open, in write-ahead logging mode,
+    so that readers don't block writers. The store can be used from
+    multiple threads.
+    '''
+    def __init__(self, path):
+        '''
+        Opens the store, creating the database if necessary.
+        @param path: Path to database file, or ':memory:'
+        '''
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.RLock()
+        self._depth = 0  # of nested transactions
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID""")
+
+    def namespace(self, name):
+        ''' Returns a view of the store limited to given namespace. '''
+        return Namespace(self, name)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Context manager which groups writes into a single transaction,
+        committed at the end of the block (or rolled back on exception).
+        Transactions can be nested, in which case only the outermost one
+        is actually committed.
+        '''
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute("BEGIN")
+            self._depth += 1
+            try:
+                yield self
+            except:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("COMMIT")
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM items WHERE namespace = ? AND key = ?",
+                (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, namespace, key, value):
+        value = json.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO items (namespace, key, value) "
+                "VALUES (?, ?, ?)", (namespace, key, value))
+
+    def delete(self, namespace, key):
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM items WHERE namespace = ? AND key = ?",
+                (namespace, key))
+        return cursor.rowcount > 0
+
+    def scan(self, namespace, prefix=''):
+        '''
+        Retrieves items whose keys begin with given prefix.
+        @return: List of (key, value) pairs, sorted by keys
+        '''
+        query = "SELECT key, value FROM items WHERE namespace = ?"
+        params = [namespace]
+        if prefix:
+            # SQLite turns prefix GLOBs into range queries over the index
+            query += " AND key GLOB ?"
+            params.append(_glob_escape(prefix) + '*')
+        query += " ORDER BY key"
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def clear(self, namespace):
+        with self._lock:
+            self._conn.execute("DELETE FROM items WHERE namespace = ?",
+                               (namespace,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Namespace(object):
+    '''
+    Part of the key-value store which belongs to particular owner
+    (e.g. a plugin), so that its keys don't collide with others'.
+    '''
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get(self, key, default=None):
+        ''' Retrieves the value for given key, or default if it's not there. '''
+        return self.store.get(self.name, key, default)
+
+    def put(self, key, value):
+        ''' Stores the value (which must be serializable to JSON). '''
+        self.store.put(self.name, key, value)
+
+    def delete(self, key):
+        '''
+        Removes given key.
+        @return: Whether it was present
+        '''
+        return self.store.delete(self.name, key)
+
+    def scan(self, prefix=''):
+        '''
+        Retrieves items whose keys begin with given prefix
+        (or all items, if it's empty).
+        @return: List of (key, value) pairs, sorted by keys
+        '''
+        return self.store.scan(self.name, prefix)
+
+    def clear(self):
+        ''' Removes all the items. '''
+        self.store.clear(self.name)
+
+    def transaction(self):
+        ''' Context manager which groups writes into a single transaction. '''
+        return self.store.transaction()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+
+def _glob_escape(text):
+    ''' Escapes the characters which have special meaning in GLOB patterns. '''
+    return GLOB_SPECIAL_RE.sub(r'[\1]', text)
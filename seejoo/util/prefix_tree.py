@@ -8,127 +8,167 @@ A generalized prefix tree class.
 
 class PrefixTreeNode(object):
     '''
-    A generalized prefix tree node. Node contains:
-    - data (any object)
-    - links to children, each of them (i.e. links) labeled with a string
+    A node of compressed prefix (radix) tree. Node contains:
+    - label of the link from its parent (a non-empty string, except for root)
+    - data (any object), if the node ends a key stored in tree
+    - children, indexed by the first character of their labels
     '''
-    def __init__(self, data = None):
-        ''' Initializes the prefix tree node. '''
+    __slots__ = ('label', 'data', 'is_key', 'children', 'completions')
+
+    def __init__(self, label = "", data = None, is_key = False):
+        self.label = label
         self.data = data
+        self.is_key = is_key
         self.children = {}
-    
-    def _traverse(self, path):
+        self.completions = None     # memoized (key, data) pairs in subtree
+
+    def __str__(self):
+        return "%s --> (%s)" % (self.data,
+                                ",".join(c.label for c in self.children.itervalues()))
+
+
+class PrefixTree(object):
+    '''
+    A generalized prefix tree, mapping string keys to arbitrary data.
+
+    Lookups and insertions take time proportional to the length of key,
+    regardless of how many items the tree holds.
+    '''
+    def __init__(self):
+        self.root = PrefixTreeNode()
+        self.size = 0
+
+    def _find(self, key):
         '''
-        Internal function that traverses the prefix tree, searching for
-        node which lies at the end of given path.
-        Returns result of traversal which can be either a node
-        found at the end of the path or a node where a divergence
-        has been found and new node should potentially be inserted.
-        @param path: A string determining the path in tree to traverse
-        @return: 2-tuple: a node and a string path in tree that was traversed
+        Internal function that traverses the tree along given key.
+        @return: Node at the end of key, or None if there is no such node
         '''
-        if not path:    return self, ""
-        
-        node = self
-        ahead = path
-        while len(ahead) > 0:
-            # Pick a path to go down
-            for c in sorted(node.children.keys(), key = len, reverse = True):
-                if len(c) > len(ahead): continue
-                if ahead.startswith(c):
-                    node = node.children[c]
-                    ahead = ahead[len(c):]
-                    break
-            else:
-                # No path to go down;
-                # either a divergence or leaf
-                return node, path[:path.find(ahead)]
-        
-        return node, path   # Found a match
-    
-    def get(self, path):
+        node = self.root
+        i, n = 0, len(key)
+        while i < n:
+            node = node.children.get(key[i])
+            if node is None or not key.startswith(node.label, i):
+                return None
+            i += len(node.label)
+        return node
+
+    def get(self, key, default = None):
         '''
-        Retrieves an item from this node's subtree if it exists.
-        @note: This node is part of its subtree so its key should prefix
-        the parameter of this function for anything to be found
-        @return: Data of the item or None if it could not be found
+        Retrieves an item from the tree if it exists.
+        @return: Data of the item or default if it could not be found
         '''
-        node, tree_path = self._traverse(path)
-        return node.data if tree_path == path else None
-    
-    def add(self, path, data):
+        node = self._find(key)
+        return node.data if node is not None and node.is_key else default
+
+    def add(self, key, data):
         '''
-        Adds an item to this node subtree.
+        Adds an item to the tree. Existing items are not replaced.
         @return: Whether the item could be added
         '''
-        # Special case for insertion in the current node
-        if not path:
-            if self.data:   return False
-            self.data = data
-            return True
-        
-        node, tree_path = self._traverse(path)
-        if path == tree_path:   return False
-        
-        new_node = PrefixTreeNode(data)
-        
-        # Relocate nodes that should be children of the newly created one
-        rest = path[len(tree_path):]
-        to_delete = []
-        for label, child in node.children.items():
-            if label.startswith(rest):
-                new_label = label[len(rest):]
-                new_node.children[new_label] = child
-                to_delete.append(label)
-        for label in to_delete:
-            del node.children[label]
-        
-        node.children[rest] = new_node
+        node = self.root
+        path = [node]
+        i, n = 0, len(key)
+        while i < n:
+            child = node.children.get(key[i])
+            if child is None:
+                node.children[key[i]] = PrefixTreeNode(key[i:], data, True)
+                break
+
+            # Find how much of the child's label matches the key
+            label = child.label
+            j, m = 1, min(len(label), n - i)
+            while j < m and label[j] == key[i + j]:
+                j += 1
+            if j < len(label):
+                # Split the link, putting a new node where key diverges
+                split = PrefixTreeNode(label[:j])
+                child.label = label[j:]
+                split.children[child.label[0]] = child
+                node.children[key[i]] = split
+                if i + j == n:
+                    split.data, split.is_key = data, True
+                else:
+                    split.children[key[i + j]] = PrefixTreeNode(key[i + j:],
+                                                                data, True)
+                break
+
+            node = child
+            path.append(node)
+            i += j
+        else:
+            if node.is_key:     return False
+            node.data, node.is_key = data, True
+
+        self.size += 1
+        for node in path:
+            node.completions = None
         return True
-    
+
+    def _completions(self, node, key):
+        '''
+        Internal function which returns (memoized) list of items
+        from the subtree of given node, sorted by their keys.
+        @param key: Key corresponding to the node
+        @return: List of (key, data) pairs
+        '''
+        if node.completions is None:
+            items = [(key, node.data)] if node.is_key else []
+            for c in sorted(node.children):
+                child = node.children[c]
+                items.extend(self._completions(child, key + child.label))
+            node.completions = items
+        return node.completions
+
+    def _search(self, prefix):
+        '''
+        Internal function that finds all items whose keys begin
+        with given prefix.
+        @return: List of (key, data) pairs, sorted by keys
+        '''
+        node = self.root
+        i, n = 0, len(prefix)
+        while i < n:
+            node = node.children.get(prefix[i])
+            if node is None:
+                return []
+            label = node.label
+            if n - i <= len(label):
+                if not label.startswith(prefix[i:]):
+                    return []
+                return self._completions(node, prefix[:i] + label)
+            if not prefix.startswith(label, i):
+                return []
+            i += len(label)
+        return self._completions(node, prefix)
+
     def search(self, prefix):
         '''
-        Searches for all nodes that match given prefix.
-        @return: A dictionary of matches, with values being data
-        of nodes found
+        Searches for all items whose keys begin with given prefix.
+        @return: A dictionary of matches, with values being data of items
         '''
-        res = {}
-        node, path = self._traverse(prefix)
-        
-        # Do a DFS from given node
-        stack = [(path, node)]
-        while len(stack) > 0:
-            curr_prefix, curr_node = stack.pop()
-            rest = prefix[len(curr_prefix):]
-            if rest:
-                # Keep looking: try child nodes,
-                # but only those that go along the path of the search prefix
-                for child_label, child_node in curr_node.children.items():
-                    if child_label.startswith(rest) or rest.startswith(child_label):
-                        stack.append((curr_prefix + child_label, child_node))
-            else:
-                # This path is exhausted so we reached at some viable search result
-                res[curr_prefix] = curr_node
-                
-        return res
-            
+        return dict(self._search(prefix))
+
+    def completions(self, prefix):
+        '''
+        Finds all keys which begin with given prefix.
+        @return: Sorted list of keys
+        '''
+        return [key for key, _ in self._search(prefix)]
+
     def __contains__(self, key):
         ''' 'in' operator. '''
-        try:
-            self.__getitem__(key)
-            return True
-        except KeyError:
-            return False
-    
+        node = self._find(key)
+        return node is not None and node.is_key
+
     def __getitem__(self, key):
         ''' Indexing operator. '''
-        node, tree_path = self._traverse(key)
-        if tree_path == key:    return node.data
-        else:                   raise KeyError, key
-        
-    def __str__(self):
-        return "%s --> (%s)" % (self.data, ",".join(self.children.keys()))
-    
+        node = self._find(key)
+        if node is not None and node.is_key:    return node.data
+        else:                                   raise KeyError, key
+
+    def __iter__(self):
+        ''' Iterates over keys of the tree, in sorted order. '''
+        return iter(self.completions(""))
 
-# Tree is just its root node
-PrefixTree = PrefixTreeNode
+    def __len__(self):
+        return self.size
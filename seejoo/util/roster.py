@@ -0,0 +1,199 @@
+'''
+In-memory roster of channels that the bot is on:
+who is in them, with what modes and hostmasks.
+
+Nicks and channel names are compared according to IRC case mapping,
+so that lookups work regardless of how the names were spelled.
+Strings are interned, since the same nicks and modes repeat a lot.
+'''
+from seejoo.util.irc import DEFAULT_CASEMAPPING, irc_lower, parse_hostmask
+
+
+def _intern(s):
+    return intern(s) if type(s) is str else s
+
+
+class User(object):
+    ''' User who is on at least one of the channels. '''
+    __slots__ = ('nick', 'hostmask', 'modes')
+
+    def __init__(self, nick, hostmask=None):
+        self.nick = nick
+        self.hostmask = hostmask
+        self.modes = {}  # channel key -> modes (such as 'o' or 'ov')
+
+
+class Channel(object):
+    ''' Channel along with its members. '''
+    __slots__ = ('name', 'members')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # nick key -> User
+
+
+class Roster(object):
+    '''
+    Roster of channels, kept up to date with the users joining them,
+    leaving them and changing nicks or modes.
+
+    Membership checks and lookups of users take constant time.
+    '''
+    def __init__(self, casemapping=DEFAULT_CASEMAPPING):
+        self.casemapping = casemapping
+        self._channels = {}  # channel key -> Channel
+        self._users = {}  # nick key -> User
+
+    def _key(self, name):
+        return _intern(irc_lower(name, self.casemapping))
+
+    # Updating
+
+    def add_channel(self, channel):
+        ''' Starts tracking a channel (which bot has just joined). '''
+        self.remove_channel(channel)
+        self._channels[self._key(channel)] = Channel(_intern(channel))
+
+    def remove_channel(self, channel):
+        ''' Stops tracking a channel, forgetting its members
+        unless they are also on other channels.
+        '''
+        chan_key = self._key(channel)
+        chan = self._channels.pop(chan_key, None)
+        if chan is None:
+            return
+        for nick_key, user in chan.members.iteritems():
+            del user.modes[chan_key]
+            if not user.modes:
+                del self._users[nick_key]
+
+    def add(self, channel, nick, modes='', hostmask=None):
+        ''' Adds a user to the channel. '''
+        chan_key = self._key(channel)
+        chan = self._channels.get(chan_key)
+        if chan is None:
+            return  # not a channel we're on
+
+        nick_key = self._key(nick)
+        user = self._users.get(nick_key)
+        if user is None:
+            user = self._users[nick_key] = User(_intern(nick))
+        if hostmask:
+            user.hostmask = hostmask
+        user.modes[chan_key] = _intern(modes)
+        chan.members[nick_key] = user
+
+    def remove(self, channel, nick):
+        ''' Removes a user from the channel. '''
+        chan_key, nick_key = self._key(channel), self._key(nick)
+        chan = self._channels.get(chan_key)
+        if chan is None:
+            return
+        user = chan.members.pop(nick_key, None)
+        if user is None:
+            return
+        del user.modes[chan_key]
+        if not user.modes:
+            del self._users[nick_key]
+
+    def remove_user(self, nick):
+        ''' Removes a user from all channels (e.g. when they quit IRC).
+        @return: List of channels that user was on
+        '''
+        nick_key = self._key(nick)
+        user = self._users.pop(nick_key, None)
+        if user is None:
+            return []
+
+        channels = []
+        for chan_key in user.modes:
+            chan = self._channels[chan_key]
+            del chan.members[nick_key]
+            channels.append(chan.name)
+        return channels
+
+    def rename(self, old, new):
+        ''' Changes the nick of a user. '''
+        old_key, new_key = self._key(old), self._key(new)
+        user = self._users.pop(old_key, None)
+        if user is None:
+            return
+
+        user.nick = _intern(new)
+        if user.hostmask:
+            user.hostmask = parse_hostmask(
+                "%s!%s@%s" % (new, user.hostmask.id, user.hostmask.host))
+        self._users[new_key] = user
+        for chan_key in user.modes:
+            members = self._channels[chan_key].members
+            del members[old_key]
+            members[new_key] = user
+
+    def set_mode(self, channel, nick, mode, set=True):
+        ''' Sets or unsets user's mode (such as 'o' or 'v') on the channel. '''
+        chan_key = self._key(channel)
+        user = self._users.get(self._key(nick))
+        if user is None or chan_key not in user.modes:
+            return
+
+        modes = user.modes[chan_key]
+        if set and mode not in modes:
+            modes += mode
+        elif not set:
+            modes = modes.replace(mode, '')
+        user.modes[chan_key] = _intern(modes)
+
+    def set_hostmask(self, nick, hostmask):
+        ''' Sets the hostmask of user, if they are on any of the channels. '''
+        user = self._users.get(self._key(nick))
+        if user is not None:
+            user.hostmask = hostmask
+
+    # Querying
+
+    def is_on(self, channel, nick):
+        ''' Checks whether user is on given channel. '''
+        chan = self._channels.get(self._key(channel))
+        return chan is not None and self._key(nick) in chan.members
+
+    def get_nicks(self, channel):
+        ''' Returns the list of nicks of users on given channel. '''
+        chan = self._channels.get(self._key(channel))
+        if chan is None:
+            return []
+        return [user.nick for user in chan.members.itervalues()]
+
+    def get_modes(self, channel, nick):
+        '''
+        Retrieves the modes of user on given channel.
+        @return: String of mode characters (possibly empty),
+                 or None if user is not on the channel
+        '''
+        user = self._users.get(self._key(nick))
+        return user.modes.get(self._key(channel)) if user else None
+
+    def get_hostmask(self, nick):
+        '''
+        Retrieves the hostmask of user (util.irc.Hostmask).
+        @return: Hostmask, or None if it's not known
+        '''
+        user = self._users.get(self._key(nick))
+        return user.hostmask if user else None
+
+    def get_channels(self, nick):
+        ''' Returns the list of channels that user is on. '''
+        user = self._users.get(self._key(nick))
+        if user is None:
+            return []
+        return [self._channels[chan_key].name for chan_key in user.modes]
+
+    def __contains__(self, channel):
+        ''' 'in' operator: whether the channel is being tracked. '''
+        return self._key(channel) in self._channels
+
+    def __iter__(self):
+        ''' Iterates over the names of channels. '''
+        return (chan.name for chan in self._channels.itervalues())
+
+    def __len__(self):
+        return len(self._channels)
@@ -0,0 +1,172 @@
+'''
+Scheduler of delayed and periodic calls.
+
+Pending calls are kept in a heap ordered by their time, and only the
+earliest one is scheduled in the reactor. This way, any number of timers
+costs a single delayed call, and adding or cancelling one is O(log n).
+'''
+import heapq
+import itertools
+import logging
+import random
+
+from twisted.internet import defer, reactor
+
+
+class Timer(object):
+    ''' Call of a function scheduled at some time,
+    possibly repeated at regular intervals.
+    '''
+    __slots__ = ('scheduler', 'time', 'func', 'interval', 'jitter',
+                 'cancelled', 'pending')
+
+    def __init__(self, scheduler, time, func, interval=None, jitter=0):
+        self.scheduler = scheduler
+        self.time = time
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.cancelled = False
+        self.pending = False  # whether it's on scheduler's heap
+
+    def cancel(self):
+        ''' Cancels the call (and its repetitions). '''
+        if not self.cancelled:
+            self.cancelled = True
+            if self.pending:
+                self.scheduler._cancelled += 1
+
+    @property
+    def active(self):
+        ''' Whether the call is still going to happen. '''
+        return self.pending and not self.cancelled
+
+    def __repr__(self):
+        return "<Timer %r at %s%s>" % (
+            self.func, self.time,
+            " every %ss" % self.interval if self.interval else "")
+
+
+class Scheduler(object):
+    '''
+    Schedules calls of functions after some delay, or periodically.
+    Functions are called in the reactor thread.
+    '''
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self._heap = []  # (time, sequence number, timer) triples
+        self._sequence = itertools.count()  # keeps timers with same time FIFO
+        self._cancelled = 0  # timers cancelled but still on heap
+        self._call = None  # delayed call for the earliest timer
+
+    def schedule(self, delay, func):
+        '''
+        Schedules a function to be called after given number of seconds.
+        @return: Timer, which can be used to cancel the call
+        '''
+        timer = Timer(self, self.clock.seconds() + delay, func)
+        self._push(timer)
+        return timer
+
+    def every(self, interval, func, jitter=0, delay=None):
+        '''
+        Schedules a function to be called repeatedly.
+        @param interval: Number of seconds between calls
+        @param jitter: Maximum number of seconds randomly added
+                       to every interval, so that timers with the same
+                       intervals don't all fire at once
+        @param delay: Number of seconds before the first call
+                      (by default, the interval plus jitter)
+        @return: Timer, which can be used to cancel the calls
+        '''
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if delay is None:
+            delay = interval + random.uniform(0, jitter)
+        timer = Timer(self, self.clock.seconds() + delay, func,
+                      interval, jitter)
+        self._push(timer)
+        return timer
+
+    def stop(self):
+        ''' Cancels all the pending calls. '''
+        for _, _, timer in self._heap:
+            timer.cancelled = True
+            timer.pending = False
+        self._heap = []
+        self._cancelled = 0
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def __len__(self):
+        ''' Number of pending (not cancelled) timers. '''
+        return len(self._heap) - self._cancelled
+
+    def _push(self, timer):
+        timer.pending = True
+        heapq.heappush(self._heap, (timer.time, next(self._sequence), timer))
+        if self._heap[0][2] is timer:
+            self._reschedule()
+
+    def _reschedule(self):
+        ''' Schedules the delayed call of earliest timer in the reactor. '''
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)[2].pending = False
+            self._cancelled -= 1
+
+        if self._call and self._call.active():
+            if self._heap and self._call.getTime() == self._heap[0][0]:
+                return
+            self._call.cancel()
+        self._call = None
+
+        if self._heap:
+            delay = max(0, self._heap[0][0] - self.clock.seconds())
+            self._call = self.clock.callLater(delay, self._run)
+
+    def _run(self):
+        ''' Calls the functions of timers which are due. '''
+        self._call = None
+        now = self.clock.seconds()
+
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self._heap)
+            timer.pending = False
+            if timer.cancelled:
+                self._cancelled -= 1
+                continue
+            due.append(timer)
+            if timer.interval:
+                timer.time = now + timer.interval + random.uniform(
+                    0, timer.jitter)
+                timer.pending = True
+                heapq.heappush(self._heap,
+                               (timer.time, next(self._sequence), timer))
+
+        # Get rid of cancelled timers once they make up most of the heap
+        if self._cancelled > len(self._heap) // 2:
+            for _, _, timer in self._heap:
+                if timer.cancelled:
+                    timer.pending = False
+            self._heap = [entry for entry in self._heap
+                          if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+        for timer in due:
+            if not timer.cancelled:  # by functions called before
+                self._call_timer(timer)
+        self._reschedule()
+
+    def _call_timer(self, timer):
+        try:
+            result = timer.func()
+        except Exception:
+            logging.exception("Error in scheduled call of %r", timer.func)
+            return
+        if isinstance(result, defer.Deferred):
+            result.addErrback(lambda failure: logging.error(
+                "Error in scheduled call of %r: %s",
+                timer.func, failure.getTraceback()))
@@ -39,3 +39,29 @@ def strip_html(data):
     data = strip_html_entities(data)
     data = normalize_whitespace(data)
     return data
+
+
+def edit_distance(a, b, max_distance=None):
+    '''
+    Computes the Levenshtein distance between two strings, i.e. the number
+    of character insertions, deletions and substitutions needed
+    to turn one into another.
+    @param max_distance: Optional bound for the distance. If it's exceeded,
+                         computation stops early and max_distance + 1
+                         is returned
+    '''
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
@@ -0,0 +1,298 @@
+'''
+Pool of pre-forked worker processes, for computations which are
+too risky to perform in the bot's own process (e.g. evaluating
+expressions given by users).
+
+Workers are started ahead of time and reused, so that requests don't
+have to wait for a fork. They run under resource limits, and the reactor
+talks to them asynchronously. Requests are queued per key (such as user)
+and served in turns, so that nobody can starve the others.
+'''
+from collections import deque, OrderedDict
+from multiprocessing import Process, Pipe
+import logging
+import os
+import signal
+
+from twisted.internet import defer, reactor, threads
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not on Unix, so no limits can be imposed
+
+
+class QueueFull(Exception):
+    ''' Raised when too many requests with the same key are waiting. '''
+
+
+class WorkerDied(Exception):
+    ''' Raised when worker has exited (e.g. because it exceeded
+    its CPU time limit) while processing the request.
+    '''
+
+
+def _worker_main(conn, func, initializer, cpu_limit, memory_limit):
+    '''
+    Main function of worker process. Receives requests through
+    the connection, passes them to the function and sends back
+    its results. Continues until the connection is closed.
+    '''
+    # Interrupting the bot shouldn't take its workers down in the middle
+    # of a request; they are stopped along with the bot anyway
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if resource and memory_limit:
+        size = _address_space_size()
+        if size is not None:
+            limit = size + memory_limit
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if initializer:
+        initializer()
+
+    while True:
+        try:                request = conn.recv()
+        except EOFError:    return
+
+        if resource and cpu_limit:
+            # CPU time adds up over the worker's whole life,
+            # so the limit has to be moved forward for every request
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime) + 1
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = used + cpu_limit
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+        conn.send(func(request))
+
+
+def _address_space_size():
+    ''' Returns the size of process' virtual memory in bytes,
+    or None if it cannot be determined.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize()
+
+
+@implementer(IReadDescriptor)
+class _Worker(object):
+    ''' Worker process, along with the request it's processing. '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.job = None  # (key, Deferred) of the request being processed
+        self.timeout = None  # delayed call which fires if it takes too long
+
+        self.conn, child_conn = Pipe()
+        self.process = Process(name=pool.name, target=_worker_main,
+                               args=(child_conn, pool.func, pool.initializer,
+                                     pool.cpu_limit, pool.memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()  # so that we notice when worker exits
+        reactor.addReader(self)
+
+    def send(self, request):
+        self.conn.send(request)
+
+    def kill(self):
+        reactor.removeReader(self)
+        self.conn.close()
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+        threads.deferToThread(self.process.join)  # reap it without blocking
+
+    # IReadDescriptor
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def doRead(self):
+        try:
+            result = self.conn.recv()
+        except (EOFError, IOError):
+            self.pool._lost(self, WorkerDied(
+                "worker %s has exited" % self.process.pid))
+            return
+        self.pool._finished(self, result)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return "%s-%s" % (self.pool.name, self.process.pid)
+
+
+class WorkerPool(object):
+    '''
+    Pool of worker processes which call a function on requests.
+    Requests and results are sent between processes, so they must be
+    picklable (and should be small).
+
+    Every key can have only one request processed at a time, while
+    the remaining ones wait in its queue. Idle workers take requests
+    from the queues of different keys in turns.
+    '''
+    def __init__(self, func, size=2, timeout=5, cpu_limit=None,
+                 memory_limit=None, initializer=None, max_queued=3,
+                 name="seejoo_worker", clock=reactor):
+        '''
+        @param func: Function called in workers for every request
+        @param size: Number of worker processes
+        @param timeout: Number of seconds after which the request fails
+                        with defer.TimeoutError, and its worker is replaced
+        @param cpu_limit: Number of seconds of CPU time that a request
+                          can take before its worker is killed
+        @param memory_limit: Number of bytes of memory that worker
+                             can allocate, on top of what it started with
+        @param initializer: Function called in every worker once,
+                            before it starts processing requests
+        @param max_queued: Maximum number of requests waiting in the queue
+                           of a single key; over that, QueueFull is raised
+        '''
+        self.func = func
+        self.size = size
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.initializer = initializer
+        self.max_queued = max_queued
+        self.name = name
+        self.clock = clock
+
+        self._running = False
+        self._workers = []
+        self._idle = deque()
+        self._queues = OrderedDict()  # key -> deque of (request, Deferred)
+        self._busy_keys = set()  # keys with a request being processed
+
+    def start(self):
+        ''' Starts the worker processes, if they aren't running yet. '''
+        self._running = True
+        while len(self._workers) < self.size:
+            self._spawn()
+
+    def stop(self):
+        ''' Kills the worker processes, cancelling all the requests. '''
+        self._running = False
+        jobs = []
+        for worker in self._workers:
+            if worker.job:
+                jobs.append(self._release(worker))
+            worker.kill()
+        for queue in self._queues.itervalues():
+            jobs.extend(queue)
+        self._workers = []
+        self._idle.clear()
+        self._queues.clear()
+
+        for _, d in jobs:
+            d.cancel()
+
+    def submit(self, request, key=None):
+        '''
+        Queues a request to be processed by one of the workers.
+        Pool is started if necessary.
+        @param key: Key of the queue (e.g. user making the request)
+        @return: Deferred with function's result
+        '''
+        if not self._running:
+            self.start()
+
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        elif len(queue) >= self.max_queued:
+            return defer.fail(QueueFull(
+                "%s requests of %r waiting already" % (len(queue), key)))
+
+        d = defer.Deferred()
+        queue.append((request, d))
+        self._dispatch()
+        return d
+
+    def __len__(self):
+        ''' Number of requests waiting in the queues. '''
+        return sum(len(queue) for queue in self._queues.itervalues())
+
+    def _create_worker(self):
+        return _Worker(self)
+
+    def _spawn(self):
+        if not self._running or len(self._workers) >= self.size:
+            return
+        worker = self._create_worker()
+        self._workers.append(worker)
+        self._idle.append(worker)
+        self._dispatch()
+
+    def _dispatch(self):
+        ''' Hands over the waiting requests to idle workers. '''
+        while self._idle:
+            key = next((k for k in self._queues
+                        if k not in self._busy_keys), self._queues)
+            if key is self._queues:
+                return  # nothing waiting, or only for keys that are busy
+
+            queue = self._queues.pop(key)
+            request, d = queue.popleft()
+            if queue:
+                self._queues[key] = queue  # at the end, to wait for its turn
+
+            worker = self._idle.popleft()
+            worker.job = (key, d)
+            worker.timeout = self.clock.callLater(self.timeout,
+                                                  self._timed_out, worker)
+            self._busy_keys.add(key)
+            try:
+                worker.send(request)
+            except (IOError, OSError), e:
+                self._lost(worker, WorkerDied(str(e)))
+
+    def _release(self, worker):
+        ''' Detaches the request from the worker.
+        @return: (key, Deferred) of the request
+        '''
+        key, d = worker.job
+        worker.job = None
+        if worker.timeout.active():
+            worker.timeout.cancel()
+        worker.timeout = None
+        self._busy_keys.discard(key)
+        return key, d
+
+    def _finished(self, worker, result):
+        _, d = self._release(worker)
+        self._idle.append(worker)
+        self._dispatch()
+        d.callback(result)
+
+    def _timed_out(self, worker):
+        self._lost(worker, defer.TimeoutError(
+            "request took more than %ss" % self.timeout))
+
+    def _lost(self, worker, error):
+        ''' Gets rid of worker which cannot be used anymore,
+        failing its request and starting a replacement in background.
+        '''
+        job = self._release(worker) if worker.job else None
+        if not job:
+            logging.warning("Idle worker of %s pool lost: %s", self.name, error)
+
+        worker.kill()
+        self._workers.remove(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        self.clock.callLater(0, self._spawn)
+
+        self._dispatch()
+        if job:
+            job[1].errback(error)
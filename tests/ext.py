@@ -0,0 +1,163 @@
+'''
+Contains unit tests for the extensions module.
+'''
+import unittest
+
+from twisted.internet import defer
+
+from seejoo import events, ext
+
+
+class JoinListener(ext.Plugin):
+    def join(self, bot, channel, user):
+        return 'join'
+
+
+class HostmaskListener(ext.Plugin):
+    def join(self, bot, channel, user, hostmask):
+        return hostmask
+
+
+class CommandPlugin(ext.Plugin):
+    commands = {'foo': "Foo command"}
+
+    def command(self, bot, channel, user, cmd, args):
+        return 'foo'
+
+
+class CommandListener(ext.Plugin):
+    def command(self, bot, channel, user, cmd, args):
+        return 'any'
+
+
+class AsyncCommandPlugin(ext.Plugin):
+    commands = {'foo': "Foo command"}
+
+    def command(self, bot, channel, user, cmd, args):
+        result = yield defer.succeed(cmd.upper())
+        defer.returnValue(result)
+
+
+class QuitListener(ext.Plugin):
+    def __init__(self):
+        self.quits = []
+
+    def quit(self, bot, user, message):
+        self.quits.append(user)
+
+
+class NetsplitListener(QuitListener):
+    def netsplit(self, bot, servers, users, hostmasks):
+        self.quits.append(users)
+
+
+@ext.cacheable(60)
+class CacheablePlugin(ext.Plugin):
+    commands = {'foo': "Foo command"}
+
+    def __init__(self):
+        self.calls = 0
+
+    def command(self, bot, channel, user, cmd, args):
+        self.calls += 1
+        return self.calls
+
+
+@ext.cacheable(60)
+class FlakyPlugin(CacheablePlugin):
+    def command(self, bot, channel, user, cmd, args):
+        self.calls += 1
+        if self.calls == 1:
+            return ext.uncached("Not available")
+        if self.calls == 2:
+            raise IOError("Not available")
+        return self.calls
+
+
+class PluginEventsTest(unittest.TestCase):
+
+    def tearDown(self):
+        for plugin in list(ext._plugins):
+            ext.unregister_plugin(plugin)
+
+    def test_overridden_methods(self):
+        plugin = JoinListener()
+        self.assertEquals(ext.get_plugin_events(plugin), frozenset(['join']))
+
+    def test_function_plugin(self):
+        def func_plugin(bot, event, **kwargs):
+            pass
+        self.assertEquals(ext.get_plugin_events(func_plugin),
+                          frozenset(ext.EVENTS) - ext.BATCH_EVENTS)
+
+        func_plugin.events = ('tick',)
+        self.assertEquals(ext.get_plugin_events(func_plugin),
+                          frozenset(['tick']))
+
+    def test_optional_args(self):
+        for plugin in (JoinListener(), HostmaskListener()):
+            ext.register_plugin(plugin)
+
+        event = events.Join('#c', 'nick', hostmask='mask')
+        results = [handler(None, event)
+                   for _, handler in ext._subscribers['join']]
+        self.assertEquals(results, ['join', 'mask'])
+
+    def test_subscribers(self):
+        plugin = JoinListener()
+        ext.register_plugin(plugin)
+        self.assertEquals(len(ext._subscribers['join']), 1)
+        self.assertEquals(ext._subscribers['message'], [])
+
+        ext.unregister_plugin(plugin)
+        self.assertEquals(ext._subscribers['join'], [])
+
+    def test_batch_events(self):
+        quit_listener, netsplit_listener = QuitListener(), NetsplitListener()
+        for plugin in (quit_listener, netsplit_listener):
+            ext.register_plugin(plugin)
+
+        ext.notify(None, events.Netsplit('a.net b.net', ('foo', 'bar'),
+                                         (None, None)))
+        self.assertEquals(quit_listener.quits, ['foo', 'bar'])
+        self.assertEquals(netsplit_listener.quits, [('foo', 'bar')])
+
+    def test_command_routing(self):
+        ext.register_plugin(CommandPlugin())
+        ext.register_plugin(CommandListener())
+
+        self.assertEquals(notify_command('foo'), ['foo', 'any'])
+        self.assertEquals(notify_command('bar'), ['any'])
+
+    def test_async_command(self):
+        ext.register_plugin(AsyncCommandPlugin())
+        self.assertEquals(notify_command('foo'), ['FOO'])
+
+    def test_cached_command(self):
+        plugin = CacheablePlugin()
+        ext.register_plugin(plugin)
+
+        self.assertEquals(notify_command('foo', 'bar'), [1])
+        self.assertEquals(notify_command('foo', ' bar '), [1])
+        self.assertEquals(notify_command('foo', 'baz'), [2])
+        self.assertEquals(notify_command('foo', 'bar', nocache=True), [3])
+        self.assertEquals(notify_command('foo', 'bar'), [3])
+
+    def test_failures_not_cached(self):
+        plugin = FlakyPlugin()
+        ext.register_plugin(plugin)
+
+        self.assertEquals(notify_command('foo', 'bar'), ["Not available"])
+        self.assertEquals(notify_command('foo', 'bar'), None)  # error
+        self.assertEquals(notify_command('foo', 'bar'), [3])
+        self.assertEquals(notify_command('foo', 'bar'), [3])
+        self.assertEquals(plugin.calls, 3)
+
+
+def notify_command(cmd, args=None, **kwargs):
+    ''' Notifies plugins about a command and returns their results. '''
+    results = []
+    d = ext.notify(None, 'command',
+                   channel=None, user='nick', cmd=cmd, args=args, **kwargs)
+    d.addCallback(results.append)
+    return results[0]
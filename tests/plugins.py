@@ -0,0 +1,205 @@
+'''
+Contains unit tests for plugins.
+'''
+from datetime import datetime, timedelta
+import unittest
+
+from twisted.internet import defer, task
+
+from seejoo import ext
+from seejoo.util.kvstore import KeyValueStore
+from seejoo.util.scheduler import Scheduler
+
+# Plugins are instantiated on import, so they shouldn't get
+# the real storage in user's home directory
+if ext._storage is None:
+    ext._storage = KeyValueStore(':memory:')
+
+from seejoo.plugins import rss, urlspy
+
+
+def make_feed(*items):
+    ''' Creates content of RSS feed with items given as (guid, pubDate). '''
+    return "<rss><channel><title>Feed</title>%s</channel></rss>" % "".join(
+        "<item><title>Item %s</title><guid>%s</guid>"
+        "<pubDate>%s</pubDate></item>" % (guid, guid, date)
+        for guid, date in items)
+
+
+class RssParsingTest(unittest.TestCase):
+
+    FEED = make_feed(('4', "Thu, 01 Jan 2015 04:00:00 +0000"),
+                     ('3', "Thu, 01 Jan 2015 03:00:00 +0000"),
+                     ('2', "Thu, 01 Jan 2015 02:00:00 +0000"),
+                     ('1', "Thu, 01 Jan 2015 01:00:00 +0000"))
+
+    def guids(self, items):
+        return [item['guid'] for item in items]
+
+    def test_all_items(self):
+        items = rss.get_new_items(self.FEED)
+        self.assertEquals(self.guids(items), ['4', '3', '2', '1'])
+        self.assertEquals(items[0]['pubDate'], datetime(2015, 1, 1, 4))
+
+    def test_until_last_item(self):
+        items = rss.get_new_items(
+            self.FEED, until=lambda item: item['guid'] == '2')
+        self.assertEquals(self.guids(items), ['4', '3'])
+
+    def test_until_older_item(self):
+        min_date = datetime(2015, 1, 1, 2, 30)
+        items = rss.get_new_items(
+            self.FEED, until=lambda item: item['pubDate'] < min_date)
+        self.assertEquals(self.guids(items), ['4', '3'])
+
+    def test_stops_in_document_order(self):
+        # items after the last seen one are older, even if they claim not to be
+        feed = make_feed(('2', "Thu, 01 Jan 2015 02:00:00 +0000"),
+                         ('1', "Thu, 01 Jan 2015 01:00:00 +0000"),
+                         ('3', "Thu, 01 Jan 2015 03:00:00 +0000"))
+        items = rss.get_new_items(feed, until=lambda item: item['guid'] == '1')
+        self.assertEquals(self.guids(items), ['2'])
+
+    def test_sorted_by_date(self):
+        feed = make_feed(('1', "Thu, 01 Jan 2015 01:00:00 +0000"),
+                         ('x', "not a date"),
+                         ('2', "Thu, 01 Jan 2015 02:00:00 +0000"))
+        items = rss.get_new_items(feed)
+        self.assertEquals(self.guids(items), ['2', '1', 'x'])
+        self.assertNotIn('pubDate', items[2])
+
+    def test_truncated_feed(self):
+        content = self.FEED[:self.FEED.index('<guid>2')]
+        self.assertEquals(self.guids(rss.get_new_items(content)), ['4', '3'])
+
+    def test_rfc822_dates(self):
+        self.assertEquals(rss.parse_pub_date("Thu, 01 Jan 2015 12:00:00 +0100"),
+                          datetime(2015, 1, 1, 11))
+        self.assertEquals(rss.parse_pub_date("Thu, 01 Jan 2015 12:00:00 GMT"),
+                          datetime(2015, 1, 1, 12))
+
+    def test_other_dates(self):
+        self.assertEquals(rss.parse_pub_date("2015-01-01T12:00:00+01:00"),
+                          datetime(2015, 1, 1, 11))
+        self.assertEquals(rss.parse_pub_date("2015-01-01 12:00"),
+                          datetime(2015, 1, 1, 12))
+        self.assertIsNone(rss.parse_pub_date("not a date"))
+        self.assertIsNone(rss.parse_pub_date(None))
+
+
+class FakeBot(object):
+    def __init__(self, clock):
+        self.channels = set()
+        self.schedule = Scheduler(clock).schedule
+
+
+class RssPollingTest(unittest.TestCase):
+
+    INTERVAL = 60  # seconds
+    JITTER = INTERVAL * rss.POLL_JITTER
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.plugin = rss.Rss()
+        self.plugin.storage.clear()
+        self.fetches = []
+        self.failing = True
+        self.fetch_rss_feed = rss.fetch_rss_feed
+        rss.fetch_rss_feed = self.fetch
+
+    def tearDown(self):
+        rss.fetch_rss_feed = self.fetch_rss_feed
+
+    def fetch(self, url, state):
+        self.fetches.append(self.clock.seconds())
+        state['last_fetch_duration'] = 0.5
+        if self.failing:
+            return defer.fail(IOError("Feed not available"))
+        return defer.succeed(None)  # not modified
+
+    def init(self):
+        self.plugin.init(FakeBot(self.clock), {'feeds': [{
+            'name': 'F', 'url': 'http://example.com/feed',
+            'frequency': '%s seconds' % self.INTERVAL}]})
+
+    def poll(self):
+        ''' Advances the clock until the next poll,
+        returning the number of seconds it took.
+        '''
+        count = len(self.fetches)
+        start = self.clock.seconds()
+        while len(self.fetches) == count:
+            self.clock.advance(1)
+        return self.fetches[-1] - start
+
+    def assertInterval(self, interval, expected):
+        self.assertTrue(expected <= interval <= expected + self.JITTER + 1,
+                        "%s is not about %s" % (interval, expected))
+
+    def test_backoff(self):
+        self.init()
+        self.poll()
+        for failures in xrange(1, 4):
+            self.assertEquals(self.plugin.get_stats()['F']['failures'],
+                              failures)
+            self.assertInterval(self.poll(), self.INTERVAL * 2 ** failures)
+
+        self.failing = False
+        self.assertInterval(self.poll(), self.INTERVAL * 2 ** 4)
+        self.assertEquals(self.plugin.get_stats()['F']['failures'], 0)
+        self.assertInterval(self.poll(), self.INTERVAL)
+
+    def test_max_backoff(self):
+        self.init()
+        for _ in xrange(10):
+            interval = self.poll()
+        self.assertInterval(interval, rss.MAX_POLL_BACKOFF)
+
+    def test_stats(self):
+        self.init()
+        self.poll()
+        stats = self.plugin.get_stats()['F']
+        self.assertEquals(stats['last_fetch_duration'], 0.5)
+        self.assertEquals(stats['failures'], 1)
+
+        now = stats['next_poll'] - timedelta(seconds=90)
+        self.assertEquals(rss.format_feed_stats('F', stats, now),
+                          "F: next poll in 0:01:30, last fetch took 0.50s, "
+                          "1 failed poll(s) in a row")
+        self.assertEquals(
+            self.plugin.command(None, None, 'nick', 'feeds', 'G'),
+            "Unknown feed 'G'.")
+
+
+class PageCharsetTest(unittest.TestCase):
+
+    TITLE = u"Za\u017c\xf3\u0142\u0107 g\u0119\u015bl\u0105 ja\u017a\u0144"
+
+    def parse(self, page, charset=None, chunk_size=64):
+        parser = urlspy.PageInfoParser(urlspy.PAGE_ELEMENTS, charset)
+        for i in xrange(0, len(page), chunk_size):
+            if parser.feed_chunk(page[i:i + chunk_size]):
+                break
+        parser.finish()
+        return parser.found.get('title')
+
+    def page(self, head, charset, padding=0):
+        return (u"<html><head>%s<title>%s</title></head><body>%s</body></html>"
+                % (head, self.TITLE, u"x" * padding)).encode(charset)
+
+    def test_meta_charset(self):
+        page = self.page(u'<meta charset="iso-8859-2">', 'iso-8859-2')
+        self.assertEquals(self.parse(page), self.TITLE)
+
+    def test_meta_http_equiv(self):
+        page = self.page(u'<meta http-equiv="Content-Type" '
+                         u'content="text/html; charset=ISO-8859-2">',
+                         'iso-8859-2', padding=4 * urlspy.CHARSET_SNIFF_BYTES)
+        self.assertEquals(self.parse(page), self.TITLE)
+
+    def test_header_charset_first(self):
+        page = self.page(u'<meta charset="iso-8859-2">', 'utf-8')
+        self.assertEquals(self.parse(page, charset='utf-8'), self.TITLE)
+
+    def test_default_charset(self):
+        self.assertEquals(self.parse(self.page(u'', 'utf-8')), self.TITLE)
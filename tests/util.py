@@ -5,15 +5,34 @@ Created on 2011-06-12
 
 Contains unit tests for utility module.
 '''
+import os
+import shutil
+import tempfile
 import unittest
-from seejoo.util.prefix_tree import PrefixTreeNode
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.words.protocols.irc import ServerSupportedFeatures
+
+from seejoo.util import http, irc
+from seejoo.util.bk_tree import BKTree
+from seejoo.util.cache import LRUCache, SingleFlight
+from seejoo.util.journal import Journal
+from seejoo.util.kvstore import KeyValueStore
+from seejoo.util.prefix_tree import PrefixTree
+from seejoo.util.roster import Roster
+from seejoo.util.scheduler import Scheduler
+from seejoo.util.strings import edit_distance
+from seejoo.util.workers import QueueFull, WorkerPool
 
 
 class PrefixTreeTest(unittest.TestCase):
     TEST_ITEMS = { 'abc': 1, 'abcd': 2, 'a': 3, 'ab': 4, '': 5 }
 
     def test_prefixtree(self):
-        tree = PrefixTreeNode()
+        tree = PrefixTree()
 
         for key, data in self.TEST_ITEMS.items():
             tree.add(key, data)
@@ -22,3 +41,449 @@ class PrefixTreeTest(unittest.TestCase):
             self.assertEquals(tree.get(key), data)
 
         print tree.search('a')
+
+    def test_search(self):
+        tree = PrefixTree()
+        for key in ('google', 'googlefight', 'gc', 'help', 'hello'):
+            self.assertTrue(tree.add(key, key.upper()))
+        self.assertFalse(tree.add('help', None))
+
+        self.assertEquals(tree.completions('goo'), ['google', 'googlefight'])
+        self.assertEquals(tree.search('hel'), {'help': 'HELP', 'hello': 'HELLO'})
+        self.assertEquals(tree.completions('x'), [])
+        self.assertNotIn('goo', tree)
+
+        tree.add('go', 'GO')
+        self.assertEquals(tree.completions('g'),
+                          ['gc', 'go', 'google', 'googlefight'])
+        self.assertEquals(len(tree), 6)
+
+
+class HttpTest(unittest.TestCase):
+
+    def test_header_arg_to_name(self):
+        self.assertEquals(http.header_arg_to_name('user_agent'), 'User-Agent')
+        self.assertEquals(http.header_arg_to_name('accept'), 'Accept')
+
+    def test_normalize_url(self):
+        self.assertEquals(http.normalize_url('example.com/a'),
+                          'http://example.com/a')
+        self.assertEquals(http.normalize_url(u'https://example.com'),
+                          'https://example.com')
+
+
+class FakeResponse(object):
+    ''' Response of HTTP request, delivering its body at once. '''
+    def __init__(self, code, body='', headers=None):
+        self.code = code
+        self.body = body
+        self.length = len(body)
+        self.headers = Headers(dict((name, [value]) for name, value
+                                    in (headers or {}).iteritems()))
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = http.HTTPClient()
+        self.requests = []
+        self.response = None
+
+    def request(self, url, method='GET', headers=None):
+        self.requests.append(headers)
+        return defer.succeed(self.response)
+
+    def fetch_if_modified(self, *args, **kwargs):
+        self.client.request = self.request
+        results = []
+        self.client.fetch_if_modified('http://example.com/feed', *args,
+                                      **kwargs).addBoth(results.append)
+        return results[0]
+
+    def test_modified(self):
+        self.response = FakeResponse(200, 'content', {
+            'ETag': '"v2"', 'Last-Modified': 'Fri, 02 Jan 2015 00:00:00 GMT'})
+        result = self.fetch_if_modified(
+            '"v1"', 'Thu, 01 Jan 2015 00:00:00 GMT', headers={'Accept': '*/*'})
+        self.assertEquals(result, ('content', '"v2"',
+                                   'Fri, 02 Jan 2015 00:00:00 GMT'))
+        self.assertEquals(self.requests, [{
+            'Accept': '*/*', 'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'}])
+
+    def test_unconditional(self):
+        self.response = FakeResponse(200, 'content')
+        self.assertEquals(self.fetch_if_modified(), ('content', None, None))
+        self.assertEquals(self.requests, [{}])
+
+    def test_not_modified(self):
+        self.response = FakeResponse(304)
+        result = self.fetch_if_modified('"v1"', 'Thu, 01 Jan 2015 00:00:00 GMT')
+        self.assertEquals(result, (None, '"v1"',
+                                   'Thu, 01 Jan 2015 00:00:00 GMT'))
+
+    def test_error(self):
+        self.response = FakeResponse(500, 'error')
+        failure = self.fetch_if_modified('"v1"')
+        self.assertTrue(failure.check(http.HTTPError))
+        self.assertEquals(failure.value.code, 500)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 0
+        self.cache = LRUCache(2, ttl=10, clock=lambda: self.time)
+
+    def test_eviction(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertEquals(self.cache.get('c'), 3)
+
+    def test_expiration(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2, ttl=20)
+        self.time = 15
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEquals(self.cache.get('b'), 2)
+        self.assertEquals(self.cache.stats()['hits'], 1)
+        self.assertEquals(self.cache.stats()['misses'], 1)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_merged_calls(self):
+        pending = defer.Deferred()
+        flights = SingleFlight()
+        first = flights.call('key', lambda: pending)
+        second = flights.call('key', self.fail)
+
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        pending.callback(42)
+
+        self.assertEquals(results, [42, 42])
+        self.assertEquals(flights.stats(),
+                          {'calls': 1, 'merged': 1, 'in_flight': 0})
+
+    def test_failure(self):
+        flights = SingleFlight()
+        pending = defer.Deferred()
+        first = flights.call('key', lambda: pending)
+        second = flights.call('key', self.fail)
+        pending.errback(ValueError())
+
+        errors = []
+        for d in (first, second):
+            d.addErrback(lambda failure: errors.append(failure.type))
+        self.assertEquals(errors, [ValueError, ValueError])
+        self.assertNotIn('key', flights)
+
+
+class BKTreeTest(unittest.TestCase):
+    WORDS = ('google', 'googlefight', 'wiki', 'weather', 'help', 'hello')
+
+    def test_edit_distance(self):
+        self.assertEquals(edit_distance('kitten', 'sitting'), 3)
+        self.assertEquals(edit_distance('', 'abc'), 3)
+        self.assertEquals(edit_distance('kitten', 'sitting', max_distance=1), 2)
+
+    def test_search(self):
+        tree = BKTree()
+        for word in self.WORDS:
+            self.assertTrue(tree.add(word))
+        self.assertFalse(tree.add('wiki'))
+
+        self.assertEquals(tree.search('hepl', 2), [(2, 'hello'), (2, 'help')])
+        self.assertEquals(tree.search('gogle', 1), [(1, 'google')])
+        self.assertEquals(tree.search('xyz', 1), [])
+        self.assertIn('weather', tree)
+
+
+class HostmaskTest(unittest.TestCase):
+
+    def test_parse(self):
+        hostmask = irc.parse_hostmask('nick!~id@example.com')
+        self.assertEquals((hostmask.nick, hostmask.id, hostmask.host),
+                          ('nick', '~id', 'example.com'))
+        self.assertIs(irc.parse_hostmask('nick!~id@example.com'), hostmask)
+        self.assertIsNone(irc.parse_hostmask(''))
+        self.assertRaises(AttributeError, setattr, hostmask, 'nick', 'other')
+
+    def test_accessors(self):
+        self.assertEquals(irc.get_nick('nick!id@host'), 'nick')
+        self.assertEquals(irc.get_user_id('nick!id@host'), 'id')
+        self.assertEquals(irc.get_host('nick!id@host'), 'host')
+        self.assertEquals(irc.get_nick('nick'), 'nick')
+        self.assertIsNone(irc.get_host('nick'))
+
+    def test_casemapping(self):
+        self.assertEquals(irc.irc_lower('[Foo]~'), '{foo}^')
+        self.assertEquals(irc.irc_lower(u'[Foo]~'), u'{foo}^')
+        self.assertEquals(irc.irc_lower('[Foo]~', 'ascii'), '[foo]~')
+        self.assertEquals(irc.irc_lower('[Foo]~', 'strict-rfc1459'), '{foo}~')
+
+
+class MessageTargetsTest(unittest.TestCase):
+
+    def test_max_targets(self):
+        bot = type('Bot', (object,), {})()
+        self.assertEquals(irc.get_max_targets(bot, 'PRIVMSG'), 1)
+
+        bot.supported = ServerSupportedFeatures()
+        bot.supported.parse(['MAXTARGETS=3'])
+        self.assertEquals(irc.get_max_targets(bot, 'PRIVMSG'), 3)
+        bot.supported.parse(['TARGMAX=PRIVMSG:4,NOTICE:,KICK:1'])
+        self.assertEquals(irc.get_max_targets(bot, 'PRIVMSG'), 4)
+        self.assertIsNone(irc.get_max_targets(bot, 'NOTICE'))
+        self.assertEquals(irc.get_max_targets(bot, 'WHOIS'), 1)
+
+    def test_group_targets(self):
+        targets = ['#a', '#b', '#c']
+        self.assertEquals(irc.group_targets(targets, 2), ['#a,#b', '#c'])
+        self.assertEquals(irc.group_targets(targets, None), ['#a,#b,#c'])
+        self.assertEquals(irc.group_targets(targets, None, max_length=5),
+                          ['#a,#b', '#c'])
+        self.assertEquals(irc.group_targets([], 2), [])
+
+
+class RosterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.roster = Roster()
+        self.roster.add_channel('#Chan')
+        self.roster.add('#chan', '[Nick]', 'o',
+                        irc.parse_hostmask('[Nick]!id@host'))
+        self.roster.add('#chan', 'other')
+
+    def test_membership(self):
+        self.assertTrue(self.roster.is_on('#CHAN', '{nick}'))
+        self.assertFalse(self.roster.is_on('#chan', 'unknown'))
+        self.assertEquals(sorted(self.roster.get_nicks('#chan')),
+                          ['[Nick]', 'other'])
+        self.assertEquals(self.roster.get_channels('[nick]'), ['#Chan'])
+
+    def test_modes(self):
+        self.roster.set_mode('#chan', 'other', 'v')
+        self.roster.set_mode('#chan', '[nick]', 'o', False)
+        self.assertEquals(self.roster.get_modes('#chan', 'other'), 'v')
+        self.assertEquals(self.roster.get_modes('#chan', '[nick]'), '')
+        self.assertIsNone(self.roster.get_modes('#chan', 'unknown'))
+
+    def test_rename(self):
+        self.roster.rename('[nick]', 'new')
+        self.assertFalse(self.roster.is_on('#chan', '[Nick]'))
+        self.assertTrue(self.roster.is_on('#chan', 'new'))
+        self.assertEquals(str(self.roster.get_hostmask('new')), 'new!id@host')
+
+    def test_leaving(self):
+        self.roster.remove('#chan', 'other')
+        self.assertEquals(self.roster.remove_user('[nick]'), ['#Chan'])
+        self.assertEquals(self.roster.get_nicks('#chan'), [])
+        self.roster.remove_channel('#chan')
+        self.assertNotIn('#chan', self.roster)
+
+
+class KeyValueStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = KeyValueStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_namespaces(self):
+        foo, bar = self.store.namespace('foo'), self.store.namespace('bar')
+        foo['key'] = {'a': [1, 2]}
+
+        self.assertEquals(foo['key'], {'a': [1, 2]})
+        self.assertNotIn('key', bar)
+        self.assertTrue(foo.delete('key'))
+        self.assertIsNone(foo.get('key'))
+
+    def test_scan(self):
+        ns = self.store.namespace('foo')
+        for key in ('ab', 'abc', 'a*', 'b'):
+            ns[key] = key.upper()
+        self.assertEquals(ns.scan('ab'), [('ab', 'AB'), ('abc', 'ABC')])
+        self.assertEquals(ns.scan('a*'), [('a*', 'A*')])
+        self.assertEquals(len(ns.scan()), 4)
+
+    def test_transaction(self):
+        ns = self.store.namespace('foo')
+        with ns.transaction():
+            ns['a'] = 1
+        try:
+            with ns.transaction():
+                ns['b'] = 2
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertIn('a', ns)
+        self.assertNotIn('b', ns)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        journal = Journal(self.path)
+        journal.append({'op': 'store', 'to': 'foo'})
+        journal.append({'op': 'deliver', 'to': 'foo'})
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEquals(journal.size, os.path.getsize(self.path))
+        self.assertEquals(journal.replay(), [{'op': 'store', 'to': 'foo'},
+                                             {'op': 'deliver', 'to': 'foo'}])
+
+    def test_partial_record(self):
+        journal = Journal(self.path)
+        journal.append({'op': 'store'})
+        journal.file.write('{"op": "del')
+        journal.close()
+        self.assertEquals(Journal(self.path).replay(), [{'op': 'store'}])
+
+    def test_append_after_partial_record(self):
+        journal = Journal(self.path)
+        journal.append({'op': 'store'})
+        journal.file.write('{"op": "del')
+        journal.close()
+
+        journal = Journal(self.path)
+        journal.append({'op': 'deliver'})
+        journal.close()
+        self.assertEquals(Journal(self.path).replay(),
+                          [{'op': 'store'}, {'op': 'deliver'}])
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = Scheduler(self.clock)
+        self.calls = []
+
+    def call(self, name):
+        return lambda: self.calls.append(name)
+
+    def test_schedule(self):
+        self.scheduler.schedule(2, self.call('b'))
+        self.scheduler.schedule(1, self.call('a'))
+        self.clock.advance(1)
+        self.assertEquals(self.calls, ['a'])
+        self.clock.advance(1)
+        self.assertEquals(self.calls, ['a', 'b'])
+        self.assertEquals(len(self.scheduler), 0)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 0)
+
+    def test_every(self):
+        timer = self.scheduler.every(1, self.call('x'))
+        self.scheduler.every(10, self.call('y'), jitter=5)
+        self.clock.pump([1] * 3)
+        self.assertEquals(self.calls, ['x'] * 3)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+
+        timer.cancel()
+        self.clock.pump([1] * 3)
+        self.assertEquals(self.calls, ['x'] * 3)
+        self.assertEquals(len(self.scheduler), 1)
+
+    def test_cancel(self):
+        timer = self.scheduler.schedule(1, self.call('a'))
+        self.assertTrue(timer.active)
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.clock.advance(1)
+        self.assertEquals(self.calls, [])
+        self.assertEquals(len(self.clock.getDelayedCalls()), 0)
+
+    def test_errors(self):
+        self.scheduler.schedule(1, lambda: 1 / 0)
+        self.scheduler.schedule(1, self.call('a'))
+        self.clock.advance(1)
+        self.assertEquals(self.calls, ['a'])
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    class FakeWorker(object):
+        def __init__(self):
+            self.job = self.timeout = None
+            self.requests = []
+            self.killed = False
+
+        def send(self, request):
+            self.requests.append(request)
+
+        def kill(self):
+            self.killed = True
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = WorkerPool(None, size=2, timeout=5, max_queued=2,
+                               clock=self.clock)
+        self.pool._create_worker = self.FakeWorker
+        self.pool.start()
+        self.results = []
+
+    def submit(self, request, key):
+        d = self.pool.submit(request, key)
+        d.addBoth(self.results.append)
+        return d
+
+    def finish(self, worker):
+        self.pool._finished(worker, worker.requests[-1])
+
+    def test_turns(self):
+        w1, w2 = self.pool._workers
+        for i in xrange(3):
+            self.submit('a%d' % i, 'a')
+        self.submit('b0', 'b')
+        self.assertEquals(w1.requests + w2.requests, ['a0', 'b0'])
+        self.assertEquals(len(self.pool), 2)
+
+        self.finish(w2)
+        self.assertEquals(w2.requests, ['b0'])  # 'a' still has one running
+        self.finish(w1)
+        self.submit('b1', 'b')
+        self.assertEquals(sorted([w1.requests[-1], w2.requests[-1]]),
+                          ['a1', 'b1'])
+        self.assertEquals(self.results, ['b0', 'a0'])
+
+    def test_queue_full(self):
+        for i in xrange(4):
+            self.submit(i, 'a')
+        self.assertEquals(len(self.pool), 2)
+        self.assertTrue(self.results[0].check(QueueFull))
+
+    def test_timeout(self):
+        w1, w2 = self.pool._workers
+        self.submit('x', 'a')
+        self.submit('y', 'a')
+        self.clock.advance(5)
+        self.assertTrue(self.results[0].check(defer.TimeoutError))
+        self.assertTrue(w1.killed)
+        self.assertEquals(w2.requests, ['y'])
+
+        self.clock.advance(0)  # replacement is started in background
+        self.assertEquals(len(self.pool._workers), 2)
+        self.assertNotIn(w1, self.pool._workers)